@@ -0,0 +1,69 @@
+"""Measure the startup time of the CLI commands that need neither spaCy nor the network
+
+    python -m benchmark.startup
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Modules that must not be imported before they are used
+HEAVY_MODULES = ['pandas', 'openai', 'spacy', 'lemminflect', 'unimorph', 'openpyxl']
+# Startup time budget of each command in seconds
+BUDGET_SECS = 1.0
+REPEAT = 5
+
+root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+
+def time_command(args, repeat=REPEAT):
+    """Run the command several times and return the durations in seconds
+    """
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, *args], cwd=root, check=True, 
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def find_eager_imports():
+    """Import main and return the heavy modules that are imported eagerly
+    """
+    code = f"import sys, main; print([m for m in {HEAVY_MODULES!r} if m in sys.modules])"
+    out = subprocess.run([sys.executable, '-c', code], cwd=root, check=True, capture_output=True, text=True)
+    return json.loads(out.stdout.strip().replace("'", '"'))
+
+
+def main():
+    fn_stream = os.path.join(tempfile.mkdtemp(), 'empty.jsonl')
+    open(fn_stream, 'w').close()
+    commands = {
+        "python (baseline)": ['-c', 'pass'],
+        "import main": ['-c', 'import main'],
+        "main.py --help": ['main.py', '--help'],
+        "main.py inspect": ['main.py', 'inspect'],
+        "main.py export": ['main.py', 'export', fn_stream],
+    }
+    eager = find_eager_imports()
+    if eager:
+        print(f"Heavy modules imported by `import main`: {eager}")
+    
+    over_budget = []
+    for name, args in commands.items():
+        durations = time_command(args)
+        median = statistics.median(durations)
+        print(f"{name:<20} median {median * 1000:7.1f} ms, min {min(durations) * 1000:7.1f} ms")
+        if median > BUDGET_SECS:
+            over_budget.append(name)
+    if over_budget or eager:
+        print(f"Over the budget of {BUDGET_SECS}s: {over_budget}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""Measure the end-to-end throughput of the generation on the fake backend, without network
+
+    python -m benchmark.throughput [--families 20] [--modes serial async] [--latency 0.8 0.5] [--error-rate 0.05] [--hedge]
+
+Reports items per minute, requests per item and the p50/p95 latency of an item
+(from the start of the word to its cloze item) for each mode.
+"""
+import argparse
+import asyncio
+import statistics
+import time
+import main
+from lib.backend import FakeBackend
+from lib.hedge import HedgePolicy
+from lib.nlp_helper import get_nlp, get_nlp_parser
+from lib.rate_limit import RateLimiter
+from lib.retry import RetryPolicy
+from lib.utils import setup_log
+import setting
+
+
+class ItemTimer:
+    """Record the latency of each item by wrapping main.start_word() and main.add_item()
+    """
+    def __init__(self) -> None:
+        self.started = {}
+        self.latencies = []
+        self._start_word = main.start_word
+        self._add_item = main.add_item
+
+    def start_word(self, checkpoint, word_family, word):
+        self.started[(repr(word_family), repr(word))] = time.perf_counter()
+        return self._start_word(checkpoint, word_family, word)
+
+    def add_item(self, result, word_family, word, *args, **kwargs):
+        added = self._add_item(result, word_family, word, *args, **kwargs)
+        if added:
+            self.latencies.append(time.perf_counter() - self.started[(repr(word_family), repr(word))])
+        return added
+
+    def __enter__(self):
+        main.start_word, main.add_item = self.start_word, self.add_item
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        main.start_word, main.add_item = self._start_word, self._add_item
+        return False
+
+
+def percentile(values, q):
+    if len(values) < 2:
+        return values[0] if values else float('nan')
+    return statistics.quantiles(values, n=100, method='inclusive')[q - 1]
+
+
+def run_mode(mode, word_cluster, word_families, args):
+    """Generate the word families in mode ('serial' | 'async') on a new fake backend
+
+    Returns:
+        dict: the measurements
+    """
+    backend = FakeBackend(latency_dist=args.latency_dist, latency_params=tuple(args.latency), error_rate=args.error_rate,
+                          rate_limit_rate=args.rate_limit_rate, malformed_rate=args.malformed_rate)
+    bot_sent_gen, bot_rational = main.create_bots(batched=setting.SENT_GEN_BATCH_SIZE > 1)
+    limiter = RateLimiter(rpm=args.rpm, tpm=args.tpm)
+    hedge = HedgePolicy(enabled=args.hedge)
+    # A new circuit breaker for each mode
+    retry = RetryPolicy()
+    for bot in (bot_sent_gen, bot_rational):
+        bot.backend = backend
+        bot.limiter = limiter
+        bot.hedge = hedge
+        bot.retry = retry
+    results = [main.FamilyResult() for _ in word_families]
+
+    with ItemTimer() as timer:
+        start = time.perf_counter()
+        if mode == 'async':
+            asyncio.run(main.agenerate(bot_sent_gen, bot_rational, word_cluster, word_families, results))
+        else:
+            main.generate(bot_sent_gen, bot_rational, word_cluster, word_families, results)
+        elapsed = time.perf_counter() - start
+
+    n_items = sum(len(result.rows) for result in results)
+    return {
+        "mode": mode,
+        "items": n_items,
+        "secs": elapsed,
+        "items_per_min": n_items / elapsed * 60 if elapsed else 0,
+        "calls_per_item": backend.calls / n_items if n_items else float('nan'),
+        "errors": backend.errors,
+        "hedges": hedge.hedges,
+        "p50": percentile(timer.latencies, 50),
+        "p95": percentile(timer.latencies, 95),
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="End-to-end throughput on the fake backend")
+    parser.add_argument('--families', type=int, default=20, help="number of word families to generate")
+    parser.add_argument('--modes', nargs='+', default=['serial', 'async'], choices=['serial', 'async'])
+    parser.add_argument('--latency-dist', default=setting.FAKE_LATENCY_DIST, choices=['constant', 'uniform', 'lognormal'])
+    parser.add_argument('--latency', type=float, nargs='+', default=list(setting.FAKE_LATENCY_PARAMS),
+                        help="parameters of the latency distribution in seconds")
+    parser.add_argument('--error-rate', type=float, default=setting.FAKE_ERROR_RATE)
+    parser.add_argument('--rate-limit-rate', type=float, default=setting.FAKE_RATE_LIMIT_RATE)
+    parser.add_argument('--malformed-rate', type=float, default=setting.FAKE_MALFORMED_RATE)
+    parser.add_argument('--rpm', type=int, default=setting.RATE_LIMIT_RPM, help="requests per minute of the rate limiter")
+    parser.add_argument('--tpm', type=int, default=setting.RATE_LIMIT_TPM, help="tokens per minute of the rate limiter")
+    parser.add_argument('--sent-gen-batch-size', type=int, default=setting.SENT_GEN_BATCH_SIZE)
+    parser.add_argument('--rational-batch-size', type=int, default=setting.RATIONAL_BATCH_SIZE)
+    parser.add_argument('--hedge', action='store_true', default=setting.HEDGE_ENABLED, help="hedge the slow requests")
+    return parser.parse_args()
+
+
+def run():
+    args = parse_args()
+    setup_log(level="WARNING", need_file=False)
+    setting.SENT_GEN_BATCH_SIZE = args.sent_gen_batch_size
+    setting.RATIONAL_BATCH_SIZE = args.rational_batch_size
+    word_cluster = main.load_word_cluster(main.input_path, setting.SUBLIST)
+    word_families = main.select_word_families(word_cluster, start=setting.KEYWORD_START_POS, max_count=args.families)
+    # Load spaCy before the timing
+    get_nlp()
+    if setting.SYNTAX_FILTER:
+        get_nlp_parser()
+
+    print(f"{len(word_families)} word families, latency {args.latency_dist} {args.latency}, "
+          f"error {args.error_rate}, 429 {args.rate_limit_rate}, malformed {args.malformed_rate}")
+    for mode in args.modes:
+        r = run_mode(mode, word_cluster, word_families, args)
+        print(f"{r['mode']:<8} {r['items']:4d} items in {r['secs']:7.1f}s: {r['items_per_min']:7.1f} items/min, "
+              f"{r['calls_per_item']:5.2f} calls/item, {r['errors']} errors, {r['hedges']} hedges, "
+              f"latency p50 {r['p50']:6.2f}s p95 {r['p95']:6.2f}s")
+
+
+if __name__ == '__main__':
+    run()
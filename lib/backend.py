@@ -0,0 +1,320 @@
+import asyncio
+from collections import deque
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import weakref
+from types import SimpleNamespace
+from lib.rate_limit import estimate_tokens
+import setting
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+_client = None
+# The connection pool of an async client is bound to the event loop it is first used in,
+#   and each asyncio.run() (sync batched mode, shards, benchmark) runs a new loop
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_client():
+    """The OpenAI client, created on first use so that offline commands do not pay for it
+    """
+    global _client
+    if _client is None:
+        from openai import OpenAI
+        _client = OpenAI()
+    return _client
+
+
+def get_async_client():
+    """The async OpenAI client of the running event loop
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        from openai import AsyncOpenAI
+        client = _async_clients[loop] = AsyncOpenAI()
+    return client
+
+
+class Completion:
+    """The result of a chat completion request
+
+    Args:
+        contents (list): message content of each choice
+        usage (object, optional): usage with prompt_tokens, completion_tokens and prompt_tokens_details.cached_tokens
+        headers (dict, optional): response headers, used by the rate limiter
+    """
+    def __init__(self, contents, usage=None, headers=None) -> None:
+        self.contents = contents
+        self.usage = usage
+        self.headers = headers
+
+
+class Backend:
+    """Where MyBotWrapper sends the chat completion requests
+    """
+    name = "<Abstract>"
+    # Whether the responses can be stored in the response cache
+    cacheable = True
+
+    def complete(self, params):
+        """
+        Args:
+            params (dict): the parameters of the chat completion request, see MyBotWrapper.get_request_params()
+
+        Returns:
+            Completion: the completion
+        """
+        raise NotImplementedError()
+
+    async def acomplete(self, params):
+        raise NotImplementedError()
+
+
+class OpenAIBackend(Backend):
+    name = "openai"
+
+    def complete(self, params):
+        raw = get_client().chat.completions.with_raw_response.create(**params)
+        response = raw.parse()
+        return Completion([choice.message.content for choice in response.choices], usage=response.usage, headers=raw.headers)
+
+    async def acomplete(self, params):
+        raw = await get_async_client().chat.completions.with_raw_response.create(**params)
+        response = raw.parse()
+        return Completion([choice.message.content for choice in response.choices], usage=response.usage, headers=raw.headers)
+
+
+class FakeAPIError(Exception):
+    """Raised by FakeBackend like the errors of the OpenAI client, with status_code
+    """
+    def __init__(self, status_code, message="") -> None:
+        super().__init__(f"Error code: {status_code} - {message}")
+        self.status_code = status_code
+        self.response = None
+
+
+class FakeBackend(Backend):
+    """A local backend that answers the prompts of the parsers in lib.parser with valid responses
+        made from the inputs in the prompt, for running the whole pipeline offline.
+
+        The outcome of a request (latency, error, 429, malformed JSON, content) is drawn from
+        a rng keyed by the messages and the number of times they were sent, so it is the same
+        regardless of the order of the requests.
+    """
+    name = "fake"
+    cacheable = False
+
+    # Sentence templates that keep the POS tag of the word, {} is the word,
+    #   in the length range of setting.SENT_GEN_TARGET_WORDS so that they pass the length check of the n choices
+    templates = {
+        "NN": "Our committee reviewed the {} carefully with the other members before the annual meeting in the spring.",
+        "NNS": "Several {} were discussed in detail by the researchers and the students at the annual meeting last week.",
+        "VB": "Researchers in our department often {} the data carefully before they start writing the final report.",
+        "VBP": "Many researchers in our department {} the data carefully before they start writing the final report.",
+        "VBZ": "Our research team usually {} the data every week before the regular meeting with the supervisor.",
+        "VBD": "Last year our research team {} the data carefully before the regular meeting with the supervisor.",
+        "VBG": "Our research team is {} the data from the survey this month for the final report.",
+        "VBN": "All the data from the survey have been {} carefully by our research team this year.",
+        "JJ": "After a long discussion, our committee found the proposal {} for the research budget of next year.",
+        "RB": "Despite the many problems, our research team completed the analysis {} before the deadline last month.",
+    }
+
+    def __init__(self, latency_dist=setting.FAKE_LATENCY_DIST, latency_params=setting.FAKE_LATENCY_PARAMS,
+                 error_rate=setting.FAKE_ERROR_RATE, rate_limit_rate=setting.FAKE_RATE_LIMIT_RATE,
+                 malformed_rate=setting.FAKE_MALFORMED_RATE, seed=setting.RANDOM_SEED) -> None:
+        """
+        Args:
+            latency_dist (str): 'constant' (secs) | 'uniform' (low, high) | 'lognormal' (median, sigma)
+            latency_params (tuple): parameters of the latency distribution in seconds
+            error_rate (float): ratio of requests failing with a server error (500)
+            rate_limit_rate (float): ratio of requests failing with a rate limit error (429)
+            malformed_rate (float): ratio of responses that are cut off (broken JSON or a sentence without the word)
+        """
+        self.latency_dist = latency_dist
+        self.latency_params = latency_params
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.malformed_rate = malformed_rate
+        self.seed = seed
+        self.calls = 0
+        self.errors = 0
+        # hash of messages -> number of requests
+        self._sent = {}
+        # hash of the system messages seen, to fake the prompt prefix caching
+        self._prefixes = set()
+        self._lock = threading.Lock()
+
+    def complete(self, params):
+        rng, latency = self._start(params)
+        time.sleep(latency)
+        return self._respond(params, rng)
+
+    async def acomplete(self, params):
+        rng, latency = self._start(params)
+        await asyncio.sleep(latency)
+        return self._respond(params, rng)
+
+    def _start(self, params):
+        key = hashlib.sha256(json.dumps(params['messages'], ensure_ascii=False).encode('utf-8')).hexdigest()
+        with self._lock:
+            self.calls += 1
+            count = self._sent.get(key, 0)
+            self._sent[key] = count + 1
+        rng = random.Random(f"{self.seed}:{key}:{count}")
+        return rng, self.get_latency(rng)
+
+    def get_latency(self, rng):
+        if self.latency_dist == 'constant':
+            return self.latency_params[0]
+        if self.latency_dist == 'uniform':
+            return rng.uniform(*self.latency_params)
+        if self.latency_dist == 'lognormal':
+            median, sigma = self.latency_params
+            return median * rng.lognormvariate(0, sigma)
+        raise ValueError(f"Unknown latency distribution: {self.latency_dist}")
+
+    def _respond(self, params, rng):
+        p = rng.random()
+        if p < self.rate_limit_rate:
+            self.errors += 1
+            raise FakeAPIError(429, "Rate limit reached")
+        if p < self.rate_limit_rate + self.error_rate:
+            self.errors += 1
+            raise FakeAPIError(500, "The server had an error while processing your request")
+
+        messages = params['messages']
+        prompt = messages[-1]['content']
+        is_json = params.get('response_format', {}).get('type') == 'json_object'
+        contents = []
+        for _ in range(params.get('n', 1)):
+            content = self.answer(prompt, rng)
+            if rng.random() < self.malformed_rate:
+                content = content[:len(content) // 2] if is_json else "Sorry, I cannot help with that."
+            contents.append(content)
+        return Completion(contents, usage=self.get_usage(messages, contents))
+
+    def answer(self, prompt, rng):
+        """Answer the prompt of a parser in lib.parser by its layout
+        """
+        if prompt.startswith("The words are:"):
+            items = re.findall(r'^- "(.+)" tagged as "(.+)"$', prompt, re.MULTILINE)
+            return json.dumps({word: self.make_sentence(word, tag, rng) for word, tag in items})
+        m = re.match(r'The word is "(.+)" tagged as "(.+)"\.$', prompt)
+        if m:
+            return self.make_sentence(m.group(1), m.group(2), rng)
+        stems = re.findall(r'^(\d+)\. Question stem: ".*"\n   Possible distractors: "(.*)"$', prompt, re.MULTILINE)
+        if stems:
+            return json.dumps({i: self.judge(candidates, rng) for i, candidates in stems})
+        m = re.search(r'Possible distractors: "(.*)"$', prompt)
+        if m:
+            return json.dumps(self.judge(m.group(1), rng))
+        logger.warning(f"FakeBackend cannot answer the prompt: {prompt[:100]}")
+        return "{}"
+
+    def make_sentence(self, word, tag, rng):
+        template = self.templates.get(tag) or rng.choice(list(self.templates.values()))
+        return template.format(word)
+
+    @staticmethod
+    def judge(candidates, rng):
+        """Judge the comma separated candidates, most of them are syntactically valid and semantically wrong
+        """
+        return {w: {"syntax": rng.random() < 0.8, "semantics": rng.random() < 0.2} for w in candidates.split(", ") if w}
+
+    def get_usage(self, messages, contents):
+        prompt_tokens = estimate_tokens(json.dumps(messages, ensure_ascii=False), completion_tokens=0)
+        cached_tokens = 0
+        if messages[0]['role'] == 'system':
+            key = hashlib.sha256(messages[0]['content'].encode('utf-8')).hexdigest()
+            with self._lock:
+                seen = key in self._prefixes
+                self._prefixes.add(key)
+            prefix_tokens = estimate_tokens(messages[0]['content'], completion_tokens=0)
+            # The provider caches the prefixes of 1024 tokens and more, in chunks of 128 tokens
+            if seen and prefix_tokens >= 1024:
+                cached_tokens = prefix_tokens // 128 * 128
+        return SimpleNamespace(prompt_tokens=prompt_tokens,
+                               completion_tokens=sum(estimate_tokens(c, completion_tokens=0) for c in contents),
+                               prompt_tokens_details=SimpleNamespace(cached_tokens=cached_tokens))
+
+
+class ReplayBackend(Backend):
+    """Serve the responses recorded in the log of a run, keyed by the prompt (ParserBase.format_messages()).
+        The responses of a prompt are served in the recorded order. A prompt that was not recorded, 
+        or whose responses are used up, gets an empty response and is counted in misses.
+    """
+    name = "replay"
+    cacheable = False
+
+    def __init__(self, records) -> None:
+        """
+        Args:
+            records (dict): prompt -> list of the responses
+        """
+        self.records = {prompt: deque(responses) for prompt, responses in records.items()}
+        self.calls = 0
+        self.hits = 0
+        self.misses = 0
+
+    def complete(self, params):
+        from lib.parser import ParserBase
+        prompt = ParserBase.format_messages(params['messages'])
+        is_json = params.get('response_format', {}).get('type') == 'json_object'
+        self.calls += 1
+        contents = []
+        for _ in range(params.get('n', 1)):
+            responses = self.records.get(prompt)
+            if responses:
+                self.hits += 1
+                contents.append(responses.popleft())
+            else:
+                self.misses += 1
+                logger.debug(f"No recorded response for the prompt: {prompt[-200:]}")
+                contents.append("{}" if is_json else "")
+        return Completion(contents)
+
+    async def acomplete(self, params):
+        return self.complete(params)
+
+
+_backend = None
+
+
+def get_backend():
+    """The backend of setting.LLM_BACKEND, shared by all bots in the process
+    """
+    global _backend
+    if _backend is None:
+        if setting.OFFLINE_CHATGPT or setting.LLM_BACKEND == 'fake':
+            _backend = FakeBackend()
+        elif setting.LLM_BACKEND == 'openai':
+            _backend = OpenAIBackend()
+        else:
+            raise ValueError(f"Unknown backend: {setting.LLM_BACKEND}")
+        logger.info(f"LLM backend: {_backend.name}")
+    return _backend
+
+
+###################
+# Test
+###################
+def test_fake_backend():
+    from lib.parser import SentGenParser, BatchRationalParser
+    backend = FakeBackend(latency_dist='constant', latency_params=(0,))
+    parser = SentGenParser()
+    messages = parser.compose_messages({"word": "analyse", "tag": "VB"})
+    completion = backend.complete({"messages": messages, "response_format": {"type": "text"}})
+    print(parser.parse_response(parser.format_messages(messages), completion.contents[0]))
+
+    parser = BatchRationalParser()
+    messages = parser.compose_messages({"items": [{"keyword": "analyse", "candidates": ["assess", "define"], "sentence": "We ____ the data."}]})
+    completion = backend.complete({"messages": messages, "response_format": {"type": "json_object"}})
+    print(parser.parse_response(parser.format_messages(messages), completion.contents[0])['results'])
+    assert backend.calls == 2
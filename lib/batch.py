@@ -0,0 +1,304 @@
+"""Two-phase generation through the OpenAI Batch API
+
+    1. prepare: render the SentGenParser prompts of the selected word families into a batch input file
+    2. ingest the sentence results: parse, POS check, and emit a batch of RationalParser prompts
+    3. ingest the rationality results: collect the cloze items, and emit a follow-up batch
+        for the items that do not have enough distractors yet
+
+Every batch input file comes with a manifest that keeps the inputs of each request 
+by its custom_id, so the results can be parsed without any live service.
+"""
+import glob
+import json
+import os
+import re
+from lib.nlp_helper import pos_check_batch
+from lib.utils import fill_cloze, get_date_str, get_rng
+from lib.word_cluster import MyWord
+import setting
+
+import logging
+logger = logging.getLogger(__name__)
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+SENT_GEN = "sent_gen"
+RATIONAL = "rational"
+
+
+def get_requests_path(batch_dir, phase):
+    return os.path.join(batch_dir, f"{phase}-requests.jsonl")
+
+
+def get_manifest_path(batch_dir, phase):
+    return os.path.join(batch_dir, f"{phase}-manifest.jsonl")
+
+
+def get_rational_phase(round_):
+    return f"{RATIONAL}-{round_}"
+
+
+def get_latest_rational_round(batch_dir):
+    pat = re.compile(re.escape(RATIONAL) + r"-(\d+)-manifest\.jsonl$")
+    rounds = [int(m.group(1)) for fn in glob.glob(os.path.join(batch_dir, f"{RATIONAL}-*-manifest.jsonl"))
+              if (m := pat.search(fn))]
+    return max(rounds) if rounds else 0
+
+
+def word_to_json(word: MyWord):
+    return [word.surface, word.tag]
+
+
+def word_from_json(obj) -> MyWord:
+    return MyWord(obj[0], obj[1])
+
+
+def make_batch_request(bot, inputs, custom_id):
+    """Render a request line of the batch input file
+
+    Returns:
+        dict: {"custom_id": ..., "method": "POST", "url": ..., "body": {...}}
+    """
+    messages = bot.parser.compose_messages(inputs=inputs)
+    body = bot.get_request_params(messages)
+    body.pop('timeout', None)
+    return {"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": body}
+
+
+def write_jsonl(path, objs):
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        for obj in objs:
+            f.write(json.dumps(obj, ensure_ascii=False) + "\n")
+
+
+def read_jsonl(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def read_batch_results(path):
+    """Read the output (or error) file of a batch
+
+    Returns:
+        dict: custom_id -> message content, None if the request failed
+    """
+    results = {}
+    for obj in read_jsonl(path):
+        custom_id = obj.get('custom_id')
+        response = obj.get('response') or {}
+        content = None
+        if not obj.get('error') and response.get('status_code') == 200:
+            try:
+                content = response['body']['choices'][0]['message']['content']
+            except (KeyError, IndexError, TypeError):
+                logger.warning(f"Unexpected batch result for {custom_id}: {obj}")
+        else:
+            logger.warning(f"Batch request {custom_id} failed: {obj.get('error') or response.get('status_code')}")
+        results[custom_id] = content
+    return results
+
+
+def prepare_sent_gen_batch(bot_sent_gen, word_families, batch_dir, get_inputs, words_per_family=setting.BATCH_WORDS_PER_FAMILY):
+    """Write the sentence generation requests of the word families
+
+    Args:
+        get_inputs (callable): MyWord -> inputs of the sentence generation parser
+        words_per_family (int, optional): the number of words submitted for each family, -1 means all.
+
+    Returns:
+        int: the number of requests
+    """
+    requests, manifest = [], []
+    for word_family in word_families:
+        rng = get_rng(repr(word_family))
+        words = [w for w in word_family.get_shuffled_words(rng=rng) if w]
+        if words_per_family > 0:
+            words = words[:words_per_family]
+        for order, word in enumerate(words):
+            custom_id = f"{SENT_GEN}-{len(requests)}"
+            requests.append(make_batch_request(bot_sent_gen, get_inputs(word), custom_id))
+            manifest.append({"custom_id": custom_id, "family": repr(word_family), "order": order, 
+                             "word": word_to_json(word), "inputs": get_inputs(word)})
+    write_jsonl(get_requests_path(batch_dir, SENT_GEN), requests)
+    write_jsonl(get_manifest_path(batch_dir, SENT_GEN), manifest)
+    return len(requests)
+
+
+def ingest_sent_gen_results(bot_sent_gen, bot_rational, word_cluster, batch_dir, results_path):
+    """Parse the sentence generation results and write the first rationality batch
+
+    Returns:
+        list: log rows
+    """
+    results = read_batch_results(results_path)
+    parsed = []
+    for entry in read_jsonl(get_manifest_path(batch_dir, SENT_GEN)):
+        word = word_from_json(entry['word'])
+        response = results.get(entry['custom_id'])
+        if response is None:
+            logger.error(f"No result for '{repr(word)}' ({entry['custom_id']})")
+            continue
+        prompt = bot_sent_gen.parser.format_messages(bot_sent_gen.parser.compose_messages(inputs=entry['inputs']))
+        r = bot_sent_gen.parser.parse_response(prompt=prompt, response=response)
+        parsed.append((entry, word, r))
+
+    # Tag all the generated sentences in one pass
+    pos_inputs = [{"word": word.surface, "tag": word.tag, "sentence": fill_cloze(r.get('result'), word.surface)} 
+                  for _, word, r in parsed if r.get('success')]
+    pos_results = iter(pos_check_batch(pos_inputs))
+    
+    log_data = []
+    items = []
+    count_per_family = {}
+    for entry, word, r in parsed:
+        suc = r.get('success')
+        log_data.append([get_date_str(), bot_sent_gen.task_name, word.surface, word.tag, r.get('prompt'), r.get('raw_response'), r.get('result'), suc])
+        if suc:
+            sentence = fill_cloze(r.get('result'), word.surface)
+            suc = next(pos_results)
+            log_data.append([get_date_str(), "POS Check", word.surface, word.tag, f"Tag: {word.tag}, Sentence: {sentence}", "-", "-", suc])
+        family = entry['family']
+        if not suc:
+            logger.error(f"Failed to generate sentence for '{repr(word)}'")
+            continue
+        if count_per_family.get(family, 0) >= setting.WORD_PER_FAMILY:
+            continue
+        count_per_family[family] = count_per_family.get(family, 0) + 1
+        items.append({"family": family, "word": entry['word'], "sentence": r.get('result'),
+                      "excepts": [entry['word']], "distractors": [], "trial": 0})
+    n = write_rational_batch(bot_rational, word_cluster, batch_dir, items, round_=1)
+    logger.info(f"{len(items)} sentences accepted, {n} rationality requests written")
+    return log_data
+
+
+def write_rational_batch(bot_rational, word_cluster, batch_dir, items, round_):
+    """Sample distractor candidates for the items and write the rationality requests
+
+    Returns:
+        int: the number of requests
+    """
+    requests, manifest = [], []
+    for item in items:
+        word = word_from_json(item['word'])
+        rng = get_rng(f"{item['family']}:{repr(word)}:{item['trial']}")
+        excepts = [word_from_json(w) for w in item['excepts']]
+        candidates = word_cluster.find_distractors(word.tag, excepts=excepts, n=setting.TEST_DISTRACTOR_COUNT, rng=rng)
+        if len(candidates) == 0:
+            logger.warning(f"No more distractor candidates for '{word}'")
+            continue
+        custom_id = f"{RATIONAL}-{round_}-{len(requests)}"
+        inputs = {"keyword": word, "candidates": candidates, "sentence": item['sentence']}
+        requests.append(make_batch_request(bot_rational, inputs, custom_id))
+        manifest.append({**item, "custom_id": custom_id, 
+                         "candidates": [word_to_json(w) for w in candidates],
+                         "excepts": item['excepts'] + [word_to_json(w) for w in candidates]})
+    phase = get_rational_phase(round_)
+    write_jsonl(get_requests_path(batch_dir, phase), requests)
+    write_jsonl(get_manifest_path(batch_dir, phase), manifest)
+    return len(requests)
+
+
+def ingest_rational_results(bot_rational, word_cluster, batch_dir, results_path, round_=None, max_trials=5):
+    """Collect the distractors from a rationality batch. Items that do not have enough distractors 
+        are sent to a follow-up batch (round_ + 1), up to max_trials rounds.
+
+    Returns:
+        (list, list): rows of [clozed_sentence, keyword, *distractors], and log rows
+    """
+    round_ = round_ or get_latest_rational_round(batch_dir)
+    results = read_batch_results(results_path)
+    data, log_data, pending = [], [], []
+    for entry in read_jsonl(get_manifest_path(batch_dir, get_rational_phase(round_))):
+        word = word_from_json(entry['word'])
+        item = {k: entry[k] for k in ("family", "word", "sentence", "excepts", "distractors", "trial")}
+        item['trial'] += 1
+        response = results.get(entry['custom_id'])
+        if response is not None:
+            candidates = [word_from_json(w) for w in entry['candidates']]
+            messages = bot_rational.parser.compose_messages(inputs={"keyword": word, "candidates": candidates, "sentence": entry['sentence']})
+            prompt = bot_rational.parser.format_messages(messages)
+            r = bot_rational.parser.parse_response(prompt=prompt, response=response)
+            suc = r.get('success')
+            good_candidates = r.get('good_candidates')
+            log_data.append([get_date_str(), bot_rational.task_name, word.surface, word.tag, prompt, response, good_candidates, suc])
+            if suc:
+                item['distractors'] = (item['distractors'] + [str(w) for w in good_candidates])[:setting.DISTRACTOR_COUNT]
+            else:
+                logger.error(f"Failed to decide proper distractors for {word}")
+        else:
+            logger.error(f"No result for '{repr(word)}' ({entry['custom_id']})")
+
+        if len(item['distractors']) >= setting.DISTRACTOR_COUNT:
+            data.append([item['sentence'], word.surface, *item['distractors']])
+        elif item['trial'] < max_trials:
+            pending.append(item)
+        else:
+            logger.error(f"Failed to generate enough distractors for '{word}'")
+
+    if pending:
+        n = write_rational_batch(bot_rational, word_cluster, batch_dir, pending, round_=round_ + 1)
+        logger.info(f"{n} follow-up rationality requests written for round {round_ + 1}")
+    return data, log_data
+
+
+def submit_batch(requests_path):
+    """Upload a batch input file and create the batch
+
+    Returns:
+        str: batch id
+    """
+    from lib.backend import get_client
+    client = get_client()
+    with open(requests_path, 'rb') as f:
+        batch_file = client.files.create(file=f, purpose="batch")
+    batch = client.batches.create(input_file_id=batch_file.id, endpoint=BATCH_ENDPOINT, completion_window="24h")
+    logger.info(f"Batch {batch.id} created for {requests_path}")
+    return batch.id
+
+
+def download_batch_results(batch_id, results_path):
+    """Download the output of a batch if it is completed
+
+    Returns:
+        bool: whether the results are downloaded
+    """
+    from lib.backend import get_client
+    client = get_client()
+    batch = client.batches.retrieve(batch_id)
+    logger.info(f"Batch {batch_id}: {batch.status} {batch.request_counts}")
+    if batch.status != "completed":
+        return False
+    lines = []
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if file_id:
+            lines.append(client.files.content(file_id).text.strip())
+    dirname = os.path.dirname(results_path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    with open(results_path, 'w', encoding='utf-8') as f:
+        f.write("\n".join(line for line in lines if line) + "\n")
+    return True
+
+
+###################
+# Test
+###################
+def test_read_batch_results():
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(), 'results.jsonl')
+    write_jsonl(path, [
+        {"custom_id": "a", "response": {"status_code": 200, "body": {"choices": [{"message": {"content": "hello"}}]}}, "error": None},
+        {"custom_id": "b", "response": None, "error": {"code": "server_error"}},
+    ])
+    results = read_batch_results(path)
+    assert results == {"a": "hello", "b": None}
+    print(results)
+
+
+if __name__ == '__main__':
+    test_read_batch_results()
@@ -0,0 +1,152 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import setting
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """On-disk cache of raw LLM responses backed by SQLite.
+    
+        The key is a hash of everything that decides the response (model, temperature, 
+        response format, task name and prompt). When the total size of the cached responses 
+        exceeds max_size_mb, the least recently used entries are evicted.
+    """
+    def __init__(self, path=setting.RESPONSE_CACHE_PATH, max_size_mb=setting.RESPONSE_CACHE_MAX_SIZE_MB) -> None:
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.path = path
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # WAL and a busy timeout let the processes of a sharded run share the cache
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            response TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            last_access REAL NOT NULL
+        )''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_last_access ON responses (last_access)')
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(model, temperature, response_format, task_name, prompt, variant=0, n=1):
+        """Compute the content address of a request
+
+        Args:
+            prompt (str): the text of the request, the JSON of the chat messages for MyBotWrapper
+            variant (int, optional): distinguish repeated requests of the same prompt, 
+                e.g. the n-th trial of a non-deterministic generation. Defaults to 0.
+            n (int, optional): the number of completions in the request. Defaults to 1.
+        """
+        obj = [model, temperature, response_format, task_name, prompt, variant]
+        if n != 1:
+            obj.append(n)
+        return hashlib.sha256(json.dumps(obj, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute('SELECT response FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute('UPDATE responses SET last_access = ? WHERE key = ?', (time.time(), key))
+            self._conn.commit()
+            return row[0]
+
+    def put(self, key, response):
+        self.put_many([(key, response)])
+
+    def put_many(self, items):
+        """Put many (key, response) pairs in one transaction
+        """
+        with self._lock:
+            now = time.time()
+            # Take the write lock first, so that the total size read by _evict() includes the writes of the other processes
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                for key, response in items:
+                    self._conn.execute('INSERT OR REPLACE INTO responses (key, response, size, last_access) VALUES (?, ?, ?, ?)',
+                                       (key, response, len(response.encode('utf-8')), now))
+                self._evict()
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                raise
+
+    def _get_total_size(self):
+        return self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def _evict(self):
+        total_size = self._get_total_size()
+        if total_size <= self.max_size:
+            return
+        n_evicted = 0
+        for key, size in self._conn.execute('SELECT key, size FROM responses ORDER BY last_access').fetchall():
+            if total_size <= self.max_size:
+                break
+            self._conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+            total_size -= size
+            n_evicted += 1
+        logger.debug(f"Evicted {n_evicted} entries from response cache")
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+
+    def stats(self):
+        total = self.hits + self.misses
+        with self._lock:
+            total_size = self._get_total_size()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "size_mb": total_size / 1024 / 1024,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+###################
+# Test
+###################
+def test_cache():
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(), 'responses.sqlite')
+    cache = ResponseCache(path=path, max_size_mb=20 / 1024 / 1024)
+    k1 = cache.make_key('model', 0, 'text', 'task', 'prompt 1')
+    k2 = cache.make_key('model', 0, 'text', 'task', 'prompt 2')
+    assert cache.get(k1) is None
+    cache.put(k1, '0123456789')
+    assert cache.get(k1) == '0123456789'
+    cache.put(k2, '0123456789')
+    cache.get(k1)
+    # k2 is the least recently used one now
+    cache.put(cache.make_key('model', 0, 'text', 'task', 'prompt 3'), '0123456789')
+    assert cache.get(k2) is None and cache.get(k1) is not None
+    print(cache.stats())
+
+    # The size limit holds for the writes of several processes sharing the file
+    other = ResponseCache(path=path, max_size_mb=20 / 1024 / 1024)
+    other.put(cache.make_key('model', 0, 'text', 'task', 'prompt 4'), '0123456789')
+    cache.put(cache.make_key('model', 0, 'text', 'task', 'prompt 5'), '0123456789')
+    assert len(cache) == 2 and cache.stats()['size_mb'] * 1024 * 1024 == 20
+    other.close()
+    cache.close()
+
+
+if __name__ == '__main__':
+    test_cache()
@@ -1,44 +1,259 @@
-from openai import OpenAI
-from tenacity import retry, stop_after_attempt
+import copy
+import json
+import time
+from lib.backend import get_backend
+from lib.hedge import hedge_policy
+from lib.metrics import get_tag, metrics
+from lib.rate_limit import limiter
+from lib.retry import PARSE, RequestFailed, retry_policy
+from lib.tracing import span
 import setting
 
 import logging
 logger = logging.getLogger(__name__)
 
-client = OpenAI()
-
-
-
 class MyBotWrapper:
-    def __init__(self, parser, model=setting.DEFAULT_MODEL, temperature=0.5) -> None:
+    def __init__(self, parser, model=setting.DEFAULT_MODEL, temperature=0.5, cache=None, backend=None) -> None:
+        """
+        Args:
+            cache (ResponseCache, optional): cache the raw responses that are parsed successfully. 
+                Defaults to None (no cache).
+            backend (Backend, optional): where the requests go. Defaults to None (get_backend()).
+        """
         self.parser = parser
         self.model = model
         self.temperature = temperature
+        self.backend = backend or get_backend()
+        # Responses of the local backends must not be mixed with the real ones
+        self.cache = cache if self.backend.cacheable else None
+        self.limiter = limiter
+        self.hedge = hedge_policy
+        self.retry = retry_policy
+        # Token usage of the requests sent by this bot
+        self.usage = {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
     
-    @retry(stop=stop_after_attempt(3))
-    def run(self, inputs):
-        prompt = self.parser.compose_prompt(inputs=inputs)
+    def run(self, inputs, variant=0):
+        """Run the task with the inputs
+
+        Args:
+            inputs (dict): inputs for the parser to compose the prompt
+            variant (int, optional): the n-th request of the same inputs (e.g. trial number),
+                cached separately so that retries do not get the same response. Defaults to 0.
+
+        Returns:
+            dict: the parsed response, or parser.failed_response() if the request failed after its retries
+                or the response broke the parser
+                (see lib.retry, a CircuitOpenError is raised when too many runs failed in a row)
+        """
+        start = time.perf_counter()
+        messages = self.parser.compose_messages(inputs=inputs)
+        prompt = self.parser.format_messages(messages)
+        logger.debug(f"PROMPT: {prompt}")
+        key, response = self.get_cached_response(messages, variant=variant)
+        if response is None:
+            try:
+                response = self.get_completion(messages)
+            except RequestFailed as e:
+                res = self.parser.failed_response(prompt, e.error_class, e.error)
+                self.record_run(inputs, start, [res])
+                return res
+        logger.debug(f"RAW RESPONSE: {response}")
+        res = self.parse_response(self.parser, prompt, response)
+        logger.debug(f"PARSED RESPONSE: {res}")
+        self.put_cached_response(key, response, res)
+        self.record_run(inputs, start, [res])
+        return res
+
+    async def arun(self, inputs, variant=0):
+        """Async version of run()
+        
+        The parser keeps the inputs between compose_messages() and parse_response(),
+            so each call works on its own copy to allow concurrent calls on the same bot.
+        """
+        start = time.perf_counter()
+        parser = copy.copy(self.parser)
+        messages = parser.compose_messages(inputs=inputs)
+        prompt = parser.format_messages(messages)
         logger.debug(f"PROMPT: {prompt}")
-        if setting.OFFLINE_CHATGPT:
-            res = self.parser.get_sample_response(prompt=prompt)
-            logger.debug(f"PARSED RESPONSE: {res}")
-        else:
-            response = self.get_completion(prompt=prompt)
-            logger.debug(f"RAW RESPONSE: {response}")
-            res = self.parser.parse_response(prompt=prompt, response=response)
-            logger.debug(f"PARSED RESPONSE: {res}")
+        key, response = self.get_cached_response(messages, variant=variant)
+        if response is None:
+            try:
+                response = await self.aget_completion(messages)
+            except RequestFailed as e:
+                res = parser.failed_response(prompt, e.error_class, e.error)
+                self.record_run(inputs, start, [res])
+                return res
+        logger.debug(f"RAW RESPONSE: {response}")
+        res = self.parse_response(parser, prompt, response)
+        logger.debug(f"PARSED RESPONSE: {res}")
+        self.put_cached_response(key, response, res)
+        self.record_run(inputs, start, [res])
         return res
 
-    def get_completion(self, prompt):
-        messages = [{"role": "user", "content": prompt}]
-        response = client.chat.completions.create(
+    def run_multi(self, inputs, n, variant=0):
+        """Run the task with the inputs and get n completions in one request
+
+        Returns:
+            list: parsed result of each completion
+        """
+        start = time.perf_counter()
+        messages = self.parser.compose_messages(inputs=inputs)
+        prompt = self.parser.format_messages(messages)
+        logger.debug(f"PROMPT: {prompt}")
+        key, cached = self.get_cached_response(messages, variant=variant, n=n)
+        try:
+            responses = json.loads(cached) if cached is not None else self.get_completions(messages, n=n)
+        except RequestFailed as e:
+            results = [self.parser.failed_response(prompt, e.error_class, e.error)]
+            self.record_run(inputs, start, results)
+            return results
+        logger.debug(f"RAW RESPONSES: {responses}")
+        results = [self.parse_response(self.parser, prompt, response) for response in responses]
+        logger.debug(f"PARSED RESPONSES: {results}")
+        self.put_cached_response(key, json.dumps(responses, ensure_ascii=False), {"success": any(r.get('success') for r in results)})
+        self.record_run(inputs, start, results)
+        return results
+
+    async def arun_multi(self, inputs, n, variant=0):
+        """Async version of run_multi()
+        """
+        start = time.perf_counter()
+        parser = copy.copy(self.parser)
+        messages = parser.compose_messages(inputs=inputs)
+        prompt = parser.format_messages(messages)
+        logger.debug(f"PROMPT: {prompt}")
+        key, cached = self.get_cached_response(messages, variant=variant, n=n)
+        try:
+            responses = json.loads(cached) if cached is not None else await self.aget_completions(messages, n=n)
+        except RequestFailed as e:
+            results = [parser.failed_response(prompt, e.error_class, e.error)]
+            self.record_run(inputs, start, results)
+            return results
+        logger.debug(f"RAW RESPONSES: {responses}")
+        results = [self.parse_response(parser, prompt, response) for response in responses]
+        logger.debug(f"PARSED RESPONSES: {results}")
+        self.put_cached_response(key, json.dumps(responses, ensure_ascii=False), {"success": any(r.get('success') for r in results)})
+        self.record_run(inputs, start, results)
+        return results
+
+    def parse_response(self, parser, prompt, response):
+        """Parse a response, one that breaks the parser (e.g. valid JSON of an unexpected shape) is a failed result
+            of the parse error class, retried by the trial loops like the responses that the parser rejects
+        """
+        try:
+            return parser.parse_response(prompt=prompt, response=response)
+        except Exception as e:
+            logger.warning(f"{self.task_name}: failed to parse the response: {e!r}")
+            return parser.failed_response(prompt, PARSE, e, response=response)
+
+    def get_cached_response(self, messages, variant=0, n=1):
+        """Look up the response of the chat messages in the cache
+
+        Returns:
+            (str, str): the cache key and the cached response, 
+                the response is None if not cached or cache is disabled
+        """
+        if not self.cache:
+            return None, None
+        key = self.get_cache_key(messages, variant=variant, n=n)
+        response = self.cache.get(key)
+        if response is not None:
+            logger.debug(f"Cache hit for {self.task_name}")
+            metrics.inc('llm_cache_hits_total', stage=self.task_name)
+        return key, response
+
+    def get_cache_key(self, messages, variant=0, n=1):
+        return self.cache.make_key(self.model, self.temperature, self.parser.response_format, 
+                                   self.task_name, json.dumps(messages, ensure_ascii=False), variant=variant, n=n)
+
+    def put_cached_response(self, key, response, res):
+        # Only cache the responses that are usable
+        if key and res.get('success'):
+            self.cache.put(key, response)
+
+    def get_completion(self, messages):
+        return self.get_completions(messages, n=1)[0]
+
+    async def aget_completion(self, messages):
+        return (await self.aget_completions(messages, n=1))[0]
+
+    def get_completions(self, messages, n=1):
+        with span("LLM call", task=self.task_name, n=n):
+            completion = self.retry.call(self.task_name, lambda: self.hedge.call(self.task_name, lambda: self.send_request(messages, n=n)))
+        return completion.contents
+
+    async def aget_completions(self, messages, n=1):
+        with span("LLM call", task=self.task_name, n=n):
+            completion = await self.retry.acall(self.task_name, lambda: self.hedge.acall(self.task_name, lambda: self.asend_request(messages, n=n)))
+        return completion.contents
+
+    def send_request(self, messages, n=1):
+        """One attempt of a request, each hedged attempt goes through the rate limiter on its own
+        """
+        with self.limiter.request(self.parser.format_messages(messages), n=n) as req:
+            start = time.perf_counter()
+            completion = self.backend.complete(self.get_request_params(messages, n=n))
+            metrics.observe('llm_request_seconds', time.perf_counter() - start, stage=self.task_name)
+            req.headers = completion.headers
+        # The usage of every attempt is counted, including the hedges that lost
+        self.record_usage(completion.usage)
+        return completion
+
+    async def asend_request(self, messages, n=1):
+        async with self.limiter.request(self.parser.format_messages(messages), n=n) as req:
+            start = time.perf_counter()
+            completion = await self.backend.acomplete(self.get_request_params(messages, n=n))
+            metrics.observe('llm_request_seconds', time.perf_counter() - start, stage=self.task_name)
+            req.headers = completion.headers
+        self.record_usage(completion.usage)
+        return completion
+
+    def get_request_params(self, messages, n=1):
+        params = dict(
             model=self.model,
             messages=messages,
             temperature=self.temperature, # this is the degree of randomness of the model's output
             timeout=setting.REQUEST_TIMEOUT_SECS,
             response_format={ "type": self.parser.response_format }
         )
-        return response.choices[0].message.content
+        if n > 1:
+            params['n'] = n
+        return params
+
+    def record_usage(self, usage):
+        """Count the prompt tokens served from the provider's prompt cache and the uncached ones
+        """
+        if usage is None:
+            return
+        details = getattr(usage, 'prompt_tokens_details', None)
+        cached = getattr(details, 'cached_tokens', None) or 0
+        prompt_tokens = usage.prompt_tokens or 0
+        self.usage['calls'] += 1
+        self.usage['prompt_tokens'] += prompt_tokens
+        self.usage['cached_tokens'] += cached
+        self.usage['completion_tokens'] += usage.completion_tokens or 0
+        metrics.record_usage(self.task_name, self.model, prompt_tokens, cached, usage.completion_tokens or 0)
+        logger.debug(f"{self.task_name} prompt tokens: {cached} cached, {prompt_tokens - cached} uncached")
+
+    def record_run(self, inputs, start, results):
+        """Observe the latency of a run (cache lookup, request and parsing) and whether its results are accepted by the parser,
+            and record its outcome in the circuit breaker
+        """
+        metrics.observe('stage_seconds', time.perf_counter() - start, stage=self.task_name)
+        for res in results:
+            metrics.count_result(self.task_name, res.get('success'), tag=get_tag(inputs))
+        success = any(res.get('success') for res in results)
+        self.retry.record(self.task_name, success, error_class=None if success else results[0].get('error') or PARSE)
+
+    def usage_summary(self):
+        """
+        Returns:
+            str: e.g. "12 calls, 4800 prompt tokens (3072 cached, 64.0%), 600 completion tokens"
+        """
+        u = self.usage
+        ratio = u['cached_tokens'] / u['prompt_tokens'] if u['prompt_tokens'] else 0
+        return (f"{u['calls']} calls, {u['prompt_tokens']} prompt tokens ({u['cached_tokens']} cached, {ratio:.1%}), "
+                f"{u['completion_tokens']} completion tokens")
 
     @property
     def task_name(self):
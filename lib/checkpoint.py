@@ -0,0 +1,123 @@
+import json
+import os
+import time
+import setting
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+DONE = 'done'
+FAILED = 'failed'
+IN_FLIGHT = 'in_flight'
+
+
+class Checkpoint:
+    """Durable progress of a generation run, identified by its run id.
+    
+        The state changes of the items (word families and words) are appended to a JSONL file
+        and fsync'ed, so the progress survives a crash. The first line keeps the meta data of the run
+        (output files, word family selection, ...) that a resumed run needs.
+    """
+    def __init__(self, run_id, meta=None, checkpoint_dir=setting.CHECKPOINT_DIR) -> None:
+        """
+        Args:
+            run_id (str): the id of the run
+            meta (dict, optional): meta data of a new run, ignored if the checkpoint exists
+        """
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        self.run_id = run_id
+        self.path = os.path.join(checkpoint_dir, f"{run_id}.jsonl")
+        self.meta = meta or {}
+        self.states = {}
+        if os.path.exists(self.path):
+            self._load()
+        self._file = open(self.path, 'a', encoding='utf-8')
+        if not self.states and not os.path.getsize(self.path):
+            self._write({"meta": self.meta})
+
+    @classmethod
+    def exists(cls, run_id, checkpoint_dir=setting.CHECKPOINT_DIR):
+        return os.path.exists(os.path.join(checkpoint_dir, f"{run_id}.jsonl"))
+
+    @classmethod
+    def claim(cls, run_id, checkpoint_dir=setting.CHECKPOINT_DIR):
+        """Create the empty checkpoint file of a new run, atomically
+
+        Returns:
+            bool: False if a run with the id exists
+        """
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        try:
+            os.close(os.open(os.path.join(checkpoint_dir, f"{run_id}.jsonl"), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            return False
+        return True
+
+    def _load(self):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    obj = json.loads(line)
+                except json.decoder.JSONDecodeError:
+                    # the last line may be incomplete after a crash
+                    logger.warning(f"Skip broken line in checkpoint {self.path}: {line!r}")
+                    continue
+                if 'meta' in obj:
+                    self.meta = obj['meta']
+                else:
+                    self.states[obj['key']] = obj['state']
+
+    def _write(self, obj):
+        self._file.write(json.dumps(obj, ensure_ascii=False) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    @staticmethod
+    def get_key(word_family, word=None):
+        """The key of a word family, or of a word in the word family
+        """
+        if word is None:
+            return repr(word_family)
+        return f"{repr(word_family)}/{repr(word)}"
+
+    def mark(self, key, state):
+        self.states[key] = state
+        self._write({"key": key, "state": state, "time": time.time()})
+
+    def get_state(self, key):
+        return self.states.get(key)
+
+    def is_finished(self, key):
+        return self.states.get(key) in (DONE, FAILED)
+
+    def summary(self):
+        counts = {}
+        for state in self.states.values():
+            counts[state] = counts.get(state, 0) + 1
+        return counts
+
+    def close(self):
+        self._file.close()
+
+
+###################
+# Test
+###################
+def test_checkpoint():
+    import tempfile
+    checkpoint_dir = tempfile.mkdtemp()
+    cp = Checkpoint('run', meta={"sublist": 1}, checkpoint_dir=checkpoint_dir)
+    cp.mark('a', IN_FLIGHT)
+    cp.mark('a', DONE)
+    cp.mark('b', IN_FLIGHT)
+    cp.close()
+    cp = Checkpoint('run', checkpoint_dir=checkpoint_dir)
+    assert cp.meta == {"sublist": 1}
+    assert cp.is_finished('a') and not cp.is_finished('b')
+    print(cp.summary())
+    assert not Checkpoint.claim('run', checkpoint_dir=checkpoint_dir) and Checkpoint.claim('run-2', checkpoint_dir=checkpoint_dir)
+
+
+if __name__ == '__main__':
+    test_checkpoint()
@@ -0,0 +1,134 @@
+import re
+import numpy as np
+import setting
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class WordVectors:
+    """Word vectors from a local file, normalized to unit length
+    
+        Supported formats:
+            .txt / .vec: word2vec or GloVe text format (the word2vec header line is optional)
+            .npz: arrays "words" (n,) and "vectors" (n, d)
+    """
+    def __init__(self, words: list, matrix: np.ndarray) -> None:
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        self.matrix = (matrix / norms).astype(np.float32)
+        self.word_to_row = {w: i for i, w in enumerate(words)}
+        self.dim = self.matrix.shape[1] if self.matrix.ndim == 2 else 0
+
+    @classmethod
+    def load(cls, path, vocabulary=None):
+        """Load the vectors of a file
+
+        Args:
+            vocabulary (set, optional): only keep the vectors of these (lowercase) words to save memory
+        """
+        if path.endswith('.npz'):
+            data = np.load(path, allow_pickle=False)
+            words, matrix = [str(w) for w in data['words']], data['vectors']
+            if vocabulary is not None:
+                rows = [i for i, w in enumerate(words) if w.lower() in vocabulary]
+                words, matrix = [words[i] for i in rows], matrix[rows]
+            return cls(words, matrix)
+        
+        words, vectors = [], []
+        with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+            for i, line in enumerate(f):
+                parts = line.rstrip().split(' ')
+                if i == 0 and len(parts) == 2:
+                    # word2vec header: <count> <dim>
+                    continue
+                word = parts[0]
+                if vocabulary is not None and word.lower() not in vocabulary:
+                    continue
+                words.append(word)
+                vectors.append(np.asarray(parts[1:], dtype=np.float32))
+        logger.info(f"{len(words)} word vectors loaded from {path}")
+        return cls(words, np.vstack(vectors) if vectors else np.zeros((0, 0), dtype=np.float32))
+
+    def get(self, word):
+        """The unit vector of the word, None if unknown
+        """
+        i = self.word_to_row.get(word, self.word_to_row.get(word.lower()))
+        return None if i is None else self.matrix[i]
+
+    def embed_text(self, text):
+        """The normalized mean vector of the known content words in the text
+        """
+        tokens = [t for t in re.findall(r"[A-Za-z]+", text) if len(t) > 2]
+        vectors = [v for v in (self.get(t) for t in tokens) if v is not None]
+        if not vectors:
+            return np.zeros(self.dim, dtype=np.float32)
+        mean = np.mean(vectors, axis=0)
+        norm = np.linalg.norm(mean)
+        return mean / norm if norm else mean
+
+
+class DistractorRanker:
+    """Rank the distractor candidates by how likely they are "syntax true, semantics false":
+        related to the keyword (so the question is not trivial) but unrelated to the context of 
+        the sentence (so the candidate does not fit), and not a near-synonym of the keyword.
+        
+        The vectors of all words in the WordCluster are preloaded into one matrix, 
+        so scoring a list of candidates is a few matrix-vector products.
+    """
+    def __init__(self, vectors: WordVectors, word_cluster, 
+                 keyword_weight=setting.EMBEDDING_KEYWORD_WEIGHT, context_weight=setting.EMBEDDING_CONTEXT_WEIGHT,
+                 synonym_threshold=setting.EMBEDDING_SYNONYM_THRESHOLD) -> None:
+        self.vectors = vectors
+        self.keyword_weight = keyword_weight
+        self.context_weight = context_weight
+        self.synonym_threshold = synonym_threshold
+        surfaces = sorted({w.surface for words in word_cluster.tag_to_words.values() for w in words})
+        self.surface_to_row = {s: i for i, s in enumerate(surfaces)}
+        # unknown words are zero vectors, i.e. neutral scores
+        self.matrix = np.zeros((len(surfaces), vectors.dim), dtype=np.float32)
+        n_known = 0
+        for s, i in self.surface_to_row.items():
+            v = vectors.get(s)
+            if v is not None:
+                self.matrix[i] = v
+                n_known += 1
+        logger.info(f"Word vectors found for {n_known}/{len(surfaces)} words in the cluster")
+
+    @classmethod
+    def from_file(cls, path, word_cluster):
+        vocabulary = {w.surface.lower() for words in word_cluster.tag_to_words.values() for w in words}
+        return cls(WordVectors.load(path, vocabulary=vocabulary), word_cluster)
+
+    def score(self, keyword, sentence, candidates):
+        """Score the candidates, higher is better
+
+        Args:
+            keyword (MyWord): the correct answer
+            sentence (str): the clozed sentence
+            candidates (list): MyWord candidates
+
+        Returns:
+            np.ndarray: scores of the candidates
+        """
+        rows = [self.surface_to_row.get(c.surface, -1) for c in candidates]
+        m = np.zeros((len(candidates), self.vectors.dim), dtype=np.float32)
+        known = [i for i, r in enumerate(rows) if r >= 0]
+        m[known] = self.matrix[[rows[i] for i in known]]
+        
+        kw = self.vectors.get(keyword.surface)
+        sim_keyword = m @ kw if kw is not None else np.zeros(len(candidates), dtype=np.float32)
+        sim_context = m @ self.vectors.embed_text(sentence)
+        scores = self.keyword_weight * sim_keyword - self.context_weight * sim_context
+        # a near-synonym of the keyword would also be correct
+        scores[sim_keyword > self.synonym_threshold] = -np.inf
+        return scores
+
+    def rank(self, keyword, sentence, candidates):
+        """Sort the candidates from the best to the worst
+        """
+        if not candidates:
+            return []
+        scores = self.score(keyword, sentence, candidates)
+        order = np.argsort(-scores, kind='stable')
+        return [candidates[i] for i in order]
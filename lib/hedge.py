@@ -0,0 +1,232 @@
+import asyncio
+import contextvars
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from lib.metrics import metrics
+import setting
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class DeadlineExceeded(TimeoutError):
+    """No attempt of a request finished within the deadline of its stage
+    """
+
+
+class HedgePolicy:
+    """Send a duplicate of a request that is slower than usual, and take whichever attempt finishes first.
+
+        - the hedge is sent when the request has not returned after the given percentile of
+            the recent latencies of its stage (task name), within [min_delay, max_delay]
+        - the hedges are paid from a budget: each request adds budget_ratio token up to budget_burst,
+            and a hedge takes one, so the extra traffic stays under budget_ratio of the requests
+        - a stage in deadlines gives up on all its attempts after that many seconds (DeadlineExceeded),
+            so one stalled request does not hold up the items waiting for it
+    """
+    def __init__(self, enabled=setting.HEDGE_ENABLED, percentile=setting.HEDGE_PERCENTILE,
+                 min_delay=setting.HEDGE_MIN_DELAY_SECS, max_delay=setting.HEDGE_MAX_DELAY_SECS,
+                 min_samples=setting.HEDGE_MIN_SAMPLES, window=setting.HEDGE_WINDOW,
+                 budget_ratio=setting.HEDGE_BUDGET_RATIO, budget_burst=setting.HEDGE_BUDGET_BURST,
+                 deadlines=setting.STAGE_DEADLINE_SECS) -> None:
+        self.enabled = enabled
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.min_samples = min_samples
+        self.window = window
+        self.budget_ratio = budget_ratio
+        self.budget_burst = budget_burst
+        self.deadlines = deadlines or {}
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._budget = float(budget_burst)
+        self._latencies = {}
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            if stage not in self._latencies:
+                self._latencies[stage] = deque(maxlen=self.window)
+            self._latencies[stage].append(seconds)
+
+    def get_delay(self, stage):
+        """The time to wait for a request of the stage before sending its hedge
+        """
+        with self._lock:
+            latencies = sorted(self._latencies.get(stage, []))
+        if len(latencies) < self.min_samples:
+            # Not enough samples to tell a slow request from a normal one yet
+            return self.max_delay
+        delay = latencies[min(int(self.percentile * len(latencies)), len(latencies) - 1)]
+        return min(max(delay, self.min_delay), self.max_delay)
+
+    def get_deadline(self, stage):
+        return self.deadlines.get(stage)
+
+    def _start_request(self):
+        with self._lock:
+            self.requests += 1
+            self._budget = min(self._budget + self.budget_ratio, self.budget_burst)
+
+    def take_budget(self):
+        with self._lock:
+            if self._budget < 1:
+                return False
+            self._budget -= 1
+            self.hedges += 1
+            return True
+
+    def _timed(self, stage, func):
+        start = time.perf_counter()
+        result = func()
+        self.observe(stage, time.perf_counter() - start)
+        return result
+
+    async def _atimed(self, stage, func):
+        start = time.perf_counter()
+        result = await func()
+        self.observe(stage, time.perf_counter() - start)
+        return result
+
+    def _won(self, stage, attempt):
+        # outcome is whether the hedge finished before the first attempt
+        if attempt > 0:
+            with self._lock:
+                self.hedge_wins += 1
+        metrics.inc('llm_hedges_total', stage=stage, outcome='won' if attempt > 0 else 'lost')
+
+    def _deadline_exceeded(self, stage, deadline):
+        metrics.inc('llm_deadline_exceeded_total', stage=stage)
+        raise DeadlineExceeded(f"{stage}: no response within {deadline}s")
+
+    def call(self, stage, func):
+        """Call func() (one attempt of a request) with hedging and the deadline of the stage.
+            The attempts run in worker threads, and a thread cannot be cancelled: the losing attempt 
+            (or the attempts given up at the deadline) keeps running in the background until the request returns
+            or times out (setting.REQUEST_TIMEOUT_SECS), holding its rate limiter slot and using its tokens until then.
+            The async mode (acall()) cancels them instead.
+
+        Returns:
+            the result of the first attempt that succeeds
+        """
+        deadline = self.get_deadline(stage)
+        if not self.enabled and deadline is None:
+            return self._timed(stage, func)
+        self._start_request()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=2 * setting.RATE_LIMIT_MAX_CONCURRENCY, thread_name_prefix='hedge')
+        start = time.monotonic()
+        hedge_at = start + self.get_delay(stage) if self.enabled else None
+        end = start + deadline if deadline is not None else None
+        attempts = [self._executor.submit(contextvars.copy_context().run, self._timed, stage, func)]
+        pending = set(attempts)
+        error = None
+        while True:
+            timeout = min((t for t in (hedge_at, end) if t is not None), default=None)
+            done, pending = wait(pending, timeout=None if timeout is None else max(timeout - time.monotonic(), 0),
+                                 return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if len(attempts) > 1:
+                        self._won(stage, attempts.index(future))
+                    return future.result()
+                error = error or future.exception()
+            now = time.monotonic()
+            if hedge_at is not None and now >= hedge_at:
+                hedge_at = None
+                if self.take_budget():
+                    logger.debug(f"{stage}: hedge sent after {now - start:.1f}s")
+                    attempts.append(self._executor.submit(contextvars.copy_context().run, self._timed, stage, func))
+                    pending.add(attempts[-1])
+            if not pending:
+                raise error
+            if end is not None and now >= end:
+                self._deadline_exceeded(stage, deadline)
+
+    async def acall(self, stage, func):
+        """Async version of call(), func is a coroutine function and the losing attempt is cancelled
+        """
+        deadline = self.get_deadline(stage)
+        if not self.enabled and deadline is None:
+            return await self._atimed(stage, func)
+        self._start_request()
+        start = time.monotonic()
+        hedge_at = start + self.get_delay(stage) if self.enabled else None
+        end = start + deadline if deadline is not None else None
+        attempts = [asyncio.ensure_future(self._atimed(stage, func))]
+        pending = set(attempts)
+        error = None
+        try:
+            while True:
+                timeout = min((t for t in (hedge_at, end) if t is not None), default=None)
+                done, pending = await asyncio.wait(pending, timeout=None if timeout is None else max(timeout - time.monotonic(), 0),
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if len(attempts) > 1:
+                            self._won(stage, attempts.index(task))
+                        return task.result()
+                    error = error or task.exception()
+                now = time.monotonic()
+                if hedge_at is not None and now >= hedge_at:
+                    hedge_at = None
+                    if self.take_budget():
+                        logger.debug(f"{stage}: hedge sent after {now - start:.1f}s")
+                        attempts.append(asyncio.ensure_future(self._atimed(stage, func)))
+                        pending.add(attempts[-1])
+                if not pending:
+                    raise error
+                if end is not None and now >= end:
+                    self._deadline_exceeded(stage, deadline)
+        finally:
+            for task in attempts:
+                if not task.done():
+                    task.cancel()
+
+    def stats(self):
+        return {"requests": self.requests, "hedges": self.hedges, "hedge_wins": self.hedge_wins,
+                "hedge_ratio": self.hedges / self.requests if self.requests else 0.0}
+
+
+# Shared by all bots in the process
+hedge_policy = HedgePolicy()
+
+
+###################
+# Test
+###################
+def test_hedge():
+    import random
+    rng = random.Random(0)
+    policy = HedgePolicy(enabled=True, min_delay=0.01, max_delay=0.05, min_samples=5, budget_ratio=0.5, budget_burst=2,
+                         deadlines={"slow": 0.1})
+
+    async def request():
+        await asyncio.sleep(0.5 if rng.random() < 0.2 else 0.005)
+        return "ok"
+
+    async def run():
+        results = [await policy.acall("task", request) for _ in range(30)]
+        try:
+            await policy.acall("slow", lambda: asyncio.sleep(1))
+        except DeadlineExceeded as e:
+            print(e)
+        return results
+
+    start = time.time()
+    assert asyncio.run(run()) == ["ok"] * 30
+    print(policy.stats(), f"{time.time() - start:.2f}s")
+    assert policy.hedges > 0 and policy.hedges <= 2 + 0.5 * policy.requests
+
+    start = time.time()
+    assert policy.call("task", lambda: time.sleep(0.5 if rng.random() < 0.5 else 0.005) or "ok") == "ok"
+    print(policy.stats(), f"{time.time() - start:.2f}s")
+
+
+if __name__ == '__main__':
+    test_hedge()
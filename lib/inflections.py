@@ -1,6 +1,4 @@
 from collections import defaultdict
-from lemminflect import getAllInflections
-from unimorph import inflect_word
 
 import logging
 logger = logging.getLogger(__name__)
@@ -100,6 +98,7 @@ def get_correct_inflections(tag_to_words: dict):
 
 
 def get_inflections_lemm(word):
+    from lemminflect import getAllInflections
     res = getAllInflections(word)
     if not res:
         logger.warning(f"No inflections found for word: <{word}>")
@@ -109,6 +108,7 @@ def get_inflections_lemm(word):
 
 
 def get_inflections_unimorph(word):
+    from unimorph import inflect_word
     res = inflect_word(word, lang="eng")
     tag_to_words = defaultdict(set)
     for line in res.split("\n"):
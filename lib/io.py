@@ -1,9 +1,14 @@
+import csv
 from enum import Enum
+import json
 import os
-import pandas as pd
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    import pandas as pd
 
 
-def read_data(path) -> pd.DataFrame:
+def read_data(path) -> 'pd.DataFrame':
+    import pandas as pd
     df = None
     _type = parse_file_type(path)
     if _type == FileType.CSV:
@@ -13,7 +18,14 @@ def read_data(path) -> pd.DataFrame:
     return df
 
 
-def write_data(df: pd.DataFrame, filename: str):
+def write_rows(rows: list, columns: list, filename: str):
+    """Write the rows as a table with the columns
+    """
+    import pandas as pd
+    write_data(pd.DataFrame(rows, columns=columns), filename)
+
+
+def write_data(df: 'pd.DataFrame', filename: str):
     path = os.path.dirname(filename)
     os.makedirs(path, exist_ok=True)
     _type = parse_file_type(filename)
@@ -23,13 +35,148 @@ def write_data(df: pd.DataFrame, filename: str):
         df.to_excel(filename, index=None)
 
 
+class StreamWriter:
+    """Append rows to a line-oriented file (JSONL or CSV) as soon as they are produced,
+        so the cost of each write does not grow with the length of the run.
+        
+        Rows are lists of values in the order of the columns, which are fixed at construction.
+    """
+    def __init__(self, filename: str, columns: list, expand_prompts=False) -> None:
+        """
+        Args:
+            expand_prompts (bool, optional): write the prompt references of a run log (see lib.run_log) 
+                as the full prompt texts. Defaults to False.
+        """
+        path = os.path.dirname(filename)
+        if path:
+            os.makedirs(path, exist_ok=True)
+        self.filename = filename
+        self.columns = columns
+        self.expand_prompts = expand_prompts
+        self._type = parse_file_type(filename)
+        if self._type not in (FileType.JSONL, FileType.CSV):
+            raise ValueError(f"Unsupported stream file type: {filename}")
+        is_new = not os.path.exists(filename) or os.path.getsize(filename) == 0
+        self._file = open(filename, 'a', encoding='utf-8', newline='')
+        if self._type == FileType.CSV:
+            self._csv = csv.writer(self._file)
+            if is_new:
+                self._csv.writerow(columns)
+
+    def write(self, row: list):
+        """Append a row, the values are in the order of the columns
+        """
+        if self.expand_prompts:
+            from lib.run_log import expand_prompt_refs
+            row = expand_prompt_refs(row)
+        if self._type == FileType.JSONL:
+            obj = dict(zip(self.columns, row))
+            self._file.write(json.dumps(obj, ensure_ascii=False, default=str) + "\n")
+        else:
+            self._csv.writerow(row)
+        self._file.flush()
+
+    def write_rows(self, rows: list):
+        for row in rows:
+            self.write(row)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def open_stream_writer(filename: str, columns: list):
+    """A writer of the log rows: RunLog for a compact run log (.jsonl.gz), 
+        StreamWriter with the full prompts otherwise
+    """
+    if filename.endswith('.jsonl.gz'):
+        from lib.run_log import RunLog
+        return RunLog(filename, columns=columns)
+    return StreamWriter(filename, columns=columns, expand_prompts=True)
+
+
+def get_stream_stem(filename: str):
+    """The file name without the stream extension, e.g. to name the Excel export
+    """
+    for ext in ('.jsonl.gz', '.jsonl', '.csv'):
+        if filename.endswith(ext):
+            return filename[:-len(ext)]
+    return os.path.splitext(filename)[0]
+
+
+def read_stream(filename: str):
+    """Read the rows written by StreamWriter or RunLog, or the rows of an Excel file in constant memory (read-only workbook)
+
+    Returns:
+        (list, generator): the columns, and the rows as lists
+    """
+    if filename.endswith('.jsonl.gz'):
+        from lib.run_log import read_run_log
+        return read_run_log(filename)
+    _type = parse_file_type(filename)
+    if _type == FileType.EXCEL:
+        from openpyxl import load_workbook
+        wb = load_workbook(filename, read_only=True)
+        it = wb.active.iter_rows(values_only=True)
+        columns = list(next(it, []))
+        def rows():
+            try:
+                for row in it:
+                    yield list(row)
+            finally:
+                wb.close()
+        return columns, rows()
+    
+    f = open(filename, 'r', encoding='utf-8', newline='')
+    if _type == FileType.CSV:
+        reader = csv.reader(f)
+        columns = next(reader, [])
+        def rows():
+            with f:
+                yield from reader
+        return columns, rows()
+    
+    first = f.readline()
+    columns = list(json.loads(first).keys()) if first.strip() else []
+    def rows():
+        with f:
+            for line in [first, *f]:
+                if line.strip():
+                    obj = json.loads(line)
+                    yield [obj.get(c) for c in columns]
+    return columns, rows()
+
+
+def export_excel(stream_filename: str, excel_filename: str):
+    """Convert a stream file into an Excel file with a constant-memory (write-only) workbook
+    """
+    from openpyxl import Workbook
+    path = os.path.dirname(excel_filename)
+    if path:
+        os.makedirs(path, exist_ok=True)
+    columns, rows = read_stream(stream_filename)
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append(columns)
+    for row in rows:
+        ws.append([v if v is None or isinstance(v, (str, int, float, bool)) else str(v) for v in row])
+    wb.save(excel_filename)
+
+
 class FileType(Enum):
     CSV = 'csv'
     EXCEL = 'excel'
+    JSONL = 'jsonl'
     
 type_ext_map = {
     FileType.CSV: ['csv'],
     FileType.EXCEL: ['xls', 'xlsx'],
+    FileType.JSONL: ['jsonl'],
 }
 
 def parse_file_type(path):
@@ -55,6 +202,18 @@ def test_io():
     write_data(df, out_path)
 
 
+def test_stream():
+    path = 'data/output/test.jsonl'
+    if os.path.exists(path):
+        os.remove(path)
+    with StreamWriter(path, columns=['a', 'b']) as writer:
+        writer.write([1, 'x'])
+        writer.write_rows([[2, ['y', 'z']], [3, None]])
+    columns, rows = read_stream(path)
+    print(columns, list(rows))
+    export_excel(path, 'data/output/test-stream.xlsx')
+
+
 if __name__ == '__main__':
     test_io()
     
\ No newline at end of file
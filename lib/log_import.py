@@ -0,0 +1,145 @@
+import json
+import re
+from lib.io import read_stream
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# The number of responses put in the cache in one transaction
+IMPORT_CHUNK_SIZE = 1000
+
+# Both the current prompt layout (instructions + prompt) and the single prompt of the older runs
+SENT_GEN_WORD_PATTERNS = [
+    re.compile(r'^The word is "(.+?)" tagged as "(.+?)"\.$', re.MULTILINE),
+    re.compile(r'The sentence should contain the word "(.+?)" tagged as "(.+?)"\.'),
+]
+SENT_GEN_LEVEL_PATTERN = re.compile(r'range from (.+?) to (.+?) based on CEFR')
+SENT_GEN_DOMAIN_PATTERN = re.compile(r'in the domain of English for (.+?) purposes')
+RATIONAL_PATTERNS = [
+    re.compile(r'^Question stem: "(.*)"\nPossible distractors: "(.*)"$', re.MULTILINE),
+    re.compile(r'^In this multiple choice cloze question stem: "(.*)" *\nA list of possible distractors include "(.*)"\. *$', re.MULTILINE),
+]
+
+
+def parse_sent_gen_prompt(prompt):
+    """Recover the inputs of SentGenParser from a logged prompt
+
+    Returns:
+        dict: the inputs, None if the prompt is not a sentence generation prompt
+    """
+    m = next(filter(None, (pattern.search(prompt) for pattern in SENT_GEN_WORD_PATTERNS)), None)
+    level = SENT_GEN_LEVEL_PATTERN.search(prompt)
+    domain = SENT_GEN_DOMAIN_PATTERN.search(prompt)
+    if not (m and level and domain):
+        return None
+    return {"word": m.group(1), "tag": m.group(2), "domain": domain.group(1),
+            "level_start": level.group(1), "level_end": level.group(2)}
+
+
+def parse_rational_prompt(prompt):
+    """Recover the inputs of RationalParser from a logged prompt
+
+    Returns:
+        dict: the inputs, None if the prompt is not a rationality test prompt
+    """
+    m = next(filter(None, (pattern.search(prompt) for pattern in RATIONAL_PATTERNS)), None)
+    if not m:
+        return None
+    return {"candidates": [w for w in m.group(2).split(", ") if w], "sentence": m.group(1)}
+
+
+# The parsers of the logged prompts, by the task_name of SentGenParser and RationalParser
+PROMPT_PARSERS = {
+    "Sentence Generation": parse_sent_gen_prompt,
+    "Rationality Test": parse_rational_prompt,
+}
+
+
+def render_logged_prompt(parser, prompt):
+    """Recover the inputs of a logged prompt of the parser's task and compose them in the current prompt layout
+
+    Returns:
+        (dict, list): the inputs and the chat messages, (None, None) if the inputs are not found in the prompt
+    """
+    parse_prompt = PROMPT_PARSERS.get(parser.task_name)
+    inputs = parse_prompt(prompt) if parse_prompt else None
+    if inputs is None:
+        return None, None
+    return inputs, parser.compose_messages(inputs=inputs)
+
+
+def is_true(value):
+    return value is True or str(value).lower() in ('true', '1')
+
+
+def import_log(path, bot_sent_gen, bot_rational, variants=None):
+    """Put the valid responses in the log of a run (.xlsx/.jsonl/.csv) into the response cache of the bots.
+        The inputs are recovered from the logged prompts and rendered with the current parsers,
+        so the responses are found by the requests of the current prompt layout.
+        The responses are validated by the current parsers, and only the successful ones are imported.
+
+    Args:
+        variants (dict, optional): inputs of sentence generation -> the number of responses imported,
+            shared by the files so that the responses of a word are cached as its successive trials
+
+    Returns:
+        dict: the number of responses imported for each task, and the skipped ones
+    """
+    variants = {} if variants is None else variants
+    cache = bot_rational.cache
+    columns, rows = read_stream(path)
+    i_task, i_prompt, i_response, i_success = (columns.index(c) for c in ('Task', 'Prompt', 'Raw Response', 'Success'))
+    bots = {bot.task_name: bot for bot in (bot_sent_gen, bot_rational)}
+    counts = {bot_sent_gen.task_name: 0, bot_rational.task_name: 0, "skipped": 0}
+    items = []
+    for row in rows:
+        task, prompt, response = row[i_task], row[i_prompt], row[i_response]
+        if not is_true(row[i_success]) or not isinstance(prompt, str) or not isinstance(response, str):
+            continue
+        bot = bots.get(task)
+        if bot is None:
+            continue
+
+        inputs, messages = render_logged_prompt(bot.parser, prompt)
+        if inputs is None:
+            counts["skipped"] += 1
+            continue
+        if not bot.parser.parse_response(prompt=bot.parser.format_messages(messages), response=response).get('success'):
+            counts["skipped"] += 1
+            continue
+
+        variant = 0
+        if bot is bot_sent_gen:
+            # The sentence generation is not deterministic, each response is cached as the next trial of the word
+            k = json.dumps(inputs, sort_keys=True)
+            variant = variants.get(k, 0)
+            variants[k] = variant + 1
+        items.append((bot.get_cache_key(messages, variant=variant), response))
+        counts[task] += 1
+        if len(items) >= IMPORT_CHUNK_SIZE:
+            cache.put_many(items)
+            items = []
+    cache.put_many(items)
+    return counts
+
+
+###################
+# Test
+###################
+def test_parse_prompt():
+    from lib.parser import SentGenParser, RationalParser
+    inputs = {"word": "analyse", "tag": "VB", "domain": "General Academic", "level_start": "B1", "level_end": "lower B2"}
+    parser = SentGenParser()
+    assert parse_sent_gen_prompt(parser.format_messages(parser.compose_messages(inputs))) == inputs
+
+    inputs = {"candidates": ["assess", "define"], "sentence": "We ____ the \"raw\" data."}
+    parser = RationalParser()
+    assert parse_rational_prompt(parser.format_messages(parser.compose_messages(inputs))) == inputs
+    old_prompt = ('You are an English teacher ... \nIn this multiple choice cloze question stem: "We ____ the data." \n'
+                  'A list of possible distractors include "define, assess". \nPlease provide feedback ...')
+    print(parse_rational_prompt(old_prompt))
+
+
+if __name__ == '__main__':
+    test_parse_prompt()
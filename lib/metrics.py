@@ -0,0 +1,313 @@
+import asyncio
+import bisect
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+import setting
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Histogram:
+    """Counts of the observed values in fixed buckets (upper bounds), as a Prometheus histogram
+    """
+    def __init__(self, buckets=setting.METRICS_LATENCY_BUCKETS) -> None:
+        self.buckets = list(buckets)
+        # The last count is for the values above the largest bucket (+Inf)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Estimate the q-quantile by linear interpolation in its bucket
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / n, self.max)
+            seen += n
+        return self.max
+
+    def merge(self, other: 'Histogram'):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+        self.max = max(self.max, other.max)
+
+    def to_dict(self):
+        return {"buckets": self.buckets, "counts": self.counts, "sum": self.sum, "count": self.count, "max": self.max}
+
+    @classmethod
+    def from_dict(cls, d):
+        h = cls(buckets=d['buckets'])
+        h.counts, h.sum, h.count, h.max = list(d['counts']), d['sum'], d['count'], d['max']
+        return h
+
+
+class Metrics:
+    """Counters and latency histograms of a run, labelled by stage (task name, "POS Check", ...) and tag.
+
+        - stage_seconds: the latency of each call of a stage
+        - llm_request_seconds: the latency of the requests sent to the backend (cache misses)
+        - stage_results_total{outcome="accepted"|"rejected"}: the results of a stage per tag
+        - llm_tokens_total{type="prompt"|"cached"|"completion"}, llm_cost_usd_total,
+            llm_retries_total, llm_errors_total, llm_cache_hits_total, llm_hedges_total, llm_deadline_exceeded_total: the LLM requests per stage
+        - circuit_breaker_open_total: the stage whose failure stopped the run
+
+        The summary() is written as JSON and to_prometheus() as a text file for node_exporter's textfile collector.
+    """
+    prefix = 'cloze_'
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+            self.started = time.time()
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, stage, **labels):
+        """Observe the time spent in the block as stage_seconds of the stage
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('stage_seconds', time.perf_counter() - start, stage=stage, **labels)
+
+    def count_result(self, stage, accepted, tag=None):
+        self.inc('stage_results_total', stage=stage, tag=tag or '-', outcome='accepted' if accepted else 'rejected')
+
+    def record_usage(self, stage, model, prompt_tokens, cached_tokens, completion_tokens):
+        self.inc('llm_tokens_total', prompt_tokens, stage=stage, type='prompt')
+        self.inc('llm_tokens_total', cached_tokens, stage=stage, type='cached')
+        self.inc('llm_tokens_total', completion_tokens, stage=stage, type='completion')
+        self.inc('llm_cost_usd_total', estimate_cost(model, prompt_tokens, cached_tokens, completion_tokens), stage=stage)
+
+    def summary(self):
+        """
+        Returns:
+            dict: {"elapsed_seconds", "cost_usd", "stages": {stage: {...}}, "raw": {...}},
+                "raw" is kept to merge the summaries of several processes with merge()
+        """
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = {key: h for key, h in self.histograms.items()}
+        stages = {}
+        def get_stage(labels):
+            return stages.setdefault(labels.get('stage', '-'), {})
+        for (name, labels), h in histograms.items():
+            labels = dict(labels)
+            if name in ('stage_seconds', 'llm_request_seconds'):
+                get_stage(labels)['seconds' if name == 'stage_seconds' else 'request_seconds'] = {"count": h.count, "sum": round(h.sum, 6), "p50": round(h.quantile(0.5), 6),
+                                                "p95": round(h.quantile(0.95), 6), "max": round(h.max, 6)}
+        for (name, labels), value in counters.items():
+            labels = dict(labels)
+            stage = get_stage(labels)
+            if name == 'stage_results_total':
+                stage[labels['outcome']] = stage.get(labels['outcome'], 0) + value
+                by_tag = stage.setdefault('by_tag', {}).setdefault(labels['tag'], {})
+                by_tag[labels['outcome']] = by_tag.get(labels['outcome'], 0) + value
+            elif name == 'llm_tokens_total':
+                stage[f"{labels['type']}_tokens"] = stage.get(f"{labels['type']}_tokens", 0) + value
+            elif name == 'llm_cost_usd_total':
+                stage['cost_usd'] = stage.get('cost_usd', 0) + value
+            elif name == 'llm_retries_total':
+                stage['retries'] = stage.get('retries', 0) + value
+                by_error = stage.setdefault('retries_by_error', {})
+                by_error[labels['error']] = by_error.get(labels['error'], 0) + value
+            elif name == 'llm_errors_total':
+                stage.setdefault('errors', {})[labels['error']] = stage.get('errors', {}).get(labels['error'], 0) + value
+            elif name == 'circuit_breaker_open_total':
+                stage['circuit_breaker_open'] = stage.get('circuit_breaker_open', 0) + value
+            elif name == 'llm_cache_hits_total':
+                stage['cache_hits'] = stage.get('cache_hits', 0) + value
+            elif name == 'llm_hedges_total':
+                stage['hedges'] = stage.get('hedges', 0) + value
+                if labels['outcome'] == 'won':
+                    stage['hedge_wins'] = stage.get('hedge_wins', 0) + value
+            elif name == 'llm_deadline_exceeded_total':
+                stage['deadline_exceeded'] = stage.get('deadline_exceeded', 0) + value
+        for stage in stages.values():
+            if 'cost_usd' in stage:
+                stage['cost_usd'] = round(stage['cost_usd'], 6)
+            n = stage.get('accepted', 0) + stage.get('rejected', 0)
+            if n:
+                stage['accept_rate'] = round(stage.get('accepted', 0) / n, 4)
+        return {
+            "elapsed_seconds": round(time.time() - self.started, 3),
+            "cost_usd": round(sum(value for (name, _), value in counters.items() if name == 'llm_cost_usd_total'), 6),
+            "stages": stages,
+            "raw": {
+                "counters": [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in counters.items()],
+                "histograms": [{"name": name, "labels": dict(labels), **h.to_dict()} for (name, labels), h in histograms.items()],
+            },
+        }
+
+    def merge(self, summary):
+        """Add the raw metrics in the summary of another process
+        """
+        for c in summary['raw']['counters']:
+            self.inc(c['name'], c['value'], **c['labels'])
+        for d in summary['raw']['histograms']:
+            key = self._key(d['name'], d['labels'])
+            with self._lock:
+                if key in self.histograms:
+                    self.histograms[key].merge(Histogram.from_dict(d))
+                else:
+                    self.histograms[key] = Histogram.from_dict(d)
+
+    def to_prometheus(self):
+        """
+        Returns:
+            str: the metrics in the Prometheus text exposition format
+        """
+        def format_labels(labels, extra=()):
+            items = [*labels, *extra]
+            if not items:
+                return ""
+            return "{" + ",".join(f'{k}="{escape_label(v)}"' for k, v in items) + "}"
+
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(), key=lambda item: item[0])
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE {self.prefix}{name} counter")
+                typed.add(name)
+            lines.append(f"{self.prefix}{name}{format_labels(labels)} {value}")
+        for (name, labels), h in histograms:
+            if name not in typed:
+                lines.append(f"# TYPE {self.prefix}{name} histogram")
+                typed.add(name)
+            cumulative = 0
+            for bound, n in zip([*h.buckets, '+Inf'], h.counts):
+                cumulative += n
+                lines.append(f"{self.prefix}{name}_bucket{format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.prefix}{name}_sum{format_labels(labels)} {h.sum}")
+            lines.append(f"{self.prefix}{name}_count{format_labels(labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, run_id, path=setting.METRICS_DIR, **extra):
+        """Write <run_id>-metrics.json and <run_id>-metrics.prom
+
+        Returns:
+            dict: the summary
+        """
+        os.makedirs(path, exist_ok=True)
+        summary = {"run_id": run_id, **extra, **self.summary()}
+        with open(os.path.join(path, f'{run_id}-metrics.json'), 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        with open(os.path.join(path, f'{run_id}-metrics.prom'), 'w', encoding='utf-8') as f:
+            f.write(self.to_prometheus())
+        return summary
+
+
+def estimate_cost(model, prompt_tokens, cached_tokens, completion_tokens):
+    """Estimate the price of the tokens with setting.MODEL_PRICES, 0 for unknown models
+
+    Returns:
+        float: USD
+    """
+    prices = setting.MODEL_PRICES.get(model)
+    if not prices:
+        return 0.0
+    input_price, cached_price, output_price = prices
+    return ((prompt_tokens - cached_tokens) * input_price + cached_tokens * cached_price + completion_tokens * output_price) / 1_000_000
+
+
+def timed(stage):
+    """Decorator to observe the latency of each call of a function (sync or async) as stage_seconds of the stage
+    """
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with metrics.timer(stage):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+        
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with metrics.timer(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def get_tag(inputs):
+    """The POS tag of the word in the inputs of a parser, '-' for the batched requests of several words
+    """
+    if not isinstance(inputs, dict):
+        return '-'
+    return inputs.get('tag') or getattr(inputs.get('keyword'), 'tag', None) or '-'
+
+
+# Shared by all the bots and stages in the process
+metrics = Metrics()
+
+
+###################
+# Test
+###################
+def test_metrics():
+    m = Metrics()
+    for latency in (0.1, 0.2, 0.3, 2.5):
+        m.observe('stage_seconds', latency, stage="Sentence Generation")
+    m.count_result("POS Check", True, tag="NN")
+    m.count_result("POS Check", False, tag="VB")
+    m.record_usage("Sentence Generation", 'gpt-4o-mini', 1000, 400, 100)
+    summary = m.summary()
+    print(json.dumps({k: v for k, v in summary.items() if k != 'raw'}, indent=2))
+    print(m.to_prometheus())
+    assert summary['stages']["POS Check"]['accept_rate'] == 0.5
+
+    merged = Metrics()
+    merged.merge(summary)
+    merged.merge(summary)
+    assert merged.summary()['stages']["Sentence Generation"]['seconds']['count'] == 8
+
+
+if __name__ == '__main__':
+    test_metrics()
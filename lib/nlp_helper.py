@@ -1,16 +1,150 @@
-import spacy
+import asyncio
+import re
+import threading
+from lib.metrics import metrics
+from lib.tracing import span
+import setting
+
+_nlp = None
+_nlp_parser = None
+# spaCy pipelines are not guaranteed to be thread-safe
+_nlp_lock = threading.RLock()
+
+
+def get_nlp():
+    """The spaCy pipeline, loaded on first use
+    """
+    global _nlp
+    with _nlp_lock:
+        if _nlp is None:
+            import spacy
+            # python -m spacy download en_core_web_sm  # <-- run first time
+            # Only the tagger is needed for token.tag_, skip the parser, NER and lemmatizer
+            _nlp = spacy.load("en_core_web_sm", exclude=["parser", "ner", "lemmatizer"])
+        return _nlp
+
+
+def get_nlp_parser():
+    """The spaCy pipeline with the dependency parser, loaded on first use
+    """
+    global _nlp_parser
+    with _nlp_lock:
+        if _nlp_parser is None:
+            import spacy
+            _nlp_parser = spacy.load("en_core_web_sm", exclude=["ner", "lemmatizer"])
+        return _nlp_parser
 
-# python -m spacy download en_core_web_sm  # <-- run first time
-nlp = spacy.load("en_core_web_sm")
 
 def pos_check(inputs):
-    word = inputs['word']
-    tag = inputs['tag']
-    sentence = inputs['sentence']
-    
-    doc = nlp(sentence)
+    return pos_check_batch([inputs])[0]
+
+
+def pos_check_batch(inputs_list, batch_size=setting.POS_CHECK_BATCH_SIZE, n_process=setting.POS_CHECK_N_PROCESS):
+    """Check the POS tag of the words in many sentences in one pass
+
+    Args:
+        inputs_list (list): [{"word": "account", "tag": "NN", "sentence": "I have an account with the bank."}, ...]
+        batch_size (int, optional): the number of sentences tagged together
+        n_process (int, optional): the number of worker processes, 
+            only worth it for thousands of sentences since the workers are started for each call
+
+    Returns:
+        list: whether each word is tagged as the given tag in its sentence
+    """
+    sentences = [inputs['sentence'] for inputs in inputs_list]
+    with metrics.timer("POS Check"), span("POS Check", sentences=len(sentences)):
+        with _nlp_lock:
+            docs = list(get_nlp().pipe(sentences, batch_size=batch_size, n_process=n_process))
+        results = [has_tagged_word(doc, inputs['word'], inputs['tag']) for doc, inputs in zip(docs, inputs_list)]
+    for inputs, suc in zip(inputs_list, results):
+        metrics.count_result("POS Check", suc, tag=inputs['tag'])
+    return results
+
+
+async def apos_check(inputs):
+    return (await apos_check_batch([inputs]))[0]
+
+
+async def apos_check_batch(inputs_list, **kwargs):
+    """Async version of pos_check_batch(), tagging runs in a worker thread off the event loop
+    """
+    return await asyncio.to_thread(pos_check_batch, inputs_list, **kwargs)
+
+
+def has_tagged_word(doc, word, tag):
     for token in doc:
         if token.text == word and token.tag_ == tag:
             return True
-        
     return False
+
+
+BLANK = '_' * 4
+ARTICLE_BLANK_PAT = re.compile(r"\ba/an " + BLANK)
+
+
+def fill_blank(clozed_sentence, word):
+    """Fill the blank with the word, choosing "a" or "an" for it if the blank follows "a/an"
+
+    Returns:
+        (str, int): the sentence, and the character offset of the word in it
+    """
+    article = "an" if word[:1].lower() in "aeiou" else "a"
+    sentence = ARTICLE_BLANK_PAT.sub(f"{article} {BLANK}", clozed_sentence, count=1)
+    start = sentence.find(BLANK)
+    return sentence.replace(BLANK, word), start
+
+
+def get_word_token(doc, start, word):
+    span = doc.char_span(start, start + len(word), alignment_mode='expand')
+    return span.root if span is not None else None
+
+
+def get_head_text(token):
+    """The head of the token, None if the token is the root
+    """
+    return None if token.head.i == token.i else token.head.text.lower()
+
+
+def syntax_filter(keyword, clozed_sentence, candidates, batch_size=setting.POS_CHECK_BATCH_SIZE):
+    """Drop the distractor candidates that obviously break the sentence when filled into the blank.
+    
+        The sentence filled with the keyword is parsed as the reference. A candidate is kept if, 
+        in the sentence filled with it, it gets the same tag as the keyword, and the same dependency
+        relation to the same head. All the sentences are parsed in one batch.
+
+    Args:
+        keyword (MyWord): the correct answer
+        clozed_sentence (str): the sentence with the blank
+        candidates (list): MyWord candidates
+
+    Returns:
+        (list, list): the kept candidates, and the dropped ones
+    """
+    if not candidates:
+        return [], []
+    with metrics.timer("Syntax Filter"), span("Syntax Filter", candidates=len(candidates)):
+        kept, dropped = _syntax_filter(keyword, clozed_sentence, candidates, batch_size=batch_size)
+    for w in candidates:
+        metrics.count_result("Syntax Filter", w in kept, tag=keyword.tag)
+    return kept, dropped
+
+
+def _syntax_filter(keyword, clozed_sentence, candidates, batch_size):
+    filled = [fill_blank(clozed_sentence, w.surface) for w in [keyword, *candidates]]
+    with _nlp_lock:
+        docs = list(get_nlp_parser().pipe([sentence for sentence, _ in filled], batch_size=batch_size))
+    
+    ref = get_word_token(docs[0], filled[0][1], keyword.surface)
+    if ref is None or ref.tag_ != keyword.tag:
+        # the reference parse is not reliable, do not judge the candidates with it
+        return list(candidates), []
+    
+    kept, dropped = [], []
+    for w, doc, (_, start) in zip(candidates, docs[1:], filled[1:]):
+        token = get_word_token(doc, start, w.surface)
+        if token is not None and token.tag_ == ref.tag_ and token.dep_ == ref.dep_ \
+                and get_head_text(token) == get_head_text(ref):
+            kept.append(w)
+        else:
+            dropped.append(w)
+    return kept, dropped
@@ -1,5 +1,6 @@
 import json
 import re
+from lib.run_log import register_template
 from lib.utils import cloze_sentence, replace_article
 
 import logging
@@ -20,6 +21,7 @@ class ParserBase():
     
     def __init__(self):
         self.inputs = None
+        self.template_id = None
     
     def compose_prompt(self, inputs):
         """Compose the prompt for ChatGPT from inputs
@@ -33,6 +35,34 @@ class ParserBase():
         self.inputs = inputs
         return ""
     
+    def compose_instructions(self, inputs):
+        """Compose the instructions that are the same for all the calls of the task in a run 
+            (persona, criteria, examples), sent before the prompt so that the provider can reuse the cached prefix
+
+        Returns:
+            str: instructions for ChatGPT, empty if everything is in the prompt
+        """
+        return ""
+    
+    def compose_messages(self, inputs):
+        """Compose the chat messages: the instructions as the system message, and the prompt as the user message
+
+        Returns:
+            list: [{"role": "system", "content": ...}, {"role": "user", "content": ...}]
+        """
+        prompt = self.compose_prompt(inputs=inputs)
+        instructions = self.compose_instructions(inputs=inputs)
+        # The run log keeps the template id and the inputs instead of the full text
+        self.template_id = register_template(type(self).__name__, instructions)
+        messages = [{"role": "system", "content": instructions}] if instructions else []
+        return messages + [{"role": "user", "content": prompt}]
+    
+    @staticmethod
+    def format_messages(messages):
+        """Join the chat messages into one text, used in the log and the cache key
+        """
+        return "\n\n".join(m['content'] for m in messages)
+    
     def parse_response(self, prompt, response):
         """Parse the response from ChatGPT into desired format
 
@@ -41,17 +71,38 @@ class ParserBase():
             response (str): raw response from ChatGPT
 
         Returns:
-            dict: parsed response
+            dict: parsed response, 'prompt_ref' is {"template": id, "params": inputs} for the run log 
+                if the prompt was composed by compose_messages(), the prompt otherwise
         """
         success = not self.response_failed(response=response)
         return {
             'success': success,
             'prompt': prompt,
+            'prompt_ref': {"template": self.template_id, "params": self.inputs} if self.template_id else prompt,
             'raw_response': response,
             self.result_key: response,
             **self.inputs,
         }
-                
+
+    def failed_response(self, prompt, error_class, error, response=None):
+        """The result of a request that got no response, or of a response that broke parse_response()
+            (see lib.retry), in the format of parse_response()
+
+        Args:
+            error_class (str): the class of the error, e.g. 'server' or 'parse'
+            error (Exception): the error
+            response (str, optional): the raw response if any. Defaults to None (the error is logged instead).
+        """
+        return {
+            'success': False,
+            'prompt': prompt,
+            'prompt_ref': {"template": self.template_id, "params": self.inputs} if self.template_id else prompt,
+            'raw_response': response if response is not None else f"{error_class}: {error!r}",
+            'error': error_class,
+            self.result_key: None,
+            **self.inputs,
+        }
+
     def response_failed(self, response):
         error_list = [
             "Failed to read response from ChatGPT",
@@ -79,9 +130,6 @@ class ParserBase():
             text = text[:-1]
         return text
 
-    def get_sample_response(self, prompt):
-        return ""
-
 
 class ParaphraseParser(ParserBase):
     
@@ -99,12 +147,6 @@ class ParaphraseParser(ParserBase):
             'paraphrase': response,
             **res,
         }
-    
-    def get_sample_response(self, prompt):
-        return {
-            'original': "I like to eat apples.",
-            'paraphrase': "I enjoy eating apples.",
-        }
 
 
 class SemanticParser(ParserBase):
@@ -129,12 +171,6 @@ class SemanticParser(ParserBase):
             'paraphrase': response,
             **res,
         }
-    
-    def get_sample_response(self, prompt):
-        return {
-            'original': "I like to eat apples.",
-            'paraphrase': "I enjoy eating apples.",
-        }
 
 
 class SentGenParser(ParserBase):
@@ -150,62 +186,138 @@ class SentGenParser(ParserBase):
         super().compose_prompt(inputs=inputs)
         word = inputs.get('word')
         tag = inputs.get('tag', 'any')
+        return f'''The word is "{word}" tagged as "{tag}".'''
+    
+    def compose_instructions(self, inputs):
         domain = inputs.get('domain', 'General Academic')
         level_start = inputs.get('level_start', 'B1')
         level_end = inputs.get('level_end', 'lower B2')
         
-        prompt = f'''You are an English teacher at a Japanese university and you are creating question stems for \
+        instructions = f'''You are an English teacher at a Japanese university and you are creating question stems for \
 vocabulary multiple-choice cloze questions for your students whose English proficiency levels range from {level_start} to {level_end} based on CEFR. 
-Now please generate a sentence in the domain of English for {domain} purposes that meets the following criteria:
-The sentence should contain the word "{word}" tagged as "{tag}".
-The word "{word}" should be pivotal to the meaning of the sentence and carries significant weight in the context. 
-The sentence should show a high-frequency use of the word "{word}" tagged as "{tag}". 
+You will be given a word and its POS tag. Please generate a sentence in the domain of English for {domain} purposes that meets the following criteria:
+The sentence should contain the given word tagged as the given tag.
+The word should be pivotal to the meaning of the sentence and carries significant weight in the context. 
+The sentence should show a high-frequency use of the word tagged as the given tag. 
 The context of the sentence can extend beyond educational institutions, encompassing a wider academic environment.
 The length of the sentence should be between 15-20 words.
-Ensure "{word}" is not used at the beginning of the sentence or repeated elsewhere in the sentence.
-Ensure none of the derivatives of "{word}" are present in the sentence.
+Ensure the word is not used at the beginning of the sentence or repeated elsewhere in the sentence.
+Ensure none of the derivatives of the word are present in the sentence.
 Please avoid starting the sentence with the definite article "the" as much as possible.
 
 To give you a clearer idea, consider this example: If the provided word was "account" tagged as "NN", an appropriate sentence would be:
 I have an account with the bank.'''
-        return prompt
+        return instructions
 
     def parse_response(self, prompt, response):
         res = super().parse_response(prompt=prompt, response=response)
         response = self.remove_surrounding_quotes(response)
         word = self.inputs.get('word')
-        pat = re.compile(r'\b' + word + r'\b', re.IGNORECASE)
-        if not pat.search(response):
-            logger.warning(f"Keyword '{word}' not found in response: {response}")
+        result = self.make_cloze(word, response)
+        if result is None:
             return {
                 **res,
                 "success": False,
             }
+        
+        return {
+            **res,
+            "result": result,
+        }
+    
+    @staticmethod
+    def make_cloze(word, sentence):
+        """Validate the generated sentence and replace the keyword with a blank
 
-        if response.startswith(word):
-            logger.warning(f"Keyword '{word}' found at the beginning of the sentence: {response}")
-            return {
-                **res,
-                "success": False,
-            }
+        Returns:
+            str: the clozed sentence, None if the sentence is not valid
+        """
+        pat = re.compile(r'\b' + word + r'\b', re.IGNORECASE)
+        if not pat.search(sentence):
+            logger.warning(f"Keyword '{word}' not found in response: {sentence}")
+            return None
+
+        if sentence.startswith(word):
+            logger.warning(f"Keyword '{word}' found at the beginning of the sentence: {sentence}")
+            return None
         
         # Replace the keyword with a blank
-        result = cloze_sentence(response, word)
+        result = cloze_sentence(sentence, word)
         
         # Replace "a" or "an" with "a/an" before the blank
         result = replace_article(result)
+        return result
+
+
+class BatchSentGenParser(ParserBase):
+    """Generate the sentences of several words in one request
+    
+    inputs={"items": [{"word": "account", "tag": "NN"}, {"word": "analysed", "tag": "VBD"}], "domain": ...}
+    
+    return {"success": True, "result": {"account": "I have an account with the bank.", ...}, 
+            "results": {"account": {"success": True, "result": "I have an ____ with the bank.", "raw_response": "I have an account with the bank."}, ...}}
+    """
+    task_name = "Batch Sentence Generation"
+    response_format = 'json_object'
+    
+    def compose_prompt(self, inputs):
+        super().compose_prompt(inputs=inputs)
+        items = inputs.get('items')
+        word_list = "\n".join(f'- "{item["word"]}" tagged as "{item["tag"]}"' for item in items)
+        return f'''The words are:
+{word_list}'''
+    
+    def compose_instructions(self, inputs):
+        domain = inputs.get('domain', 'General Academic')
+        level_start = inputs.get('level_start', 'B1')
+        level_end = inputs.get('level_end', 'lower B2')
         
+        instructions = f'''You are an English teacher at a Japanese university and you are creating question stems for \
+vocabulary multiple-choice cloze questions for your students whose English proficiency levels range from {level_start} to {level_end} based on CEFR. 
+You will be given a list of words, each with its POS tag. Please generate one sentence in the domain of English for {domain} purposes for each of the words.
+Each sentence should meet the following criteria:
+The sentence should contain its word tagged as given.
+The word should be pivotal to the meaning of the sentence and carries significant weight in the context. 
+The sentence should show a high-frequency use of the word tagged as given. 
+The context of the sentence can extend beyond educational institutions, encompassing a wider academic environment.
+The length of the sentence should be between 15-20 words.
+Ensure the word is not used at the beginning of the sentence or repeated elsewhere in the sentence.
+Ensure none of the derivatives of the word are present in the sentence.
+Please avoid starting the sentence with the definite article "the" as much as possible.
+
+To give you a clearer idea, consider this example: If the provided word was "account" tagged as "NN", an appropriate sentence would be:
+I have an account with the bank.
+
+Return only a JSON object whose keys are the provided words and values are their sentences, e.g.
+{{"account": "I have an account with the bank."}}'''
+        return instructions
+
+    def parse_response(self, prompt, response):
+        res = super().parse_response(prompt=prompt, response=response)
+        try:
+            obj = json.loads(response)
+        except json.decoder.JSONDecodeError as e:
+            return {
+                **res,
+                "success": False,
+                "results": {},
+            }
+        lower_obj = {str(k).lower(): v for k, v in obj.items()}
+        results = {}
+        for item in self.inputs.get('items'):
+            word = item['word']
+            sentence = obj.get(word, lower_obj.get(word.lower()))
+            if not isinstance(sentence, str):
+                logger.warning(f"Keyword '{word}' not found in response: {response}")
+                results[word] = {"success": False, "result": None, "raw_response": sentence}
+                continue
+            sentence = self.remove_surrounding_quotes(sentence)
+            clozed = SentGenParser.make_cloze(word, sentence)
+            results[word] = {"success": clozed is not None, "result": clozed or sentence, "raw_response": sentence}
         return {
             **res,
-            "result": result,
-        }
-    
-    def get_sample_response(self, prompt):
-        return {
-            "success": True, 
-            "result": "I have an ____ with the bank.", 
-            "word": "account", 
-            "tag": "NN",
+            "result": obj,
+            "results": results,
         }
 
 
@@ -261,13 +373,6 @@ Delimit the derivatives with a comma. \
 # ```{word}```"""
 
         return prompt
-    
-    def get_sample_response(self, prompt):
-        return {
-            "success": True,
-            "result": "accounts, accounting, accounted, accountant, accountancy", 
-            "word": "account" 
-        }
 
 
 class RationalParser(ParserBase):
@@ -282,14 +387,16 @@ class RationalParser(ParserBase):
     
     def compose_prompt(self, inputs):
         super().compose_prompt(inputs=inputs)
-        keyword = inputs.get('keyword')
         candidates = inputs.get('candidates')
-        words_with_comma = ", ".join(set(str(w) for w in candidates))
+        # Sorted so that the prompt (and its cache key) does not depend on the order of the candidates
+        words_with_comma = ", ".join(sorted(set(str(w) for w in candidates)))
         sentence = inputs.get('sentence')
-        
-        prompt = f'''You are an English teacher at a Japanese university and you are creating distractors for vocabulary multiple-choice cloze questions for your students. 
-In this multiple choice cloze question stem: "{sentence}" 
-A list of possible distractors include "{words_with_comma}". 
+        return f'''Question stem: "{sentence}"
+Possible distractors: "{words_with_comma}"'''
+    
+    def compose_instructions(self, inputs):
+        instructions = f'''You are an English teacher at a Japanese university and you are creating distractors for vocabulary multiple-choice cloze questions for your students. 
+You will be given a multiple choice cloze question stem and a list of possible distractors. 
 Please provide feedback in terms of syntactic appropriateness and contextual/semantic sense-making of the distractors in the completed sentences. 
 Return only the following result in JSON format to me:
 {{
@@ -302,29 +409,13 @@ To provide you with more instructions on judgement, consider the the question st
   "swim": {{"syntax": true, "semantics": false}},
   "beat": {{"syntax": false, "semantics": false}}
 }}'''
-# Reply with json object only without any notes. 
-# while using correct articles and prepositions, \
-
-        return prompt
+        return instructions
 
     def parse_response(self, prompt, response):
         res = super().parse_response(prompt=prompt, response=response)
         try:
             obj = json.loads(response)
-            others = []
-            good_candidates = []
-            candidates = self.inputs['candidates']
-            for k, v in obj.items():
-                candidate = next(filter(lambda w: str(w) == k, candidates), None)
-                if not candidate:
-                    logger.warning(f"Cannot find candidate '{k}' in response: {candidates}")
-                    continue
-                if v['syntax'] and not v['semantics']:
-                    # the word is a good candidate as a distractor 
-                    #   if it is syntactically correct but semantically wrong
-                    good_candidates.append(candidate)
-                else:
-                    others.append(candidate)
+            good_candidates, others = self.classify(obj, self.inputs['candidates'])
             return {
                 **res,
                 "result": obj,
@@ -338,15 +429,88 @@ To provide you with more instructions on judgement, consider the the question st
             }
         
     
-    def get_sample_response(self, prompt):
-        return {
-            "success": True,
-            "others": ["account"],
-            "good_candidates": ["bank"],
-            "response": {"account": True, "bank": False}, 
-            "words": ["account", "bank"], 
-            "sentence": "I have an ______ with the bank."
-        }
+    @staticmethod
+    def classify(obj, candidates):
+        """Classify the candidates by the judgement in the response
 
+        Args:
+            obj (dict): {"word": {"syntax": bool, "semantics": bool}, ...}
+            candidates (list): the candidates in the prompt
 
+        Returns:
+            (list, list): good candidates (syntactically correct but semantically wrong) and the others
+        """
+        others = []
+        good_candidates = []
+        for k, v in obj.items():
+            candidate = next(filter(lambda w: str(w) == k, candidates), None)
+            if not candidate:
+                logger.warning(f"Cannot find candidate '{k}' in response: {candidates}")
+                continue
+            if v['syntax'] and not v['semantics']:
+                # the word is a good candidate as a distractor 
+                #   if it is syntactically correct but semantically wrong
+                good_candidates.append(candidate)
+            else:
+                others.append(candidate)
+        return good_candidates, others
+
+
+class BatchRationalParser(ParserBase):
+    """Test the rationality of the candidates of several sentences in one request
+    
+    inputs={"items": [{"keyword": "account", "candidates": ["apple", "bank"], "sentence": "I have an ______ with the bank."}, ...]}
+    
+    return {"success": True, "result": {"1": {"apple": {"syntax": true, "semantics": false}, ...}, ...}, 
+            "results": [{"success": True, "result": {...}, "good_candidates": ["apple"], "others": ["bank"]}, ...]}
+    """
+    task_name = "Batch Rationality Test"
+    response_format = 'json_object'
+    
+    def compose_prompt(self, inputs):
+        super().compose_prompt(inputs=inputs)
+        stems = []
+        for i, item in enumerate(inputs.get('items'), start=1):
+            words_with_comma = ", ".join(sorted(set(str(w) for w in item.get('candidates'))))
+            stems.append(f'''{i}. Question stem: "{item.get('sentence')}"
+   Possible distractors: "{words_with_comma}"''')
+        return "\n".join(stems)
+    
+    def compose_instructions(self, inputs):
+        instructions = f'''You are an English teacher at a Japanese university and you are creating distractors for vocabulary multiple-choice cloze questions for your students. 
+You will be given several numbered multiple choice cloze question stems, each with a list of possible distractors. 
+For each question stem, please provide feedback in terms of syntactic appropriateness and contextual/semantic sense-making of its distractors in the completed sentence. 
+Return only the following result in JSON format to me, keyed by the number of the question stem:
+{{
+  "1": {{"word": {{"syntax": true, "semantics": true}}, "word": {{"syntax": true, "semantics": false}}}},
+  "2": {{"word": {{"syntax": false, "semantics": false}}}}
+}}
+
+To provide you with more instructions on judgement, consider the the question stem: "Birds _____ in the sky." The list of distractors include "swim, beat". The distractor "swim" is syntactically valid because there will be no grammar errors when it is filled into the blank, but it does not make sense since birds "fly" in the sky, not "swim". The distractor "beat" is syntactically inappropriate because "beat" is a transitive verb and requires an object after it. There will be  grammar errors when it is filled into the blank. It also does not make much sense or is incomprehensible. The result of this question stem is:
+{{"swim": {{"syntax": true, "semantics": false}}, "beat": {{"syntax": false, "semantics": false}}}}'''
+        return instructions
 
+    def parse_response(self, prompt, response):
+        res = super().parse_response(prompt=prompt, response=response)
+        try:
+            obj = json.loads(response)
+        except json.decoder.JSONDecodeError as e:
+            return {
+                **res,
+                "success": False,
+                "results": [],
+            }
+        results = []
+        for i, item in enumerate(self.inputs.get('items'), start=1):
+            item_obj = obj.get(str(i))
+            if not isinstance(item_obj, dict):
+                logger.warning(f"Cannot find question stem {i} in response: {response}")
+                results.append({"success": False, "result": item_obj, "good_candidates": [], "others": []})
+                continue
+            good_candidates, others = RationalParser.classify(item_obj, item.get('candidates'))
+            results.append({"success": True, "result": item_obj, "good_candidates": good_candidates, "others": others})
+        return {
+            **res,
+            "result": obj,
+            "results": results,
+        }
@@ -0,0 +1,203 @@
+import asyncio
+import re
+import threading
+import time
+import setting
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def estimate_tokens(prompt, n=1, completion_tokens=setting.RATE_LIMIT_COMPLETION_TOKENS):
+    """Rough estimation of the tokens counted against the TPM limit (~4 characters per token)
+    """
+    return len(prompt) // 4 + completion_tokens * n
+
+
+def parse_duration(text):
+    """Parse the duration in the rate limit headers, e.g. "1s", "20ms", "6m0s"
+
+    Returns:
+        float: seconds, None if not parsable
+    """
+    if text is None:
+        return None
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    units = {'h': 3600, 'm': 60, 's': 1, 'ms': 0.001}
+    parts = re.findall(r"([\d.]+)(ms|h|m|s)", text)
+    if not parts:
+        return None
+    return sum(float(value) * units[unit] for value, unit in parts)
+
+
+class RateLimiter:
+    """Pace the requests of all bots in the process under the account limits.
+
+        - two token buckets for requests per minute and tokens per minute
+        - the buckets are corrected by the x-ratelimit-remaining-* headers, 
+            and all requests are held back after a 429 until retry-after
+        - the allowed concurrency grows by one per window of successful requests with normal latency,
+            and is halved on a 429 (AIMD)
+    """
+    # Time to wait before checking again when no concurrency slot is available
+    poll_interval = 0.05
+    
+    def __init__(self, rpm=setting.RATE_LIMIT_RPM, tpm=setting.RATE_LIMIT_TPM, 
+                 max_concurrency=setting.RATE_LIMIT_MAX_CONCURRENCY, min_concurrency=1) -> None:
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.concurrency = float(max_concurrency)
+        self.in_flight = 0
+        self.n_rate_limited = 0
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._best_latency = None
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+
+    def _reserve(self, tokens):
+        """Try to take a slot for a request
+
+        Returns:
+            float: 0 if the slot is taken, otherwise the seconds to wait before trying again
+        """
+        # A single request larger than the bucket would never fit
+        tokens = min(tokens, self.tpm)
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self._blocked_until:
+                return self._blocked_until - now
+            if self.in_flight >= int(self.concurrency):
+                return self.poll_interval
+            wait = max((1 - self._requests) * 60 / self.rpm, (tokens - self._tokens) * 60 / self.tpm, 0)
+            if wait > 0:
+                return wait
+            self._requests -= 1
+            self._tokens -= tokens
+            self.in_flight += 1
+            return 0
+
+    def acquire(self, tokens):
+        while (wait := self._reserve(tokens)) > 0:
+            time.sleep(wait)
+
+    async def aacquire(self, tokens):
+        while (wait := self._reserve(tokens)) > 0:
+            await asyncio.sleep(wait)
+
+    def release(self, latency=None, headers=None, rate_limited=False):
+        """Give back the slot and learn from the response
+
+        Args:
+            latency (float, optional): seconds taken by a successful request
+            headers (Mapping, optional): response headers
+            rate_limited (bool, optional): whether the request got a 429
+        """
+        with self._lock:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if headers:
+                self._update_from_headers(headers, now)
+            if rate_limited:
+                self.n_rate_limited += 1
+                self.concurrency = max(self.min_concurrency, self.concurrency / 2)
+                retry_after = parse_duration(headers.get('retry-after')) if headers else None
+                self._blocked_until = max(self._blocked_until, now + (retry_after or 1.0))
+                logger.warning(f"Rate limited, concurrency reduced to {int(self.concurrency)}")
+            elif latency is not None:
+                if self._best_latency is None or latency < self._best_latency:
+                    self._best_latency = latency
+                if latency > setting.RATE_LIMIT_SLOW_FACTOR * self._best_latency:
+                    # the service is slowing down, back off a little
+                    self.concurrency = max(self.min_concurrency, self.concurrency * 0.9)
+                else:
+                    self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+
+    def _update_from_headers(self, headers, now):
+        remaining_requests = headers.get('x-ratelimit-remaining-requests')
+        remaining_tokens = headers.get('x-ratelimit-remaining-tokens')
+        if remaining_requests is not None:
+            self._requests = min(self._requests, float(remaining_requests))
+            if float(remaining_requests) <= 0:
+                reset = parse_duration(headers.get('x-ratelimit-reset-requests'))
+                self._blocked_until = max(self._blocked_until, now + (reset or 1.0))
+        if remaining_tokens is not None:
+            self._tokens = min(self._tokens, float(remaining_tokens))
+            if float(remaining_tokens) <= 0:
+                reset = parse_duration(headers.get('x-ratelimit-reset-tokens'))
+                self._blocked_until = max(self._blocked_until, now + (reset or 1.0))
+
+    def request(self, prompt, n=1):
+        """Hold a slot during a request of n completions, usable by both `with` and `async with`
+        """
+        return _RateLimitedRequest(self, estimate_tokens(prompt, n=n))
+
+
+class _RateLimitedRequest:
+    def __init__(self, limiter: RateLimiter, tokens) -> None:
+        self.limiter = limiter
+        self.tokens = tokens
+        self.headers = None
+        self._start = None
+
+    def __enter__(self):
+        self.limiter.acquire(self.tokens)
+        self._start = time.monotonic()
+        return self
+
+    async def __aenter__(self):
+        await self.limiter.aacquire(self.tokens)
+        self._start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is None:
+            self.limiter.release(latency=time.monotonic() - self._start, headers=self.headers)
+        else:
+            response = getattr(exc, 'response', None)
+            self.limiter.release(headers=getattr(response, 'headers', None), 
+                                 rate_limited=getattr(exc, 'status_code', None) == 429)
+        return False
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return self.__exit__(exc_type, exc, tb)
+
+
+# Shared by all bots in the process
+limiter = RateLimiter()
+
+
+###################
+# Test
+###################
+def test_limiter():
+    limiter = RateLimiter(rpm=120, tpm=100000, max_concurrency=4)
+    start = time.monotonic()
+    for i in range(3):
+        with limiter.request("x" * 400) as req:
+            req.headers = {'x-ratelimit-remaining-requests': '100'}
+    print(f"3 requests in {time.monotonic() - start:.2f}s, concurrency {limiter.concurrency:.2f}")
+    limiter.acquire(100)
+    limiter.release(headers={'retry-after': '0.2'}, rate_limited=True)
+    assert limiter.concurrency == 2
+    start = time.monotonic()
+    limiter.acquire(100)
+    assert time.monotonic() - start >= 0.2
+    assert parse_duration("6m0s") == 360 and parse_duration("20ms") == 0.02
+
+
+if __name__ == '__main__':
+    test_limiter()
@@ -0,0 +1,134 @@
+import json
+from lib.io import read_stream
+from lib.log_import import render_logged_prompt
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# The settings that change the requests of a run, kept in the checkpoint meta to replay the run the same way
+RUN_SETTINGS = [
+    'DOMAIN', 'LEVEL_START', 'LEVEL_END', 'WORD_PER_FAMILY', 'RETRY_COUNT_FOR_SINGLE_WORD',
+    'TEST_DISTRACTOR_COUNT', 'DISTRACTOR_COUNT', 'SYNTAX_FILTER', 'SYNTAX_FILTER_MAX_DRAWS',
+    'EMBEDDING_PATH', 'EMBEDDING_OVERSAMPLE', 'SENT_GEN_N_CHOICES', 'SENT_GEN_BATCH_SIZE', 'RATIONAL_BATCH_SIZE',
+    'SENT_GEN_SCORER', 'SENT_GEN_TARGET_WORDS', 'SENT_GEN_MIN_WORDS', 'SENT_GEN_MAX_WORDS', 'ASYNC_MODE', 'RANDOM_SEED',
+]
+
+
+def get_run_settings(setting):
+    return {name: getattr(setting, name) for name in RUN_SETTINGS if hasattr(setting, name)}
+
+
+def apply_run_settings(setting, run_settings):
+    """Set the recorded settings of a run
+
+    Returns:
+        dict: the settings that differed, name -> (current, recorded)
+    """
+    changed = {}
+    for name, value in run_settings.items():
+        if name in RUN_SETTINGS and json.dumps(getattr(setting, name, None)) != json.dumps(value):
+            changed[name] = (getattr(setting, name, None), value)
+    for name, value in run_settings.items():
+        if name in RUN_SETTINGS:
+            setattr(setting, name, value)
+    return changed
+
+
+def load_recorded_responses(log_path, parsers=()):
+    """Collect the prompt/response pairs in the log (stream or .xlsx) of a run
+
+    Args:
+        parsers (list, optional): the parsers of the replay. The prompts of their tasks are rendered 
+            in the current prompt layout, so that the logs of the older runs can be replayed too
+
+    Returns:
+        dict: prompt -> list of the responses in the recorded order
+    """
+    parsers = {parser.task_name: parser for parser in parsers}
+    columns, rows = read_stream(log_path)
+    i_task, i_prompt, i_response = columns.index('Task'), columns.index('Prompt'), columns.index('Raw Response')
+    records = {}
+    n = n_rendered = 0
+    for row in rows:
+        prompt, response = row[i_prompt], row[i_response]
+        # The rows of the local checks (POS Check, Syntax Filter) have no response
+        if not isinstance(prompt, str) or not isinstance(response, str) or response == "-":
+            continue
+        parser = parsers.get(row[i_task])
+        if parser:
+            _, messages = render_logged_prompt(parser, prompt)
+            if messages and parser.format_messages(messages) != prompt:
+                prompt = parser.format_messages(messages)
+                n_rendered += 1
+        records.setdefault(prompt, []).append(response)
+        n += 1
+    logger.info(f"{n} responses of {len(records)} prompts loaded from {log_path}, {n_rendered} prompts rendered in the current layout")
+    return records
+
+
+def diff_items(original, replayed):
+    """Compare the cloze items [sentence, keyword, *distractors] of two runs by keyword
+
+    Returns:
+        list: rows of [keyword, change, original sentence, replayed sentence, original distractors, replayed distractors],
+            change is 'same' | 'changed' | 'added' | 'removed'
+    """
+    original = {row[1]: row for row in original}
+    replayed = {row[1]: row for row in replayed}
+    rows = []
+    for keyword in [*original, *(k for k in replayed if k not in original)]:
+        a, b = original.get(keyword), replayed.get(keyword)
+        if a is None:
+            change = 'added'
+        elif b is None:
+            change = 'removed'
+        else:
+            change = 'same' if list(a) == list(b) else 'changed'
+        rows.append([keyword, change, a[0] if a else None, b[0] if b else None,
+                     ", ".join(map(str, a[2:])) if a else None, ", ".join(map(str, b[2:])) if b else None])
+    return rows
+
+
+###################
+# Test
+###################
+def test_diff_items():
+    original = [["I have an ____ with the bank.", "account", "apple", "table"], ["We ____ it.", "run", "a", "b"]]
+    replayed = [["I have an ____ with the bank.", "account", "apple", "chair"], ["They ____ it.", "eat", "c", "d"]]
+    rows = diff_items(original, replayed)
+    print(rows)
+    assert [r[1] for r in rows] == ['changed', 'removed', 'added']
+
+
+def test_replay_old_log():
+    import os
+    import tempfile
+    from lib.backend import ReplayBackend
+    from lib.io import StreamWriter
+    from lib.parser import SentGenParser, RationalParser
+    # A log of an older run, with the instructions and the inputs in one prompt
+    old_sent_gen_prompt = ('Please generate a sentence in the domain of English for General Academic purposes. '
+                           'The sentence should contain the word "analyse" tagged as "VB". '
+                           'The difficulty of the words should range from B1 to lower B2 based on CEFR.')
+    old_rational_prompt = ('You are an English teacher ... \nIn this multiple choice cloze question stem: "We ____ the data." \n'
+                           'A list of possible distractors include "define, assess". \nPlease provide feedback ...')
+    rows = [["Sentence Generation", old_sent_gen_prompt, '{"sentence": "We analyse the data."}', True],
+            ["POS Check", "We analyse the data.", "-", True],
+            ["Rationality Test", old_rational_prompt, '{"define": true, "assess": false}', True]]
+    path = os.path.join(tempfile.mkdtemp(), 'old-log.jsonl')
+    with StreamWriter(path, columns=['Task', 'Prompt', 'Raw Response', 'Success']) as writer:
+        writer.write_rows(rows)
+
+    sent_gen, rational = SentGenParser(), RationalParser()
+    backend = ReplayBackend(load_recorded_responses(path, parsers=[sent_gen, rational]))
+    inputs = {"word": "analyse", "tag": "VB", "domain": "General Academic", "level_start": "B1", "level_end": "lower B2"}
+    assert backend.complete({"messages": sent_gen.compose_messages(inputs)}).contents == [rows[0][2]]
+    inputs = {"candidates": ["define", "assess"], "sentence": "We ____ the data."}
+    assert backend.complete({"messages": rational.compose_messages(inputs)}).contents == [rows[2][2]]
+    assert backend.misses == 0
+
+
+if __name__ == '__main__':
+    test_diff_items()
+    test_replay_old_log()
@@ -0,0 +1,203 @@
+import asyncio
+import random
+import threading
+import time
+from lib.metrics import metrics
+import setting
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Error classes of the LLM requests
+TRANSIENT = 'transient'     # timeouts and connection errors
+RATE_LIMIT = 'rate_limit'   # 429
+SERVER = 'server'           # 5xx
+PERMANENT = 'permanent'     # 4xx other than 408/409/429 (auth, bad request, ...) and the unknown errors
+PARSE = 'parse'             # a response that the parser does not accept
+
+# Names of the timeout and connection errors of the openai and httpx clients, matched on the class hierarchy
+# so that the clients do not have to be imported
+_TRANSIENT_ERRORS = {'APIConnectionError', 'APITimeoutError', 'TimeoutException', 'NetworkError', 'RemoteProtocolError'}
+
+
+class RequestFailed(Exception):
+    """A request that failed after its retries, or at once for a permanent error
+    """
+    def __init__(self, error_class, error) -> None:
+        super().__init__(f"{error_class}: {error!r}")
+        self.error_class = error_class
+        self.error = error
+
+
+class CircuitOpenError(RuntimeError):
+    """Too many runs failed in a row, no more requests are sent
+    """
+
+
+def classify_error(error):
+    """
+    Returns:
+        str: the error class of an exception raised by a request
+    """
+    status = getattr(error, 'status_code', None)
+    if status is None:
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+    if status == 429:
+        return RATE_LIMIT
+    if status in (408, 409):
+        return TRANSIENT
+    if status is not None:
+        return SERVER if status >= 500 else PERMANENT
+    if isinstance(error, (TimeoutError, ConnectionError)) or any(cls.__name__ in _TRANSIENT_ERRORS for cls in type(error).__mro__):
+        return TRANSIENT
+    return PERMANENT
+
+
+class CircuitBreaker:
+    """Opens after threshold runs in a row failed (request errors after their retries, or responses that fail to parse).
+        Once open, every request fails fast with CircuitOpenError, so a run that cannot succeed
+        (wrong key, exhausted quota, outage, broken prompt) is stopped instead of spending its calls.
+    """
+    def __init__(self, threshold=setting.CIRCUIT_BREAKER_THRESHOLD) -> None:
+        self.threshold = threshold
+        self.failures = 0
+        self.last_error = None
+        self.is_open = False
+        self._lock = threading.Lock()
+
+    def record(self, stage, success, error_class=None):
+        with self._lock:
+            if success:
+                self.failures = 0
+                return
+            self.failures += 1
+            self.last_error = error_class
+            if self.threshold and self.failures >= self.threshold and not self.is_open:
+                self.is_open = True
+                metrics.inc('circuit_breaker_open_total', stage=stage)
+                logger.error(f"Circuit breaker open: {self.failures} runs in a row failed, the last one in {stage} ({error_class})")
+
+    def check(self):
+        if self.is_open:
+            raise CircuitOpenError(f"{self.failures} runs in a row failed, the last one with a {self.last_error} error")
+
+
+class RetryPolicy:
+    """Retry the requests by the class of their errors, with exponential backoff and full jitter:
+        the delay before the n-th retry is drawn from [0, min(max_delay, base_delay * 2 ** (n - 1))].
+
+        - policies maps an error class to (max attempts, base delay, max delay), see setting.RETRY_POLICY
+        - the permanent errors are not retried, and the rate limit errors are also held back by the rate limiter
+        - the parse failures are retried by the trial loops of main.py with a new variant,
+            get_attempts(PARSE) of them (setting.RETRY_COUNT_FOR_SINGLE_WORD by default)
+        - every run is recorded in the circuit breaker, which stops the requests when too many fail in a row
+    """
+    def __init__(self, policies=setting.RETRY_POLICY, breaker=None, rng=None) -> None:
+        self.policies = policies
+        self.breaker = breaker or CircuitBreaker()
+        self.rng = rng or random.Random()
+
+    def get_attempts(self, error_class):
+        if error_class == PARSE and PARSE not in self.policies:
+            # Read at call time, so that a resumed or replayed run uses the value in its settings
+            return setting.RETRY_COUNT_FOR_SINGLE_WORD
+        return self.policies.get(error_class, (1, 0, 0))[0]
+
+    def get_delay(self, error_class, attempt):
+        """The delay before the retry after the attempt-th attempt (1-based) failed
+        """
+        _, base_delay, max_delay = self.policies.get(error_class, (1, 0, 0))
+        return self.rng.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+
+    def _on_error(self, stage, attempt, error):
+        """
+        Returns:
+            float: the delay before the next attempt
+
+        Raises:
+            RequestFailed: if the error is not retried
+        """
+        error_class = classify_error(error)
+        if attempt >= self.get_attempts(error_class):
+            metrics.inc('llm_errors_total', stage=stage, error=error_class)
+            logger.error(f"{stage}: {error_class} error after {attempt} attempts: {error!r}")
+            raise RequestFailed(error_class, error) from error
+        delay = self.get_delay(error_class, attempt)
+        metrics.inc('llm_retries_total', stage=stage, error=error_class)
+        logger.warning(f"{stage}: retry {attempt} in {delay:.1f}s after {error_class} error: {error!r}")
+        return delay
+
+    def call(self, stage, func):
+        """Call func() (a request) until it succeeds or its error is not retried
+
+        Raises:
+            RequestFailed: the request failed
+            CircuitOpenError: the circuit breaker is open
+        """
+        attempt = 0
+        while True:
+            self.breaker.check()
+            attempt += 1
+            try:
+                return func()
+            except Exception as e:
+                delay = self._on_error(stage, attempt, e)
+            time.sleep(delay)
+
+    async def acall(self, stage, func):
+        """Async version of call(), func is a coroutine function
+        """
+        attempt = 0
+        while True:
+            self.breaker.check()
+            attempt += 1
+            try:
+                return await func()
+            except Exception as e:
+                delay = self._on_error(stage, attempt, e)
+            await asyncio.sleep(delay)
+
+    def record(self, stage, success, error_class=None):
+        """Record the outcome of a run (request and parsing) in the circuit breaker
+        """
+        self.breaker.record(stage, success, error_class=error_class)
+
+
+# Shared by all bots in the process
+retry_policy = RetryPolicy()
+
+
+###################
+# Test
+###################
+def test_retry():
+    from lib.backend import FakeAPIError
+    assert [classify_error(e) for e in (FakeAPIError(429), FakeAPIError(503), FakeAPIError(401), TimeoutError(), KeyError())] \
+        == [RATE_LIMIT, SERVER, PERMANENT, TRANSIENT, PERMANENT]
+
+    policy = RetryPolicy(policies={SERVER: (3, 0.01, 0.05), PERMANENT: (1, 0, 0)}, breaker=CircuitBreaker(threshold=2))
+    errors = [FakeAPIError(500), FakeAPIError(502)]
+    def request():
+        if errors:
+            raise errors.pop()
+        return "ok"
+    assert policy.call("task", request) == "ok"
+
+    async def forbidden():
+        raise FakeAPIError(403)
+    for _ in range(2):
+        try:
+            asyncio.run(policy.acall("task", forbidden))
+        except RequestFailed as e:
+            print(e)
+            policy.record("task", False, e.error_class)
+    try:
+        policy.call("task", request)
+    except CircuitOpenError as e:
+        print(e)
+    assert policy.breaker.is_open
+
+
+if __name__ == '__main__':
+    test_retry()
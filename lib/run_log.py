@@ -0,0 +1,218 @@
+import glob
+import gzip
+import hashlib
+import json
+import os
+import setting
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# template id -> {"parser": class name, "instructions": text}, registered by the parsers
+templates = {}
+
+SUFFIX = '.jsonl.gz'
+
+
+def register_template(parser_name, instructions):
+    """Register the instructions of a parser as a prompt template
+
+    Returns:
+        str: the template id
+    """
+    template_id = f"{parser_name}:{hashlib.sha1(instructions.encode('utf-8')).hexdigest()[:12]}"
+    if template_id not in templates:
+        templates[template_id] = {"parser": parser_name, "instructions": instructions}
+    return template_id
+
+
+def render_prompt(template, params):
+    """Reconstruct the prompt text (as ParserBase.format_messages()) from a template and its parameters
+    """
+    from lib import parser
+    parser_obj = getattr(parser, template['parser'])()
+    prompt = parser_obj.compose_prompt(inputs=params)
+    messages = [{"role": "system", "content": template['instructions']}] if template['instructions'] else []
+    return parser_obj.format_messages(messages + [{"role": "user", "content": prompt}])
+
+
+def expand_prompt_refs(row):
+    """Replace the prompt references in a row by the prompt texts, for the logs that keep the full prompts
+    """
+    return [render_prompt(templates[v['template']], v['params']) if isinstance(v, dict) and v.get('template') in templates else v
+            for v in row]
+
+
+def get_log_path(prefix):
+    """The log stream of a run: a compact run log if setting.COMPACT_RUN_LOG, JSONL otherwise
+    """
+    return prefix + (SUFFIX if setting.COMPACT_RUN_LOG else '.jsonl')
+
+
+def get_part_path(filename, index):
+    return f"{filename[:-len(SUFFIX)]}.{index:03d}{SUFFIX}"
+
+
+def get_part_paths(filename):
+    return sorted(glob.glob(glob.escape(filename[:-len(SUFFIX)]) + '.[0-9][0-9][0-9]' + SUFFIX))
+
+
+class RunLog:
+    """The log of a run as gzip'ed JSONL files, a drop-in for StreamWriter of the log rows.
+
+        - a prompt is kept as {"template": id, "params": inputs} (see ParserBase.parse_response()),
+            and the instructions of each template are written once per file
+        - the rows are buffered up to buffer_rows and then compressed to the current file,
+            a new file is started every rotate_rows rows: <name>.000.jsonl.gz, <name>.001.jsonl.gz, ...
+        - read_run_log() reads all the files back with the prompts reconstructed
+    """
+    def __init__(self, filename: str, columns: list, buffer_rows=setting.RUN_LOG_BUFFER_ROWS,
+                 rotate_rows=setting.RUN_LOG_ROTATE_ROWS) -> None:
+        if not filename.endswith(SUFFIX):
+            raise ValueError(f"Run log file name must end with {SUFFIX}: {filename}")
+        path = os.path.dirname(filename)
+        if path:
+            os.makedirs(path, exist_ok=True)
+        self.filename = filename
+        self.columns = columns
+        self.buffer_rows = buffer_rows
+        self.rotate_rows = rotate_rows
+        self._buffer = []
+        self._file = None
+        # A resumed run appends to the last file
+        parts = get_part_paths(filename)
+        self._index = len(parts) - 1 if parts else 0
+        self._open()
+
+    def _open(self):
+        path = get_part_path(self.filename, self._index)
+        # A resumed run continues the count of the rows and the templates already in the file
+        self._rows_in_file, self._written_templates = read_part_summary(path) if os.path.exists(path) else (0, set())
+        self._file = gzip.open(path, 'at', encoding='utf-8')
+        self._file.write(json.dumps({"columns": self.columns}) + "\n")
+
+    def write(self, row: list):
+        self._buffer.append(row)
+        if len(self._buffer) >= self.buffer_rows:
+            self.flush()
+
+    def write_rows(self, rows: list):
+        for row in rows:
+            self.write(row)
+
+    def flush(self):
+        for row in self._buffer:
+            if self._rows_in_file >= self.rotate_rows:
+                self._file.close()
+                self._index += 1
+                self._open()
+            for value in row:
+                if isinstance(value, dict) and 'template' in value and value['template'] not in self._written_templates:
+                    self._file.write(json.dumps({"template": {"id": value['template'], **templates[value['template']]}}, ensure_ascii=False) + "\n")
+                    self._written_templates.add(value['template'])
+            self._file.write(json.dumps({"row": row}, ensure_ascii=False, default=str) + "\n")
+            self._rows_in_file += 1
+        self._buffer = []
+        self._file.flush()
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def read_part_summary(part):
+    """
+    Returns:
+        (int, set): the number of rows in a run log file, and the ids of the templates written in it
+    """
+    n_rows, template_ids = 0, set()
+    try:
+        with gzip.open(part, 'rt', encoding='utf-8') as f:
+            for line in f:
+                if line.startswith('{"row"'):
+                    n_rows += 1
+                elif line.startswith('{"template"'):
+                    try:
+                        template_ids.add(json.loads(line)['template']['id'])
+                    except json.decoder.JSONDecodeError:
+                        pass
+    except EOFError:
+        logger.warning(f"Incomplete run log file: {part}")
+    return n_rows, template_ids
+
+
+def read_run_log(filename: str, expand=True):
+    """Read the rows of a run log
+
+    Args:
+        expand (bool, optional): reconstruct the prompts from their templates. Defaults to True.
+            Otherwise the prompt references are kept, and their templates are registered to be written to another RunLog.
+
+    Returns:
+        (list, generator): the columns, and the rows as lists
+    """
+    parts = get_part_paths(filename)
+    columns = []
+    if parts:
+        with gzip.open(parts[0], 'rt', encoding='utf-8') as f:
+            columns = json.loads(f.readline())['columns']
+
+    def read_lines(part):
+        try:
+            with gzip.open(part, 'rt', encoding='utf-8') as f:
+                yield from f
+        except EOFError:
+            # The end of the last file is lost if the run crashed before closing the log
+            logger.warning(f"Incomplete run log file: {part}")
+
+    def rows():
+        for part in parts:
+            for line in read_lines(part):
+                try:
+                    obj = json.loads(line)
+                except json.decoder.JSONDecodeError:
+                    logger.warning(f"Skip broken line in {part}")
+                    continue
+                if 'template' in obj:
+                    template = obj['template']
+                    templates.setdefault(template['id'], {"parser": template['parser'], "instructions": template['instructions']})
+                elif 'row' in obj:
+                    if not expand:
+                        yield obj['row']
+                        continue
+                    yield expand_prompt_refs(obj['row'])
+    return columns, rows()
+
+
+###################
+# Test
+###################
+def test_run_log():
+    import tempfile
+    from lib.parser import RationalParser
+    parser = RationalParser()
+    inputs = {"keyword": "analyse", "candidates": ["assess", "define"], "sentence": "We ____ the data."}
+    messages = parser.compose_messages(inputs)
+    r = parser.parse_response(parser.format_messages(messages), '{"assess": {"syntax": true, "semantics": false}}')
+
+    filename = os.path.join(tempfile.mkdtemp(), 'test-log.jsonl.gz')
+    with RunLog(filename, columns=['Task', 'Prompt', 'Success'], buffer_rows=2, rotate_rows=3) as log:
+        for _ in range(4):
+            log.write([parser.task_name, r['prompt_ref'], r['success']])
+    columns, rows = read_run_log(filename)
+    rows = list(rows)
+    print(get_part_paths(filename), columns, len(rows))
+    assert len(rows) == 4 and rows[3][1] == r['prompt']
+
+    # A resumed run fills the last file up to rotate_rows
+    with RunLog(filename, columns=['Task', 'Prompt', 'Success'], buffer_rows=2, rotate_rows=3) as log:
+        for _ in range(3):
+            log.write([parser.task_name, r['prompt_ref'], r['success']])
+    assert [read_part_summary(part)[0] for part in get_part_paths(filename)] == [3, 3, 1]
@@ -0,0 +1,48 @@
+"""Scorers to choose the best of several generated cloze sentences, higher is better.
+
+    Each scorer takes the clozed sentence and the keyword, and returns a number.
+"""
+import re
+import setting
+
+WORD_PAT = re.compile(r"[A-Za-z0-9'-]+|_{2,}")
+
+
+def count_words(sentence):
+    return len(WORD_PAT.findall(sentence))
+
+
+def score_first(sentence, word):
+    """Keep the order of the completions
+    """
+    return 0
+
+
+def score_length(sentence, word):
+    """Prefer the sentence whose length is closest to the middle of the requested range (15-20 words)
+    """
+    middle = (setting.SENT_GEN_TARGET_WORDS[0] + setting.SENT_GEN_TARGET_WORDS[1]) / 2
+    return -abs(count_words(sentence) - middle)
+
+
+def score_position(sentence, word):
+    """Prefer the sentence with the blank close to its middle, so there is context on both sides
+    """
+    tokens = WORD_PAT.findall(sentence)
+    blanks = [i for i, t in enumerate(tokens) if t.startswith('_')]
+    if not blanks or len(tokens) < 2:
+        return -1
+    return -abs(blanks[0] / (len(tokens) - 1) - 0.5)
+
+
+SCORERS = {
+    'first': score_first,
+    'length': score_length,
+    'position': score_position,
+}
+
+
+def get_scorer(name):
+    if name not in SCORERS:
+        raise ValueError(f"Unknown sentence scorer '{name}', choose from {list(SCORERS)}")
+    return SCORERS[name]
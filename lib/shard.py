@@ -0,0 +1,72 @@
+import os
+from lib.io import open_stream_writer, read_stream
+from lib.run_log import SUFFIX, get_log_path, get_part_paths, read_run_log
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def make_shards(family_counts, families_per_shard=0):
+    """Split the word families of the sublists into shards, one per sublist or per range of word families
+
+    Args:
+        family_counts (dict): sublist -> the number of word families
+        families_per_shard (int, optional): the max number of word families in a shard. Defaults to 0 (a whole sublist).
+
+    Returns:
+        list: [{"id": "sublist-01-0000", "sublist": 1, "start": 0, "count": 60}, ...] in the order of the merged output
+    """
+    shards = []
+    for sublist in sorted(family_counts):
+        n = family_counts[sublist]
+        size = families_per_shard if families_per_shard > 0 else max(n, 1)
+        for start in range(0, n, size):
+            shards.append({"id": f"sublist-{sublist:02d}-{start:04d}", "sublist": sublist, "start": start, "count": min(size, n - start)})
+    return shards
+
+
+def get_shard_paths(shard_dir, shard):
+    """
+    Returns:
+        (str, str): the cloze item stream and the log stream of the shard
+    """
+    prefix = os.path.join(shard_dir, shard['id'])
+    return f'{prefix}-cloze.jsonl', get_log_path(f'{prefix}-log')
+
+
+def merge_streams(paths, filename, columns):
+    """Concatenate the stream files in the given order into one stream file, 
+        the prompts of run logs are copied as template references
+
+    Returns:
+        int: the number of rows
+    """
+    n = 0
+    compact = filename.endswith(SUFFIX)
+    for path in get_part_paths(filename) if compact else [filename]:
+        if os.path.exists(path):
+            os.remove(path)
+    with open_stream_writer(filename, columns=columns) as writer:
+        for path in paths:
+            if not (get_part_paths(path) if path.endswith(SUFFIX) else os.path.exists(path)):
+                logger.warning(f"Shard output not found: {path}")
+                continue
+            _, rows = read_run_log(path, expand=False) if compact and path.endswith(SUFFIX) else read_stream(path)
+            for row in rows:
+                writer.write(row)
+                n += 1
+    return n
+
+
+###################
+# Test
+###################
+def test_make_shards():
+    shards = make_shards({2: 5, 1: 3}, families_per_shard=2)
+    print(shards)
+    assert [(s['sublist'], s['start'], s['count']) for s in shards] == [(1, 0, 2), (1, 2, 1), (2, 0, 2), (2, 2, 2), (2, 4, 1)]
+    assert len(make_shards({1: 60, 2: 60})) == 2
+
+
+if __name__ == '__main__':
+    test_make_shards()
@@ -0,0 +1,172 @@
+import asyncio
+import contextvars
+import functools
+import itertools
+import json
+import os
+import threading
+import time
+from contextlib import nullcontext
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# The correlation id and the track (trace viewer row) of the current span, inherited by the nested spans,
+#   the coroutines and the worker threads started with asyncio.to_thread()
+_current = contextvars.ContextVar('trace_current', default=None)
+# Returned by span() while tracing is disabled, so a disabled span costs one attribute check
+_NULL_SPAN = nullcontext()
+
+
+class Span:
+    def __init__(self, tracer, name, correlation_id, args) -> None:
+        self.tracer = tracer
+        self.name = name
+        self.correlation_id = correlation_id
+        self.args = args
+        self._token = None
+
+    def __enter__(self):
+        parent = _current.get()
+        if parent:
+            parent_id, track = parent
+            self.correlation_id = self.correlation_id or parent_id
+        elif self.correlation_id is not None:
+            # A top-level span with a correlation id (e.g. a word family) gets its own row, 
+            #   so the spans of concurrent items do not overlap
+            track = self.tracer.new_track(self.correlation_id)
+        else:
+            track = threading.get_ident()
+        self.track = track
+        self._token = _current.set((self.correlation_id, track))
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        _current.reset(self._token)
+        args = {"correlation_id": self.correlation_id, **self.args}
+        if exc_type is not None:
+            args["error"] = exc_type.__name__
+        self.tracer.add_event(self.name, self.start, end, self.track, args)
+
+
+class Tracer:
+    """Nested spans of a run written in the Chrome trace event format (chrome://tracing, Perfetto, speedscope).
+
+        Each span is a complete event ("ph": "X") with its correlation id in args, inherited from the enclosing span
+        unless a new one is given (word family -> word). A top-level span opens a new row, 
+        and the spans nested in it are drawn in that row.
+    """
+    def __init__(self) -> None:
+        self.enabled = False
+        self.events = []
+        self._tracks = itertools.count(1)
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+
+    def start(self):
+        self.enabled = True
+        self.events = []
+        self._origin = time.perf_counter()
+
+    def stop(self):
+        self.enabled = False
+
+    def span(self, name, correlation_id=None, **args):
+        """A context manager that records the time spent in the block as a span
+
+        Args:
+            correlation_id (str, optional): the item the span belongs to, inherited from the enclosing span by default
+        """
+        if not self.enabled:
+            return _NULL_SPAN
+        return Span(self, name, correlation_id, args)
+
+    def new_track(self, name):
+        track = next(self._tracks)
+        self._add({"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": track, "args": {"name": str(name)}})
+        return track
+
+    def add_event(self, name, start, end, track, args):
+        self._add({"name": name, "cat": "cloze", "ph": "X", "pid": os.getpid(), "tid": track,
+                   "ts": round((start - self._origin) * 1e6, 3), "dur": round((end - start) * 1e6, 3), "args": args})
+
+    def _add(self, event):
+        with self._lock:
+            self.events.append(event)
+
+    def write(self, filename):
+        path = os.path.dirname(filename)
+        if path:
+            os.makedirs(path, exist_ok=True)
+        with self._lock:
+            events = list(self.events)
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, ensure_ascii=False, default=str)
+        logger.info(f"{len(events)} trace events written to {filename}")
+
+
+# Shared by all the modules in the process, enabled by `python main.py --profile`
+tracer = Tracer()
+
+
+def span(name, correlation_id=None, **args):
+    return tracer.span(name, correlation_id=correlation_id, **args)
+
+
+def traced(name):
+    """Decorator to record each call of a function (sync or async) as a span
+    """
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if not tracer.enabled:
+                    return await func(*args, **kwargs)
+                with tracer.span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return func(*args, **kwargs)
+            with tracer.span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+###################
+# Test
+###################
+def test_tracer():
+    import tempfile
+    with span("disabled"):
+        pass
+    assert not tracer.events
+
+    async def item(i):
+        with span("word family", correlation_id=f"family-{i}"):
+            with span("word", word=f"w{i}"):
+                await asyncio.sleep(0.01)
+                await asyncio.to_thread(time.sleep, 0.001)
+
+    async def run():
+        await asyncio.gather(*(item(i) for i in range(3)))
+
+    tracer.start()
+    asyncio.run(run())
+    tracer.stop()
+    events = [e for e in tracer.events if e['ph'] == 'X']
+    assert len(events) == 6 and len({e['tid'] for e in events}) == 3
+    assert all(e['args']['correlation_id'].startswith('family-') for e in events)
+    filename = os.path.join(tempfile.mkdtemp(), 'trace.json')
+    tracer.write(filename)
+    print(open(filename).read()[:300])
+
+
+if __name__ == '__main__':
+    test_tracer()
@@ -1,9 +1,12 @@
 import datetime
+import glob
+import hashlib
 import json
 import os
 import pickle
 import re
-from setting import DEFAULT_LOG_LEVEL, RANDOM_SEED
+from setting import DEFAULT_LOG_LEVEL
+import setting
 
 import logging
 logger = logging.getLogger(__name__)
@@ -71,24 +74,63 @@ def replace_article(sentence):
 
 
 cache_dir = './cache'
-def get_cache_path(path, sublist):
+def get_cache_path(path, sublist, fingerprint=""):
     head, tail = os.path.split(path)
-    fn = os.path.join(cache_dir, f"{tail}.sublist{sublist}.cache")
+    suffix = f".{fingerprint}" if fingerprint else ""
+    fn = os.path.join(cache_dir, f"{tail}.sublist{sublist}{suffix}.cache")
     return fn
     
-def read_from_cache(path, sublist):
-    fn = get_cache_path(path, sublist)
+def read_from_cache(path, sublist, fingerprint=""):
+    fn = get_cache_path(path, sublist, fingerprint)
     if not os.path.exists(fn):
         return None
     with(open(fn, 'rb')) as f:
         return pickle.load(f)
 
-def write_to_cache(path, sublist, obj):
+def write_to_cache(path, sublist, obj, fingerprint=""):
     if not os.path.exists(cache_dir):
         os.makedirs(cache_dir)
-    fn = get_cache_path(path, sublist)
+    fn = get_cache_path(path, sublist, fingerprint)
     with(open(fn, 'wb')) as f:
         pickle.dump(obj, f)
+    # Remove the caches of the same input made by other versions of the code
+    _, tail = os.path.split(path)
+    for other in glob.glob(os.path.join(cache_dir, f"{glob.escape(tail)}.sublist{sublist}.*cache")):
+        if os.path.normpath(other) != os.path.normpath(fn):
+            os.remove(other)
+
+
+def get_content_hash(obj):
+    """Hash of a JSON-serializable object, independent of the process
+    """
+    return hashlib.sha256(json.dumps(obj, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def get_file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def get_code_fingerprint(source_files, packages=(), version=""):
+    """Fingerprint of the code that produces a cached object: 
+        the content of the source files, the versions of the packages, and a manual version tag
+
+    Returns:
+        str: a short hex digest
+    """
+    from importlib.metadata import version as package_version, PackageNotFoundError
+    h = hashlib.sha256(str(version).encode('utf-8'))
+    for fn in source_files:
+        h.update(get_file_hash(fn).encode('utf-8'))
+    for package in packages:
+        try:
+            h.update(f"{package}=={package_version(package)}".encode('utf-8'))
+        except PackageNotFoundError:
+            h.update(f"{package}==?".encode('utf-8'))
+    return h.hexdigest()[:16]
 
 
 def get_date_str():
@@ -97,9 +139,19 @@ def get_date_str():
 
 
 def setup_randomness():
-    if RANDOM_SEED > 0:
+    if setting.RANDOM_SEED > 0:
         import random
-        random.seed(RANDOM_SEED)
+        random.seed(setting.RANDOM_SEED)
+
+
+def get_rng(key):
+    """Get a random generator dedicated to the given key (e.g. a word family),
+        so that the result does not depend on the order in which the keys are processed
+    """
+    import random
+    if setting.RANDOM_SEED > 0:
+        return random.Random(f"{setting.RANDOM_SEED}:{key}")
+    return random.Random()
 
 
 def load_config(file='./config.json'):
@@ -2,6 +2,8 @@ from functools import reduce
 import random
 from typing import List, Optional
 from lib.inflections import get_inflections
+from lib.metrics import timed
+from lib.tracing import span
 from lib.utils import ExtendableDict
 
 import logging
@@ -54,7 +56,8 @@ class WordFamily:
         if related_words:
             words += related_words
         for i, word_surface in enumerate(words):
-            tag_to_surface, full_log = get_inflections(word_surface)
+            with span("Inflections", word=word_surface):
+                tag_to_surface, full_log = get_inflections(word_surface)
             tag_to_words = {tag: set([MyWord(w, tag) for w in words]) for tag, words in tag_to_surface.items()}
             
             self.inflection_log.extend(full_log)
@@ -81,11 +84,15 @@ class WordFamily:
             return ""
         return random.choice(candidates)
     
-    def get_shuffled_words(self):
+    def get_shuffled_words(self, rng=None):
         """Get a shuffled list of all words in the family
+        
+            words are sorted before shuffling so that the result only depends on the rng,
+            not on the hash seed of the process
         """
-        words = list(self.all_words)
-        random.shuffle(words)
+        rng = rng or random
+        words = sorted(self.all_words, key=repr)
+        rng.shuffle(words)
         return words
     
     @property
@@ -96,30 +103,107 @@ class WordFamily:
         print("headword: <{}>\n{}".format(self.headword, self.tag_to_words))
 
 
+class DistractorSampler:
+    """Draw words of a tag without replacement for one distractor request.
+    
+        It runs a partial Fisher-Yates shuffle over the (shared, read-only) word array of the tag:
+        only the swapped positions are kept in a dict and a cursor marks the drawn prefix,
+        so a draw costs O(1) no matter how many words the tag has. 
+        Excluded words are skipped when they are drawn.
+    """
+    def __init__(self, words: list, word_ids: dict, excepts=None, rng=None) -> None:
+        """
+        Args:
+            words (list): all words of the tag
+            word_ids (dict): word -> index in words
+            excepts (list, optional): words never to be drawn
+        """
+        self.words = words
+        self.word_ids = word_ids
+        self.rng = rng or random
+        self._swaps = {}
+        self._cursor = 0
+        self._excluded = set()
+        self.exclude(excepts or [])
+
+    def exclude(self, words):
+        for w in words:
+            i = self.word_ids.get(w)
+            if i is not None:
+                self._excluded.add(i)
+
+    def draw(self, n):
+        """Draw up to n words that are neither drawn before nor excluded
+        """
+        res = []
+        size = len(self.words)
+        while len(res) < n and self._cursor < size:
+            j = self.rng.randrange(self._cursor, size)
+            picked = self._swaps.get(j, j)
+            self._swaps[j] = self._swaps.pop(self._cursor, self._cursor)
+            self._cursor += 1
+            if picked not in self._excluded:
+                res.append(self.words[picked])
+        return res
+
+    @property
+    def exhausted(self):
+        return self._cursor >= len(self.words)
+
+
 class WordCluster:
     def __init__(self) -> None:
         self.tag_to_words = ExtendableDict()
         self.word_family_list = []
         self.inflection_log = []
+        # tag -> (words sorted as an array, word -> index), built on demand
+        self._tag_index = None
     
     def add_item(self, headword, related_words=[]):
         wf = WordFamily(headword, related_words)
+        self.add_family(wf)
+        return wf
+    
+    def add_family(self, wf: WordFamily):
+        """Add a word family that is already constructed, e.g. loaded from cache
+        """
         self.inflection_log.extend(wf.inflection_log)
         self.tag_to_words.merge(wf.tag_to_words)
         self.word_family_list.append(wf)
+        self._tag_index = None
     
-    def find_distractors(self, tag, excepts=None, n=10):
-        words = self.tag_to_words.get(tag, set())
-        # do not assign back to words, otherwise the original set will be modified
-        candidates = words
-        if excepts:
-            candidates = words - set(excepts)
-        
-        if 0 <= n < len(candidates):
-            # Use sample() instead of choices() to avoid duplicates
-            return random.sample(list(candidates), k=n)
-        else:
-            return candidates
+    @classmethod
+    def from_families(cls, families):
+        wc = cls()
+        for wf in families:
+            wc.add_family(wf)
+        return wc
+    
+    def get_tag_index(self, tag):
+        """Get the words of a tag as an array (sorted, so it does not depend on the hash seed), 
+            and the index of each word in it
+        """
+        if getattr(self, '_tag_index', None) is None:
+            self._tag_index = {}
+        if tag not in self._tag_index:
+            words = sorted(self.tag_to_words.get(tag, set()), key=repr)
+            self._tag_index[tag] = (words, {w: i for i, w in enumerate(words)})
+        return self._tag_index[tag]
+
+    def distractor_sampler(self, tag, excepts=None, rng=None):
+        """Get a sampler to draw distractor candidates of the tag in several rounds without repetition
+        """
+        words, word_ids = self.get_tag_index(tag)
+        return DistractorSampler(words, word_ids, excepts=excepts, rng=rng)
+    
+    @timed("Find Distractors")
+    def find_distractors(self, tag, excepts=None, n=10, rng=None):
+        """Randomly choose n words of the tag except the given ones, all of them if n < 0
+        """
+        sampler = self.distractor_sampler(tag, excepts=excepts, rng=rng)
+        if n < 0:
+            n = len(sampler.words)
+        return sampler.draw(n)
     
     @property
     def tag_size(self):
@@ -152,6 +236,15 @@ def test_family():
     print(wf.get_random_word(tag='*'))
     
 
+def test_sampler():
+    words = [MyWord(f"w{i}", 'NN') for i in range(100)]
+    sampler = DistractorSampler(words, {w: i for i, w in enumerate(words)}, excepts=words[:10], rng=random.Random(1))
+    drawn = sampler.draw(30) + sampler.draw(100)
+    assert len(drawn) == 90 and len(set(drawn)) == 90 and not set(drawn) & set(words[:10])
+    assert sampler.exhausted and sampler.draw(5) == []
+    print(drawn[:5])
+
+
 def test_cluster():
     wc = WordCluster()
     wc.add_item('analyse', ['analyser', 'analysis'])
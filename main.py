@@ -1,162 +1,1155 @@
-import pandas as pd
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from lib import batch
+from lib.cache import ResponseCache
+from lib.backend import ReplayBackend
+from lib.checkpoint import Checkpoint, DONE, FAILED, IN_FLIGHT
 from lib.chat import MyBotWrapper
-from lib.parser import SentGenParser, DerivativeParser, RationalParser
-from lib.utils import fill_cloze, get_date_str, read_from_cache, write_to_cache, setup_log, setup_randomness
-from lib.io import read_data, write_data
+from lib.parser import SentGenParser, BatchSentGenParser, DerivativeParser, RationalParser, BatchRationalParser
+from lib.scorer import count_words, get_scorer
+from lib.utils import fill_cloze, get_code_fingerprint, get_content_hash, get_date_str, get_file_hash, get_rng, read_from_cache, write_to_cache, setup_log, setup_randomness
+from lib.log_import import import_log
+from lib.metrics import metrics, timed
+from lib.tracing import span, traced, tracer
+from lib.io import StreamWriter, export_excel, get_stream_stem, open_stream_writer, read_data, read_stream, write_rows
+from lib.rate_limit import RateLimiter
+from lib.retry import PARSE, CircuitBreaker, CircuitOpenError, RetryPolicy
+from lib.replay import apply_run_settings, diff_items, get_run_settings, load_recorded_responses
+from lib.shard import get_shard_paths, make_shards, merge_streams
+from lib.run_log import get_log_path
 from lib.word_cluster import WordCluster, WordFamily
-from lib.nlp_helper import pos_check
+from lib.nlp_helper import apos_check, apos_check_batch, pos_check, pos_check_batch, syntax_filter
 import setting
 
 import logging
 logger = logging.getLogger(__name__)
 
 
-def main():
-    now = get_date_str()
-    path = 'data/input/AWL.xlsx'
-    sublist = setting.SUBLIST
-    fn_data = f'./data/output/{now}-AWL-sublist-{sublist}-cloze.xlsx'
-    fn_log = f'./log/excel/{now}-log.xlsx'
-    fn_inflections = f'./log/excel/{now}-inflections.xlsx'
-    inflection_columns = ['word', 'tag', 'lemm', 'unimorph', 'final']
+log_columns = ['Date', 'Task', 'Keyword', 'Tag', 'Prompt', 'Raw Response', 'Parsed Result', 'Success']
+columns = ['Sentence', 'Correct Answer', *[f'Distractor {i}' for i in range(1, setting.DISTRACTOR_COUNT+1)]]
 
-    logger.info(f"Try loading from cache...")
-    word_cluster = read_from_cache(path, sublist)
-    if not word_cluster:
-        logger.info(f"WordCluster cache not found, load...")
-        word_cluster = load_sublist(path, sublist=sublist)
-        write_to_cache(path, sublist, word_cluster)
-        logger.info(f"WordCluster written to cache")
+
+input_path = 'data/input/AWL.xlsx'
+
+
+class FamilyResult:
+    """The outputs of a word family that are not flushed to the output files yet
+    """
+    def __init__(self) -> None:
+        self.rows = []
+        self.log_data = []
+        # checkpoint key of a word -> state
+        self.word_states = {}
+        self.complete = False
+
+
+def flush_result(word_family, result: FamilyResult, data_writer, log_writer, checkpoint=None):
+    """Write the outputs of a word family and mark them in the checkpoint, then clear them from the result
+    """
+    # Write the outputs before marking them in the checkpoint, so nothing marked as done is lost
+    data_writer.write_rows(result.rows)
+    log_writer.write_rows(result.log_data)
+    if checkpoint:
+        for key, state in result.word_states.items():
+            checkpoint.mark(key, state)
+        if result.complete:
+            checkpoint.mark(Checkpoint.get_key(word_family), DONE)
+    result.rows, result.log_data, result.word_states = [], [], {}
+
+
+class FamilyQueue:
+    """The words of a word family waiting for their sentences in the batched sentence generation
+    """
+    def __init__(self, word_family, result: FamilyResult, checkpoint=None, max_trials=setting.RETRY_COUNT_FOR_SINGLE_WORD) -> None:
+        self.word_family = word_family
+        self.result = result
+        self.checkpoint = checkpoint
+        self.words = deque(word_family.get_shuffled_words(rng=get_rng(repr(word_family))))
+        # The words whose sentences are requested but not finished yet
+        self.active = []
+        # word -> number of sentence generation requests
+        self.trials = {}
+        self.max_trials = max_trials
+        self.n_done = 0
+    
+    def next_words(self):
+        """Take the next words so that enough words are in progress to reach setting.WORD_PER_FAMILY
+
+        Returns:
+            list: the words to request sentences for in this round
+        """
+        while self.n_done + len(self.active) < setting.WORD_PER_FAMILY and self.words:
+            word = self.words.popleft()
+            # FIXME: word is '' if inflections not generated correctly
+            if not word:
+                logger.warning(f"Empty word in word family: {repr(self.word_family)}")
+                continue
+            state = start_word(self.checkpoint, self.word_family, word)
+            if state == DONE:
+                self.n_done += 1
+            if state:
+                continue
+            self.active.append(word)
+        return list(self.active)
+    
+    def retry(self, word):
+        """Keep the word for the next round if it has trials left, otherwise mark it failed
+        """
+        self.trials[word] = self.trials.get(word, 0) + 1
+        if self.trials[word] < self.max_trials:
+            return
+        logger.error(f"Failed to generate sentence for '{repr(word)}'")
+        self.active.remove(word)
+        self.result.word_states[Checkpoint.get_key(self.word_family, word)] = FAILED
+
+
+class DistractorTask:
+    """The distractors of a cloze item being collected by afill_distractors_batched()
+    """
+    def __init__(self, word_cluster, word, sentence, log_data, rng=None) -> None:
+        self.word = word
+        self.sentence = sentence
+        self.log_data = log_data
+        # Candidates are drawn without replacement across the trials
+        self.sampler = word_cluster.distractor_sampler(word.tag, excepts=[word], rng=rng)
+        self.pool = []
+        self.distractors = []
+        self.done = False
+
+
+def main(run_id=None):
+    """Generate cloze questions for the selected word families
+
+    Args:
+        run_id (str, optional): resume the interrupted run with this id. Defaults to None (new run).
+    """
+    if run_id:
+        if not Checkpoint.exists(run_id):
+            logger.error(f"No checkpoint found for run '{run_id}'")
+            exit(-1)
+        checkpoint = Checkpoint(run_id)
+        meta = checkpoint.meta
+        resume_run_settings(meta)
+        logger.info(f"Resume run {run_id}: {checkpoint.summary()}")
     else:
-        logger.info(f"WordCluster loaded from cache: {path}")
-    df_inflections = pd.DataFrame(word_cluster.inflection_log, columns=inflection_columns)
-    write_data(df_inflections, fn_inflections)
-    logger.info(f"Inflections saved to {fn_inflections}")
+        run_id = new_run_id(Checkpoint.claim)
+        sublist = setting.SUBLIST
+        meta = {
+            "sublist": sublist,
+            "start": setting.KEYWORD_START_POS,
+            "count": setting.KEYWORD_COUNT,
+            "fn_data": f'./data/output/{run_id}-AWL-sublist-{sublist}-cloze.xlsx',
+            "fn_data_stream": f'./data/output/{run_id}-AWL-sublist-{sublist}-cloze.jsonl',
+            "fn_log": f'./log/excel/{run_id}-log.xlsx',
+            "fn_log_stream": get_log_path(f'./log/excel/{run_id}-log'),
+            "settings": get_run_settings(setting),
+        }
+        checkpoint = Checkpoint(run_id, meta=meta)
+        logger.info(f"Run id: {run_id}")
+    fn_inflections = f'./log/excel/{run_id}-inflections.xlsx'
+    inflection_columns = ['word', 'tag', 'lemm', 'unimorph', 'final']
+
+    word_cluster = load_word_cluster(input_path, meta['sublist'])
+    if not os.path.exists(fn_inflections):
+        write_rows(word_cluster.inflection_log, inflection_columns, fn_inflections)
+        logger.info(f"Inflections saved to {fn_inflections}")
     
-    word_families = select_word_families(word_cluster, start=setting.KEYWORD_START_POS, max_count=setting.KEYWORD_COUNT)
+    word_families = select_word_families(word_cluster, start=meta['start'], max_count=meta['count'])
+    word_families = [wf for wf in word_families if not checkpoint.is_finished(Checkpoint.get_key(wf))]
     n_total = len(word_families)
     logger.info(f"Start generating cloze sentences for {n_total} words...")
 
-    bot_sent_gen = MyBotWrapper(parser=SentGenParser(), temperature=0.9)
+    cache = ResponseCache() if setting.RESPONSE_CACHE_ENABLED else None
+    bot_sent_gen, bot_rational = create_bots(cache=cache, batched=setting.SENT_GEN_BATCH_SIZE > 1)
+    ranker = create_ranker(word_cluster)
+
+    data_writer = StreamWriter(meta['fn_data_stream'], columns=columns)
+    # The runs before the compact run log are resumed with their JSONL log
+    log_writer = open_stream_writer(meta['fn_log_stream'], columns=log_columns)
+    results = [FamilyResult() for _ in word_families]
+    
+    def flush(word_family, result: FamilyResult):
+        flush_result(word_family, result, data_writer, log_writer, checkpoint=checkpoint)
+
+    try:
+        if setting.ASYNC_MODE:
+            logger.info(f"Async mode: process up to {setting.CONCURRENCY} word families at once")
+            asyncio.run(agenerate(bot_sent_gen, bot_rational, word_cluster, word_families, results, 
+                                  checkpoint=checkpoint, ranker=ranker, on_family_done=flush))
+        else:
+            generate(bot_sent_gen, bot_rational, word_cluster, word_families, results, 
+                     checkpoint=checkpoint, ranker=ranker, on_family_done=flush)
+    except (KeyboardInterrupt, CircuitOpenError) as e:
+        if isinstance(e, CircuitOpenError):
+            logger.error(f"Stopped by the circuit breaker: {e}, saving the finished items...")
+        else:
+            logger.warning(f"Interrupted, saving the finished items...")
+        for word_family, result in zip(word_families, results):
+            flush(word_family, result)
+        logger.warning(f"Resume with: python main.py --resume {run_id}")
+        exit(1 if isinstance(e, CircuitOpenError) else 130)
+    finally:
+        data_writer.close()
+        log_writer.close()
+        checkpoint.close()
+        write_metrics(run_id)
+        if cache:
+            logger.info(f"Response cache: {cache.stats()}")
+            cache.close()
+    
+    for bot in (bot_sent_gen, bot_rational):
+        logger.info(f"{bot.task_name}: {bot.usage_summary()}")
+    export_excel(meta['fn_data_stream'], meta['fn_data'])
+    export_excel(meta['fn_log_stream'], meta['fn_log'])
+    logger.info(f"Done. Data saved to {meta['fn_data']}")
+
+
+def resume_run_settings(meta):
+    """Continue a run with the settings it started with, so its outputs are made by one configuration
+    """
+    changed = apply_run_settings(setting, meta.get('settings', {}))
+    if changed:
+        logger.warning(f"Resumed with the settings of the run (current -> recorded): {changed}")
+        setup_randomness()
+
+
+def new_run_id(claim):
+    """The id of a new run from the current time, with a suffix if another run started in the same second
+
+    Args:
+        claim (callable): claim(run_id) creates the files of the run atomically, False if they exist
+    """
+    base = get_date_str()
+    run_id, i = base, 1
+    while not claim(run_id):
+        i += 1
+        run_id = f"{base}-{i}"
+    return run_id
+
+
+def claim_dir(path):
+    try:
+        os.makedirs(path)
+    except FileExistsError:
+        return False
+    return True
+
+
+def write_metrics(run_id, path=setting.METRICS_DIR, **extra):
+    summary = metrics.write(run_id, path=path, **extra)
+    logger.info(f"Metrics saved to {os.path.join(path, run_id)}-metrics.json/.prom, estimated cost: ${summary['cost_usd']:.4f}")
+    return summary
+
+
+def create_bots(cache=None, batched=False):
+    """
+    Args:
+        batched (bool, optional): generate the sentences of several words in one request. Defaults to False.
+    """
+    parser_sent_gen = BatchSentGenParser() if batched else SentGenParser()
+    bot_sent_gen = MyBotWrapper(parser=parser_sent_gen, temperature=0.9, cache=cache if setting.CACHE_SENT_GEN else None)
     # bot_derive = MyBotWrapper(parser=DerivativeParser(), temperature=0.1)
-    bot_rational = MyBotWrapper(parser=RationalParser(), temperature=0)
+    parser_rational = BatchRationalParser() if batched and setting.RATIONAL_BATCH_SIZE > 1 else RationalParser()
+    bot_rational = MyBotWrapper(parser=parser_rational, temperature=0, cache=cache)
+    return bot_sent_gen, bot_rational
+
+
+def create_ranker(word_cluster):
+    """Create the distractor ranker if word vectors are configured
+    """
+    if not setting.EMBEDDING_PATH:
+        return None
+    from lib.embedding import DistractorRanker
+    return DistractorRanker.from_file(setting.EMBEDDING_PATH, word_cluster)
+
+
+def get_word_cluster_fingerprint():
+    """Fingerprint of the code that builds word families, part of the cache key of WordCluster
+    """
+    lib_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'lib')
+    source_files = [os.path.join(lib_dir, fn) for fn in ('inflections.py', 'word_cluster.py')]
+    return get_code_fingerprint(source_files, packages=('lemminflect', 'unimorph'), 
+                                version=setting.WORD_CLUSTER_CACHE_VERSION)
 
-    log_columns = ['Date', 'Task', 'Keyword', 'Tag', 'Prompt', 'Raw Response', 'Parsed Result', 'Success']
-    log_data = []
+
+def load_word_cluster(path, sublist):
+    """Load the WordCluster of a sublist, reusing the cached word families.
     
-    columns = ['Sentence', 'Correct Answer', *[f'Distractor {i}' for i in range(1, setting.DISTRACTOR_COUNT+1)]]
-    data = []
-    for i, word_family in enumerate(word_families):
-        count_per_family = 0
-        for word in word_family.get_shuffled_words():
-            # FIXME: word is '' if inflections not generated correctly
-            if not word:
-                logger.warning(f"Empty word in word family: {repr(word_family)}")
-                continue
-            
+        The cache is keyed by the fingerprint of the code that builds word families, 
+        and each word family in it by the content hash of its input row, 
+        so only the word families whose rows changed are rebuilt.
+    """
+    fingerprint = get_word_cluster_fingerprint()
+    input_hash = get_file_hash(path)
+    logger.info(f"Try loading from cache...")
+    cached = read_from_cache(path, sublist, fingerprint) or {}
+    if cached.get('input_hash') == input_hash:
+        logger.info(f"WordCluster loaded from cache: {path}")
+        return WordCluster.from_families(cached['families'].values())
+    
+    logger.info(f"WordCluster cache not found or outdated, load...")
+    word_cluster, families = load_sublist(path, sublist=sublist, cached_families=cached.get('families'))
+    write_to_cache(path, sublist, {'input_hash': input_hash, 'families': families}, fingerprint)
+    logger.info(f"WordCluster written to cache")
+    return word_cluster
+
+
+def read_word_cluster_cache(path, sublist):
+    """Read the cached WordCluster without checking the input file
+
+    Returns:
+        WordCluster: None if not cached by the current code
+    """
+    cached = read_from_cache(path, sublist, get_word_cluster_fingerprint())
+    if not cached:
+        return None
+    return WordCluster.from_families(cached['families'].values())
+
+
+def main_batch(args):
+    """Generate through the OpenAI Batch API, one phase per invocation:
+        prepare -> submit -> fetch -> ingest-sentences -> submit -> fetch -> ingest-rationality [-> submit ...]
+    """
+    batch_dir = args.dir
+    if args.action == 'submit':
+        batch.submit_batch(args.file)
+        return
+    if args.action == 'fetch':
+        if not batch.download_batch_results(args.batch_id, args.file):
+            logger.info(f"Batch {args.batch_id} is not completed yet")
+        return
+
+    word_cluster = load_word_cluster(input_path, setting.SUBLIST)
+    bot_sent_gen, bot_rational = create_bots()
+    if args.action == 'prepare':
+        word_families = select_word_families(word_cluster, start=setting.KEYWORD_START_POS, max_count=setting.KEYWORD_COUNT)
+        n = batch.prepare_sent_gen_batch(bot_sent_gen, word_families, batch_dir, get_inputs=get_sent_gen_inputs)
+        logger.info(f"{n} sentence generation requests written to {batch.get_requests_path(batch_dir, batch.SENT_GEN)}")
+    elif args.action == 'ingest-sentences':
+        log_data = batch.ingest_sent_gen_results(bot_sent_gen, bot_rational, word_cluster, batch_dir, args.file)
+        write_rows(log_data, log_columns, os.path.join(batch_dir, f'{get_date_str()}-log.xlsx'))
+    elif args.action == 'ingest-rationality':
+        data, log_data = batch.ingest_rational_results(bot_rational, word_cluster, batch_dir, args.file, round_=args.round)
+        fn_data_stream = os.path.join(batch_dir, 'cloze.jsonl')
+        fn_data = os.path.join(batch_dir, 'cloze.xlsx')
+        with StreamWriter(fn_data_stream, columns=columns) as data_writer:
+            data_writer.write_rows(data)
+        export_excel(fn_data_stream, fn_data)
+        write_rows(log_data, log_columns, os.path.join(batch_dir, f'{get_date_str()}-log.xlsx'))
+        logger.info(f"{len(data)} cloze items added to {fn_data}")
+
+
+def main_shard(args):
+    """Generate several sublists in a process pool, sharded by sublist or by range of word families.
+        The distractors are drawn from the word families of all the sublists, each shard writes its own streams,
+        and the shards are merged in order into one output and one log.
+    """
+    run_id = args.resume or new_run_id(lambda run_id: claim_dir(os.path.join('./data/output', f'{run_id}-shards')))
+    shard_dir = os.path.join('./data/output', f'{run_id}-shards')
+    fn_data_stream = f'./data/output/{run_id}-AWL-cloze.jsonl'
+    fn_log_stream = get_log_path(f'./log/excel/{run_id}-log')
+    workers = args.workers or os.cpu_count()
+    logger.info(f"Run id: {run_id}, sublists {args.sublists} in {workers} processes")
+    
+    # spawn: the workers must not inherit the threads and connections of the coordinator
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'), initializer=init_worker) as pool:
+        # Build the word families of each sublist once, the shards read them from the cache
+        family_counts = dict(zip(args.sublists, pool.map(count_word_families, args.sublists)))
+        shards = make_shards(family_counts, families_per_shard=args.families_per_shard)
+        logger.info(f"{len(shards)} shards: {family_counts} word families")
+        n_procs = min(workers, len(shards))
+        futures = [pool.submit(run_shard, run_id, shard, args.sublists, shard_dir, n_procs) for shard in shards]
+        try:
+            for shard, future in zip(shards, futures):
+                logger.info(f"Shard {shard['id']} done: {future.result()} items")
+        except (KeyboardInterrupt, CircuitOpenError) as e:
+            if isinstance(e, CircuitOpenError):
+                logger.error(f"Shard {shard['id']} stopped by the circuit breaker: {e}")
+            else:
+                logger.warning(f"Interrupted, the shards save their finished items...")
+            pool.shutdown(cancel_futures=True)
+            logger.warning(f"Resume with: python main.py --resume {run_id} shard --sublists {' '.join(map(str, args.sublists))} "
+                           f"--families-per-shard {args.families_per_shard}")
+            exit(1 if isinstance(e, CircuitOpenError) else 130)
+    
+    for shard in shards:
+        fn_metrics = os.path.join(shard_dir, f"{run_id}-{shard['id']}-metrics.json")
+        if os.path.exists(fn_metrics):
+            with open(fn_metrics, encoding='utf-8') as f:
+                metrics.merge(json.load(f))
+    write_metrics(run_id, workers=workers, shards=len(shards))
+    
+    paths = [get_shard_paths(shard_dir, shard) for shard in shards]
+    n_items = merge_streams([p[0] for p in paths], fn_data_stream, columns)
+    merge_streams([p[1] for p in paths], fn_log_stream, log_columns)
+    export_excel(fn_data_stream, get_stream_stem(fn_data_stream) + '.xlsx')
+    export_excel(fn_log_stream, get_stream_stem(fn_log_stream) + '.xlsx')
+    logger.info(f"Done. {n_items} items merged into {fn_data_stream}")
+
+
+def init_worker():
+    setup_randomness()
+    setup_log(need_file=False)
+
+
+def count_word_families(sublist):
+    return len(load_word_cluster(input_path, sublist).word_family_list)
+
+
+def run_shard(run_id, shard, sublists, shard_dir, n_procs=1):
+    """Generate the word families of a shard in a worker process, resumable by its own checkpoint
+
+    Args:
+        shard (dict): {"id": ..., "sublist": ..., "start": ..., "count": ...}, see make_shards()
+        sublists (list): the sublists whose word families make the distractor pool
+        n_procs (int, optional): the number of processes sharing the rate limits. Defaults to 1.
+
+    Returns:
+        int: the number of cloze items generated
+    """
+    # The worker process is reused by the next shards
+    metrics.reset()
+    clusters = {sublist: load_word_cluster(input_path, sublist) for sublist in sublists}
+    word_cluster = WordCluster.from_families([wf for sublist in sorted(clusters) for wf in clusters[sublist].word_family_list])
+    word_families = select_word_families(clusters[shard['sublist']], start=shard['start'], max_count=shard['count'])
+    
+    checkpoint = Checkpoint(f"{run_id}-{shard['id']}", meta={**shard, "settings": get_run_settings(setting)})
+    resume_run_settings(checkpoint.meta)
+    word_families = [wf for wf in word_families if not checkpoint.is_finished(Checkpoint.get_key(wf))]
+    cache = ResponseCache() if setting.RESPONSE_CACHE_ENABLED else None
+    bot_sent_gen, bot_rational = create_bots(cache=cache, batched=setting.SENT_GEN_BATCH_SIZE > 1)
+    # The account limits are shared by the processes
+    limiter = RateLimiter(rpm=setting.RATE_LIMIT_RPM // n_procs, tpm=setting.RATE_LIMIT_TPM // n_procs, 
+                          max_concurrency=max(1, setting.RATE_LIMIT_MAX_CONCURRENCY // n_procs))
+    for bot in (bot_sent_gen, bot_rational):
+        bot.limiter = limiter
+    
+    fn_data_stream, fn_log_stream = get_shard_paths(shard_dir, shard)
+    n_items = 0
+    with StreamWriter(fn_data_stream, columns=columns) as data_writer, \
+         open_stream_writer(fn_log_stream, columns=log_columns) as log_writer:
+        def flush(word_family, result: FamilyResult):
+            nonlocal n_items
+            n_items += len(result.rows)
+            flush_result(word_family, result, data_writer, log_writer, checkpoint=checkpoint)
+        
+        results = [FamilyResult() for _ in word_families]
+        try:
+            if setting.ASYNC_MODE:
+                asyncio.run(agenerate(bot_sent_gen, bot_rational, word_cluster, word_families, results, 
+                                      checkpoint=checkpoint, ranker=create_ranker(word_cluster), on_family_done=flush))
+            else:
+                generate(bot_sent_gen, bot_rational, word_cluster, word_families, results, 
+                         checkpoint=checkpoint, ranker=create_ranker(word_cluster), on_family_done=flush)
+        except (KeyboardInterrupt, CircuitOpenError):
+            # Save the finished items of the unfinished word families, the shard is resumed by its checkpoint
+            for word_family, result in zip(word_families, results):
+                flush(word_family, result)
+            raise
+        finally:
+            checkpoint.close()
+            metrics.write(f"{run_id}-{shard['id']}", path=shard_dir)
+            if cache:
+                cache.close()
+    return n_items
+
+
+def main_replay(args):
+    """Re-run a recorded run on the responses in its log with the current parsers and validators, 
+        without network, and compare the cloze items with the original ones
+    """
+    if Checkpoint.exists(args.run_id):
+        checkpoint = Checkpoint(args.run_id)
+        meta = checkpoint.meta
+        checkpoint.close()
+        apply_run_settings(setting, meta.get('settings', {}))
+    elif args.log:
+        # A run older than the checkpoints, replayed with the current settings and the word families given by the arguments
+        logger.warning(f"No checkpoint found for run '{args.run_id}', replay its log with the current settings")
+        meta = {}
+    else:
+        logger.error(f"No checkpoint found for run '{args.run_id}', give its log with --log")
+        exit(-1)
+    sublist = args.sublist if args.sublist is not None else meta.get('sublist', setting.SUBLIST)
+    start = args.start if args.start is not None else meta.get('start', setting.KEYWORD_START_POS)
+    count = args.count if args.count is not None else meta.get('count', setting.KEYWORD_COUNT)
+    
+    bot_sent_gen, bot_rational = create_bots(batched=setting.SENT_GEN_BATCH_SIZE > 1)
+    backend = ReplayBackend(load_recorded_responses(args.log or meta['fn_log_stream'], 
+                                                    parsers=[bot_sent_gen.parser, bot_rational.parser]))
+    word_cluster = load_word_cluster(input_path, sublist)
+    word_families = select_word_families(word_cluster, start=start, max_count=count)
+    # Nothing goes to the network, no need to pace the requests,
+    #   and the prompts not recorded must not stop the replay
+    limiter = RateLimiter(rpm=10**9, tpm=10**12)
+    retry = RetryPolicy(breaker=CircuitBreaker(threshold=0))
+    for bot in (bot_sent_gen, bot_rational):
+        bot.backend = backend
+        bot.limiter = limiter
+        bot.retry = retry
+    
+    prefix = os.path.join(args.dir, f'{args.run_id}-replay-{get_date_str()}')
+    results = [FamilyResult() for _ in word_families]
+    with StreamWriter(f'{prefix}-cloze.jsonl', columns=columns) as data_writer, \
+         open_stream_writer(get_log_path(f'{prefix}-log'), columns=log_columns) as log_writer:
+        def flush(word_family, result: FamilyResult):
+            flush_result(word_family, result, data_writer, log_writer)
+        generate(bot_sent_gen, bot_rational, word_cluster, word_families, results, 
+                 ranker=create_ranker(word_cluster), on_family_done=flush)
+    
+    logger.info(f"Replayed {backend.calls} requests: {backend.hits} responses served from the log, {backend.misses} prompts not recorded")
+    fn_original = args.data or meta.get('fn_data_stream')
+    if not fn_original:
+        logger.info(f"Replayed items saved to {prefix}-cloze.jsonl, give the items of the run with --data to compare them")
+        return
+    _, original = read_stream(fn_original)
+    _, replayed = read_stream(f'{prefix}-cloze.jsonl')
+    diff = diff_items(list(original), list(replayed))
+    write_rows(diff, ['Keyword', 'Change', 'Original Sentence', 'Replayed Sentence', 'Original Distractors', 'Replayed Distractors'], 
+               f'{prefix}-diff.xlsx')
+    counts = {change: sum(1 for row in diff if row[1] == change) for change in ('same', 'changed', 'added', 'removed')}
+    logger.info(f"Items compared with the original run: {counts}, see {prefix}-diff.xlsx")
+
+
+def main_import_logs(args):
+    """Put the valid responses in the logs of past runs into the response cache, 
+        so that the new runs do not pay for the same requests again
+    """
+    cache = ResponseCache()
+    bot_sent_gen, bot_rational = create_bots()
+    for bot in (bot_sent_gen, bot_rational):
+        # The sentence generation responses are imported even if setting.CACHE_SENT_GEN is off
+        bot.cache = cache
+        bot.model = args.model
+    variants = {}
+    for path in sorted(args.files):
+        counts = import_log(path, bot_sent_gen, bot_rational, variants=variants)
+        logger.info(f"Imported from {path}: {counts}")
+    logger.info(f"Response cache: {len(cache)} responses")
+    if not setting.CACHE_SENT_GEN:
+        logger.info(f"Set CACHE_SENT_GEN = True to use the imported sentence generation responses")
+    cache.close()
+
+
+def main_inspect(args):
+    """Print the summary of a cached WordCluster
+    """
+    word_cluster = read_word_cluster_cache(input_path, args.sublist)
+    if not word_cluster:
+        logger.error(f"No cached WordCluster for sublist {args.sublist}")
+        return
+    print(f"Word families: {word_cluster.word_family_size}")
+    print(f"Tags: {word_cluster.tag_size}")
+    for tag, words in sorted(word_cluster.tag_to_words.items()):
+        print(f"  {tag}: {len(words)} words")
+    if args.verbose:
+        for wf in word_cluster.word_family_list:
+            print(f"{repr(wf)}: " + ", ".join(repr(w) for w in sorted(wf.all_words, key=repr)))
+
+
+def main_export(args):
+    """Convert a stream file (.jsonl/.csv) or the run log (.jsonl.gz) of a run into an Excel file
+    """
+    fn_excel = args.output or get_stream_stem(args.file) + '.xlsx'
+    export_excel(args.file, fn_excel)
+    logger.info(f"Exported {args.file} to {fn_excel}")
+
+
+def generate(bot_sent_gen, bot_rational, word_cluster, word_families, results, checkpoint=None, ranker=None, on_family_done=None):
+    """Process the word families one by one, on_family_done(word_family, result) is called after each of them.
+        With setting.SENT_GEN_BATCH_SIZE > 1, the word families are processed in groups that share the sentence generation requests.
+    """
+    n_total = len(word_families)
+    if setting.SENT_GEN_BATCH_SIZE > 1:
+        logger.info(f"Batched mode: generate the sentences of up to {setting.SENT_GEN_BATCH_SIZE} words in one request")
+        # All the groups run in one event loop, which the async client and its connections are bound to
+        asyncio.run(agenerate_groups(bot_sent_gen, bot_rational, word_cluster, word_families, results, 
+                                     checkpoint=checkpoint, ranker=ranker, on_family_done=on_family_done))
+        return
+    
+    for i, (word_family, result) in enumerate(zip(word_families, results)):
+        with span("word family", correlation_id=repr(word_family)):
+            generate_word_family(bot_sent_gen, bot_rational, word_cluster, word_family, result, 
+                                 checkpoint=checkpoint, ranker=ranker, progress=f"{i+1}/{n_total}")
+        if on_family_done:
+            on_family_done(word_family, result)
+        # End of word family loop
+
+
+async def agenerate_groups(bot_sent_gen, bot_rational, word_cluster, word_families, results, checkpoint=None, ranker=None, on_family_done=None):
+    """Process the groups of word families of the batched mode one by one, for generate()
+    """
+    n_total = len(word_families)
+    group_size = get_family_group_size()
+    for i in range(0, n_total, group_size):
+        group, group_results = word_families[i:i+group_size], results[i:i+group_size]
+        with span("word family group", correlation_id=", ".join(map(repr, group))):
+            await agenerate_word_families_batched(bot_sent_gen, bot_rational, word_cluster, group, group_results, 
+                                                  checkpoint=checkpoint, ranker=ranker, progress=f"{i+1}-{i+len(group)}/{n_total}")
+        if on_family_done:
+            for word_family, result in zip(group, group_results):
+                on_family_done(word_family, result)
+
+
+class Call:
+    """A call in the steps shared by the serial and the async generation, which yield it to get its result:
+        func(*args, **kwargs) is run by run_steps(), await afunc(*args, **kwargs) by arun_steps().
+        Without afunc, func is run in a worker thread in the async mode, off the event loop.
+    """
+    def __init__(self, func, afunc, *args, **kwargs) -> None:
+        self.func = func
+        self.afunc = afunc
+        self.args = args
+        self.kwargs = kwargs
+
+
+def run_steps(steps):
+    """Run the steps (a generator of Call) by calling each call
+
+    Returns:
+        the return value of the steps
+    """
+    value, error = None, None
+    while True:
+        try:
+            call = steps.throw(error) if error else steps.send(value)
+        except StopIteration as e:
+            return e.value
+        try:
+            value, error = call.func(*call.args, **call.kwargs), None
+        except BaseException as e:
+            # Raised in the steps, so that their spans are closed
+            value, error = None, e
+
+
+async def arun_steps(steps):
+    """Async version of run_steps(), each call is awaited
+    """
+    value, error = None, None
+    while True:
+        try:
+            call = steps.throw(error) if error else steps.send(value)
+        except StopIteration as e:
+            return e.value
+        try:
+            if call.afunc:
+                value = await call.afunc(*call.args, **call.kwargs)
+            else:
+                value = await asyncio.to_thread(call.func, *call.args, **call.kwargs)
+            error = None
+        except BaseException as e:
+            value, error = None, e
+
+
+def generate_word_family(bot_sent_gen, bot_rational, word_cluster, word_family, result: FamilyResult, checkpoint=None, ranker=None, progress=""):
+    """Generate cloze questions for the words in a word family.
+        The rows of [clozed_sentence, keyword, *distractors], the log rows and the word states 
+        are added to result as soon as each word is finished.
+    """
+    run_steps(word_family_steps(bot_sent_gen, bot_rational, word_cluster, word_family, result, 
+                                checkpoint=checkpoint, ranker=ranker, progress=progress))
+
+
+async def agenerate_word_family(bot_sent_gen, bot_rational, word_cluster, word_family, result: FamilyResult, checkpoint=None, ranker=None, progress=""):
+    """Async version of generate_word_family()
+    """
+    await arun_steps(word_family_steps(bot_sent_gen, bot_rational, word_cluster, word_family, result, 
+                                       checkpoint=checkpoint, ranker=ranker, progress=progress))
+
+
+def word_family_steps(bot_sent_gen, bot_rational, word_cluster, word_family, result: FamilyResult, checkpoint=None, ranker=None, progress=""):
+    """The steps of generate_word_family() and agenerate_word_family(), see run_steps()
+    """
+    rng = get_rng(repr(word_family))
+    count_per_family = 0
+    for word in word_family.get_shuffled_words(rng=rng):
+        if count_per_family >= setting.WORD_PER_FAMILY:
+            # Successfully generated enough number of words for this word family,
+            #  break the word loop, goto next word family
+            break
+        # FIXME: word is '' if inflections not generated correctly
+        if not word:
+            logger.warning(f"Empty word in word family: {repr(word_family)}")
+            continue
+        
+        state = start_word(checkpoint, word_family, word)
+        if state == DONE:
+            count_per_family += 1
+        if state:
+            continue
+        
+        with span("word", correlation_id=Checkpoint.get_key(word_family, word), word=word.surface, tag=word.tag):
             keyword = word.surface
             keyword_tag = word.tag
-            
+        
             clozed_sentence = None
-            for trial in range(setting.RETRY_COUNT_FOR_SINGLE_WORD):
-                # print(f"{repr(w)}: {candidates}")
-                r = bot_sent_gen.run(inputs={"word": keyword, "tag": keyword_tag, "domain": setting.DOMAIN, "level_start": setting.LEVEL_START, "level_end": setting.LEVEL_END})
-                suc = r.get('success')
-                log_data.append([get_date_str(), bot_sent_gen.task_name, keyword, keyword_tag, r.get('prompt'), r.get('raw_response'), r.get('result'), suc])
-                
-                if suc:
-                    clozed_sentence = r.get('result')
-                    sentence = fill_cloze(clozed_sentence, keyword)
-
-                    suc = pos_check(inputs={"word": keyword, "tag": keyword_tag, "sentence": sentence})
-                    log_data.append([get_date_str(), "POS Check", keyword, keyword_tag, f"Tag: {keyword_tag}, Sentence: {sentence}", "-", "-", suc])
-                
-                if suc:
-                    break
-                
+            # A response that fails to parse or to pass the POS check is retried with a new variant, 
+            #   a failed request comes back as a failed result after its own retries (see MyBotWrapper.run())
+            for trial in range(bot_sent_gen.retry.get_attempts(PARSE)):
+                with span("sentence generation trial", trial=trial):
+                    if setting.SENT_GEN_N_CHOICES > 1:
+                        rs = yield Call(bot_sent_gen.run_multi, bot_sent_gen.arun_multi, 
+                                        inputs=get_sent_gen_inputs(word), n=setting.SENT_GEN_N_CHOICES, variant=trial)
+                        clozed_sentence = yield Call(choose_sentence, None, bot_sent_gen, word, rs, log_data=result.log_data)
+                        suc = clozed_sentence is not None
+                        if suc:
+                            break
+                        continue
+            
+                    # print(f"{repr(w)}: {candidates}")
+                    r = yield Call(bot_sent_gen.run, bot_sent_gen.arun, inputs=get_sent_gen_inputs(word), variant=trial)
+                    suc = r.get('success')
+                    result.log_data.append([get_date_str(), bot_sent_gen.task_name, keyword, keyword_tag, r.get('prompt_ref', r.get('prompt')), r.get('raw_response'), r.get('result'), suc])
+            
+                    if suc:
+                        clozed_sentence = r.get('result')
+                        suc = yield Call(check_pos, acheck_pos, word, clozed_sentence, log_data=result.log_data)
+            
+                    if suc:
+                        break
+            
             if not suc:
                 logger.error(f"Failed to generate sentence for '{repr(word)}'")
+                result.word_states[Checkpoint.get_key(word_family, word)] = FAILED
+                continue
+
+            # Successfully generated a sentence, now generate distractors
+            distractors = yield Call(fill_distractors, afill_distractors, bot_rational, word_cluster, word, clozed_sentence, 
+                                     n_distractors=setting.TEST_DISTRACTOR_COUNT, log_data=result.log_data, 
+                                     rng=get_rng(Checkpoint.get_key(word_family, word)), ranker=ranker)
+            if add_item(result, word_family, word, clozed_sentence, distractors, progress=progress):
+                count_per_family += 1
+        # End of word loop
+    result.complete = True
+
+
+async def agenerate_word_families_batched(bot_sent_gen, bot_rational, word_cluster, word_families, results, checkpoint=None, ranker=None, progress=""):
+    """Generate cloze questions for several word families, with the sentences of 
+        up to setting.SENT_GEN_BATCH_SIZE words generated in one request (bot_sent_gen with BatchSentGenParser).
+        The words whose sentences fail are re-queued into the next round, 
+        and a word family takes its next word when one of its words fails for good.
+    """
+    queues = [FamilyQueue(wf, result, checkpoint=checkpoint, max_trials=bot_sent_gen.retry.get_attempts(PARSE)) 
+              for wf, result in zip(word_families, results)]
+    round_ = 0
+    while True:
+        pending = [(q, word) for q in queues for word in q.next_words()]
+        if not pending:
+            break
+        
+        item_results = []
+        for chunk in split_batch(pending, setting.SENT_GEN_BATCH_SIZE):
+            with span("sentence generation trial", trial=round_, words=len(chunk)):
+                item_results += await arequest_sentences(bot_sent_gen, chunk, variant=round_)
+        
+        # POS check the valid sentences all at once
+        valid = [(q, word, r.get('result')) for (q, word), r in zip(pending, item_results) if r.get('success')]
+        pos_results = await apos_check_batch([{"word": word.surface, "tag": word.tag, "sentence": fill_cloze(clozed_sentence, word.surface)} 
+                                              for q, word, clozed_sentence in valid])
+        passed = set()
+        for (q, word, clozed_sentence), suc in zip(valid, pos_results):
+            q.result.log_data.append([get_date_str(), "POS Check", word.surface, word.tag, 
+                                      f"Tag: {word.tag}, Sentence: {fill_cloze(clozed_sentence, word.surface)}", "-", "-", suc])
+            if suc:
+                passed.add((id(q), word))
+        
+        items = [(q, word, clozed_sentence) for q, word, clozed_sentence in valid if (id(q), word) in passed]
+        if setting.RATIONAL_BATCH_SIZE > 1:
+            # The distractors of all the items in this round are tested together
+            tasks = [DistractorTask(word_cluster, word, clozed_sentence, log_data=q.result.log_data, 
+                                    rng=get_rng(Checkpoint.get_key(q.word_family, word))) for q, word, clozed_sentence in items]
+            await afill_distractors_batched(bot_rational, tasks, n_distractors=setting.TEST_DISTRACTOR_COUNT, ranker=ranker)
+            all_distractors = [task.distractors for task in tasks]
+        else:
+            all_distractors = [await afill_distractors(bot_rational, word_cluster, word, clozed_sentence, n_distractors=setting.TEST_DISTRACTOR_COUNT, 
+                                                       log_data=q.result.log_data, rng=get_rng(Checkpoint.get_key(q.word_family, word)), ranker=ranker)
+                               for q, word, clozed_sentence in items]
+        for (q, word, clozed_sentence), distractors in zip(items, all_distractors):
+            q.active.remove(word)
+            if add_item(q.result, q.word_family, word, clozed_sentence, distractors, progress=progress):
+                q.n_done += 1
+        for q, word in pending:
+            if (id(q), word) not in passed:
+                q.retry(word)
+        round_ += 1
+    
+    for result in results:
+        result.complete = True
+
+
+async def arequest_sentences(bot_sent_gen, chunk, variant=0):
+    """Request the sentences of the words in chunk [(FamilyQueue, word), ...] in one request
+
+    Returns:
+        list: {"success": bool, "result": clozed sentence, "raw_response": sentence} of each word in chunk
+    """
+    words = [word for _, word in chunk]
+    r = await bot_sent_gen.arun(inputs=get_batch_sent_gen_inputs(words), variant=variant)
+    # The whole request is logged in the first word family, each word in its own word family
+    chunk[0][0].result.log_data.append([get_date_str(), bot_sent_gen.task_name, ", ".join(w.surface for w in words), ", ".join(w.tag for w in words), 
+                                        r.get('prompt_ref', r.get('prompt')), r.get('raw_response'), r.get('result'), r.get('success')])
+    item_results = []
+    for q, word in chunk:
+        item = r.get('results', {}).get(word.surface) or {"success": False, "result": None, "raw_response": None}
+        q.result.log_data.append([get_date_str(), SentGenParser.task_name, word.surface, word.tag, 
+                                  f"Batched with: {', '.join(w.surface for w in words)}", item.get('raw_response'), item.get('result'), item.get('success')])
+        item_results.append(item)
+    return item_results
+
+
+def split_batch(pending, batch_size):
+    """Split the pending words [(FamilyQueue, word), ...] into chunks of at most batch_size,
+        a chunk never has the same surface twice as the response is keyed by the word
+    """
+    chunks = []
+    for q, word in pending:
+        for chunk in chunks:
+            if len(chunk) < batch_size and all(w.surface != word.surface for _, w in chunk):
+                chunk.append((q, word))
+                break
+        else:
+            chunks.append([(q, word)])
+    return chunks
+
+
+def get_family_group_size():
+    """The number of word families whose words are batched together, enough to fill a sentence generation request
+    """
+    return max(1, setting.SENT_GEN_BATCH_SIZE // setting.WORD_PER_FAMILY)
+
+
+async def agenerate(bot_sent_gen, bot_rational, word_cluster, word_families, results, checkpoint=None, ranker=None, on_family_done=None):
+    """Process the word families concurrently, at most setting.CONCURRENCY at a time.
+        on_family_done(word_family, result) is called in the original order of the word families,
+        so the output is the same as the serial mode.
+        With setting.SENT_GEN_BATCH_SIZE > 1, the word families are processed in groups that share the sentence generation requests.
+    """
+    n_total = len(word_families)
+    semaphore = asyncio.Semaphore(setting.CONCURRENCY)
+    batched = setting.SENT_GEN_BATCH_SIZE > 1
+    group_size = get_family_group_size() if batched else 1
+    
+    async def worker(i, group, group_results):
+        async with semaphore:
+            if batched:
+                with span("word family group", correlation_id=", ".join(map(repr, group))):
+                    await agenerate_word_families_batched(bot_sent_gen, bot_rational, word_cluster, group, group_results, 
+                                                          checkpoint=checkpoint, ranker=ranker, progress=f"{i+1}-{i+len(group)}/{n_total}")
             else:
-                # Successfully generated a sentence, now generate distractors
-                distractors = fill_distractors(bot_rational, word_cluster, word, clozed_sentence,n_distractors=setting.TEST_DISTRACTOR_COUNT, log_data=log_data)
-                
-                if len(distractors) < setting.DISTRACTOR_COUNT:
-                    logger.error(f"Failed to generate enough distractors for '{word}'")
-                else:
-                    data.append([clozed_sentence, keyword, *distractors])
-                    msg = "\n".join([f"{i+1}/{n_total}: " + "-" * 80,
-                            f"Sentence: {clozed_sentence}",
-                            f"Keyword: {keyword}",
-                            "Distractors: " + ", ".join(distractors),])
-                    logger.info(msg)
-                    df = pd.DataFrame(data, columns=columns)
-                    write_data(df, fn_data)
-                    df_log = pd.DataFrame(log_data, columns=log_columns)
-                    write_data(df_log, fn_log)
-                    count_per_family += 1
-                    if count_per_family >= setting.WORD_PER_FAMILY:
-                        # Successfully generated enough number of words for this word family,
-                        #  break the word loop, goto next word family
-                        break
+                with span("word family", correlation_id=repr(group[0])):
+                    await agenerate_word_family(bot_sent_gen, bot_rational, word_cluster, group[0], group_results[0], 
+                                                checkpoint=checkpoint, ranker=ranker, progress=f"{i+1}/{n_total}")
+    
+    groups = [(i, word_families[i:i+group_size], results[i:i+group_size]) for i in range(0, n_total, group_size)]
+    tasks = [asyncio.create_task(worker(i, group, group_results)) for i, group, group_results in groups]
+    try:
+        for (i, group, group_results), task in zip(groups, tasks):
+            await task
+            if on_family_done:
+                for word_family, result in zip(group, group_results):
+                    on_family_done(word_family, result)
+    finally:
+        # After an error (e.g. CircuitOpenError) the other tasks are stopped, and their errors collected
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
-            df_log = pd.DataFrame(log_data, columns=log_columns)
-            write_data(df_log, fn_log)
-            # End of word loop
-        # End of word family loop
+
+def start_word(checkpoint, word_family, word):
+    """Check the word in the checkpoint of a resumed run, and mark it in flight if it is not finished yet
+
+    Returns:
+        str: DONE or FAILED if the word is finished in a previous run, otherwise None
+    """
+    if not checkpoint:
+        return None
+    key = Checkpoint.get_key(word_family, word)
+    if checkpoint.is_finished(key):
+        return checkpoint.get_state(key)
+    checkpoint.mark(key, IN_FLIGHT)
+    return None
+
+
+def get_sent_gen_inputs(word):
+    return {"word": word.surface, "tag": word.tag, "domain": setting.DOMAIN, "level_start": setting.LEVEL_START, "level_end": setting.LEVEL_END}
+
+
+def get_batch_sent_gen_inputs(words):
+    return {"items": [{"word": word.surface, "tag": word.tag} for word in words], 
+            "domain": setting.DOMAIN, "level_start": setting.LEVEL_START, "level_end": setting.LEVEL_END}
+
+
+def check_pos(word, clozed_sentence, log_data=[]):
+    sentence = fill_cloze(clozed_sentence, word.surface)
+    suc = pos_check(inputs={"word": word.surface, "tag": word.tag, "sentence": sentence})
+    log_data.append([get_date_str(), "POS Check", word.surface, word.tag, f"Tag: {word.tag}, Sentence: {sentence}", "-", "-", suc])
+    return suc
+
+
+def choose_sentence(bot_sent_gen, word, results, log_data=[]):
+    """Validate the sentences generated for a word in one batch (keyword position, length, POS tag),
+        and choose the best one with setting.SENT_GEN_SCORER
+
+    Args:
+        results (list): parsed results of the sentence generation
+
+    Returns:
+        str: the chosen clozed sentence, None if none of them is valid
+    """
+    valid = []
+    for r in results:
+        suc = r.get('success')
+        if suc and not setting.SENT_GEN_MIN_WORDS <= count_words(r.get('result')) <= setting.SENT_GEN_MAX_WORDS:
+            logger.warning(f"Sentence length out of range: {r.get('result')}")
+            suc = False
+        log_data.append([get_date_str(), bot_sent_gen.task_name, word.surface, word.tag, r.get('prompt_ref', r.get('prompt')), r.get('raw_response'), r.get('result'), suc])
+        if suc:
+            valid.append(r.get('result'))
+    if not valid:
+        return None
     
-    logger.info(f"Done. Data saved to {fn_data}")
+    sentences = [fill_cloze(clozed_sentence, word.surface) for clozed_sentence in valid]
+    pos_results = pos_check_batch([{"word": word.surface, "tag": word.tag, "sentence": sentence} for sentence in sentences])
+    passed = []
+    for clozed_sentence, sentence, suc in zip(valid, sentences, pos_results):
+        log_data.append([get_date_str(), "POS Check", word.surface, word.tag, f"Tag: {word.tag}, Sentence: {sentence}", "-", "-", suc])
+        if suc:
+            passed.append(clozed_sentence)
+    if not passed:
+        return None
+    scorer = get_scorer(setting.SENT_GEN_SCORER)
+    # max() keeps the first one among the ties
+    return max(passed, key=lambda clozed_sentence: scorer(clozed_sentence, word.surface))
 
 
-def fill_distractors(bot_rational, word_cluster, word, sentence, n_distractors, log_data=[], max_trials=5):
-    excepts = [word]
+async def acheck_pos(word, clozed_sentence, log_data=[]):
+    """Async version of check_pos(), tagging does not block the event loop
+    """
+    sentence = fill_cloze(clozed_sentence, word.surface)
+    suc = await apos_check(inputs={"word": word.surface, "tag": word.tag, "sentence": sentence})
+    log_data.append([get_date_str(), "POS Check", word.surface, word.tag, f"Tag: {word.tag}, Sentence: {sentence}", "-", "-", suc])
+    return suc
+
+
+def add_item(result: FamilyResult, word_family, word, clozed_sentence, distractors, progress=""):
+    """Add a cloze item to result if there are enough distractors
+
+    Returns:
+        bool: whether the item is added
+    """
+    key = Checkpoint.get_key(word_family, word)
+    # Accepted if fill_distractors() found enough distractors
+    metrics.count_result("Fill Distractors", len(distractors) >= setting.DISTRACTOR_COUNT, tag=word.tag)
+    if len(distractors) < setting.DISTRACTOR_COUNT:
+        logger.error(f"Failed to generate enough distractors for '{word}'")
+        result.word_states[key] = FAILED
+        return False
+    result.rows.append([clozed_sentence, word.surface, *distractors])
+    result.word_states[key] = DONE
+    msg = "\n".join([f"{progress}: " + "-" * 80,
+            f"Sentence: {clozed_sentence}",
+            f"Keyword: {word.surface}",
+            "Distractors: " + ", ".join(distractors),])
+    logger.info(msg)
+    return True
+
+
+@timed("Fill Distractors")
+def fill_distractors(bot_rational, word_cluster, word, sentence, n_distractors, log_data=[], max_trials=5, rng=None, ranker=None):
+    return run_steps(fill_distractors_steps(bot_rational, word_cluster, word, sentence, n_distractors, 
+                                            log_data=log_data, max_trials=max_trials, rng=rng, ranker=ranker))
+
+
+@timed("Fill Distractors")
+async def afill_distractors(bot_rational, word_cluster, word, sentence, n_distractors, log_data=[], max_trials=5, rng=None, ranker=None):
+    """Async version of fill_distractors()
+    """
+    return await arun_steps(fill_distractors_steps(bot_rational, word_cluster, word, sentence, n_distractors, 
+                                                   log_data=log_data, max_trials=max_trials, rng=rng, ranker=ranker))
+
+
+def fill_distractors_steps(bot_rational, word_cluster, word, sentence, n_distractors, log_data=[], max_trials=5, rng=None, ranker=None):
+    """The steps of fill_distractors() and afill_distractors(), see run_steps()
+    """
+    # Candidates are drawn without replacement across the trials
+    sampler = word_cluster.distractor_sampler(word.tag, excepts=[word], rng=rng)
+    pool = []
     distractors = []
     for i in range(max_trials):
-        candidates = word_cluster.find_distractors(word.tag, excepts=excepts, n=n_distractors)
-        excepts += candidates
+        if setting.SYNTAX_FILTER:
+            # parsing is CPU-bound, keep it off the event loop in the async mode
+            candidates = yield Call(select_candidates, None, sampler, n_distractors, word, sentence, 
+                                    ranker=ranker, pool=pool, log_data=log_data)
+        else:
+            candidates = select_candidates(sampler, n_distractors, word, sentence, ranker=ranker, pool=pool, log_data=log_data)
         
         if len(candidates) == 0:
             logger.warning(f"No more distractor candidates for '{word}'")
             break
         
-        r = bot_rational.run(inputs={"keyword": word, "candidates": candidates, "sentence": sentence})
-        suc = r.get('success')
-        good_candidates = r.get('good_candidates')
-        log_data.append([get_date_str(), bot_rational.task_name, word.surface, word.tag, r.get('prompt'), r.get('raw_response'), good_candidates, suc])
-        if not suc:
-            logger.error(f"Failed to decide proper distractors for {word}")
-            continue
-        # Make sure the distractors do not exceed the max count
-        distractors += [str(w) for w in good_candidates]
+        with span("distractor trial", trial=i, candidates=len(candidates)):
+            r = yield Call(bot_rational.run, bot_rational.arun, inputs={"keyword": word, "candidates": candidates, "sentence": sentence})
+        distractors, done = collect_distractors(bot_rational, word, r, distractors, trial=i, log_data=log_data)
+        if done:
+            break
+    return distractors
+
+
+@timed("Fill Distractors")
+async def afill_distractors_batched(bot_rational, tasks, n_distractors, max_trials=5, ranker=None):
+    """Collect the distractors of several cloze items, testing the candidates of 
+        up to setting.RATIONAL_BATCH_SIZE items in one request (bot_rational with BatchRationalParser).
+        Each trial draws new candidates for the items that still need distractors, 
+        the distractors are left in task.distractors.
+    """
+    pending = list(tasks)
+    for i in range(max_trials):
+        requests = []
+        for task in pending:
+            if setting.SYNTAX_FILTER:
+                # parsing is CPU-bound, keep it off the event loop
+                candidates = await asyncio.to_thread(select_candidates, task.sampler, n_distractors, task.word, task.sentence, 
+                                                     ranker=ranker, pool=task.pool, log_data=task.log_data)
+            else:
+                candidates = select_candidates(task.sampler, n_distractors, task.word, task.sentence, 
+                                               ranker=ranker, pool=task.pool, log_data=task.log_data)
+            if len(candidates) == 0:
+                logger.warning(f"No more distractor candidates for '{task.word}'")
+                continue
+            requests.append((task, candidates))
+        if not requests:
+            break
         
-        if len(distractors) == setting.DISTRACTOR_COUNT:
+        for chunk in [requests[j:j+setting.RATIONAL_BATCH_SIZE] for j in range(0, len(requests), setting.RATIONAL_BATCH_SIZE)]:
+            with span("distractor trial", trial=i, items=len(chunk)):
+                item_results = await arequest_rationality(bot_rational, chunk)
+            for (task, _), r in zip(chunk, item_results):
+                task.distractors, task.done = collect_distractors(bot_rational, task.word, r, task.distractors, trial=i, log_data=task.log_data)
+        pending = [task for task, _ in requests if not task.done]
+
+
+async def arequest_rationality(bot_rational, chunk):
+    """Test the candidates of the items in chunk [(DistractorTask, candidates), ...] in one request
+
+    Returns:
+        list: the result of each item, in the same format as RationalParser
+    """
+    inputs = {"items": [{"keyword": task.word, "candidates": candidates, "sentence": task.sentence} for task, candidates in chunk]}
+    r = await bot_rational.arun(inputs=inputs)
+    words = [task.word for task, _ in chunk]
+    # The whole request is logged with the first item, each item with its own result
+    chunk[0][0].log_data.append([get_date_str(), bot_rational.task_name, ", ".join(w.surface for w in words), ", ".join(w.tag for w in words), 
+                                 r.get('prompt_ref', r.get('prompt')), r.get('raw_response'), r.get('result'), r.get('success')])
+    results = r.get('results') or []
+    item_results = []
+    for i, (task, _) in enumerate(chunk):
+        item = results[i] if i < len(results) else {"success": False}
+        item_results.append({**item, "prompt": f"Batched with: {', '.join(w.surface for w in words)}", "raw_response": item.get('result')})
+    return item_results
+
+
+@timed("Find Distractors")
+def draw_candidates(sampler, n, ranker=None, word=None, sentence=None, pool=None):
+    """Draw n distractor candidates. With a ranker, more candidates are drawn and the best n are chosen, 
+        the rest stay in pool for the following trials.
+    """
+    if not ranker:
+        return sampler.draw(n)
+    pool.extend(sampler.draw(n * setting.EMBEDDING_OVERSAMPLE - len(pool)))
+    ranked = ranker.rank(word, sentence, pool)
+    pool[:] = ranked[n:]
+    return ranked[:n]
+
+
+def select_candidates(sampler, n, word, sentence, ranker=None, pool=None, log_data=[]):
+    """Draw n distractor candidates for the rationality test. 
+        With setting.SYNTAX_FILTER, the candidates that break the parse of the sentence are dropped 
+        and more are drawn, up to setting.SYNTAX_FILTER_MAX_DRAWS times.
+    """
+    if not setting.SYNTAX_FILTER:
+        return draw_candidates(sampler, n, ranker=ranker, word=word, sentence=sentence, pool=pool)
+    candidates = []
+    for _ in range(setting.SYNTAX_FILTER_MAX_DRAWS):
+        drawn = draw_candidates(sampler, n - len(candidates), ranker=ranker, word=word, sentence=sentence, pool=pool)
+        if not drawn:
             break
-        elif len(distractors) > setting.DISTRACTOR_COUNT:
-            distractors = distractors[:setting.DISTRACTOR_COUNT]
+        kept, dropped = syntax_filter(word, sentence, drawn)
+        log_data.append([get_date_str(), "Syntax Filter", word.surface, word.tag, f"Sentence: {sentence}, Candidates: {drawn}", "-", kept, len(kept) > 0])
+        if dropped:
+            logger.debug(f"Candidates dropped by syntax filter for '{word}': {dropped}")
+        candidates += kept
+        if len(candidates) >= n:
             break
-        else:
-            logger.debug(f"Trial {i}: {len(distractors)} distractors collected in total.")
-    return distractors
+    return candidates
 
 
-def load_sublist(path, sublist=1, max_count=-1):
+def collect_distractors(bot_rational, word, r, distractors, trial=0, log_data=[]):
+    """Add the good candidates in the rationality test result to distractors
+
+    Returns:
+        (list, bool): the distractors, and whether enough distractors are collected
+    """
+    suc = r.get('success')
+    good_candidates = r.get('good_candidates')
+    log_data.append([get_date_str(), bot_rational.task_name, word.surface, word.tag, r.get('prompt_ref', r.get('prompt')), r.get('raw_response'), good_candidates, suc])
+    if not suc:
+        logger.error(f"Failed to decide proper distractors for {word}")
+        return distractors, False
+    # Make sure the distractors do not exceed the max count
+    distractors = distractors + [str(w) for w in good_candidates]
+    
+    if len(distractors) == setting.DISTRACTOR_COUNT:
+        return distractors, True
+    elif len(distractors) > setting.DISTRACTOR_COUNT:
+        return distractors[:setting.DISTRACTOR_COUNT], True
+    else:
+        logger.debug(f"Trial {trial}: {len(distractors)} distractors collected in total.")
+        return distractors, False
+
+
+@traced("Load Sublist")
+def load_sublist(path, sublist=1, max_count=-1, cached_families=None):
     """Load a sublist from a file as a WordCluster object
+
+    Args:
+        cached_families (dict, optional): content hash of a row -> WordFamily built before,
+            reused if the row is not changed
+
+    Returns:
+        (WordCluster, dict): the WordCluster, and the content hash of each row -> WordFamily
     """
+    cached_families = cached_families or {}
     df = read_data(path=path)
     df = df[df['Sublist'] == sublist]
     df = df.astype({'Headword': 'str', 'Related word forms': 'str'})
     wc = WordCluster()
+    families = {}
+    n_reused = 0
     for i, row in df.iterrows():
         headword = row['Headword']
-        logger.info(f"Processing word family for '{headword}'")
         # related_words = row['Related word forms'].split(',')
         # Do not derive for now
         related_words = []
-        wc.add_item(headword, related_words)
+        key = get_content_hash([headword, related_words])
+        if key in cached_families:
+            wf = cached_families[key]
+            wc.add_family(wf)
+            n_reused += 1
+        else:
+            logger.info(f"Processing word family for '{headword}'")
+            wf = wc.add_item(headword, related_words)
+        families[key] = wf
         if max_count > 0 and i >= max_count:
             break
+    logger.info(f"{len(families) - n_reused} word families built, {n_reused} reused from cache")
     logger.debug("Shape of data: {}\n{}".format(df.shape, df.head()))
     # wc.print()
-    return wc
+    return wc, families
 
 
 def select_word_families(word_cluster: WordCluster, start=0, max_count=-1) -> list[WordFamily]:
@@ -168,8 +1161,101 @@ def select_word_families(word_cluster: WordCluster, start=0, max_count=-1) -> li
     return word_families
 ################################
 
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate multiple choice cloze tests")
+    parser.add_argument('--resume', metavar='RUN_ID', help="resume an interrupted run")
+    parser.add_argument('--profile', action='store_true', 
+                        help=f"profile the command with cProfile and trace its spans, written to {setting.PROFILE_DIR}")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('run', help="generate cloze questions (default)")
+    
+    parser_batch = subparsers.add_parser('batch', help="generate cloze questions through the OpenAI Batch API")
+    parser_batch.add_argument('action', choices=['prepare', 'submit', 'fetch', 'ingest-sentences', 'ingest-rationality'])
+    parser_batch.add_argument('--dir', default=os.path.join(setting.BATCH_DIR, f"AWL-sublist-{setting.SUBLIST}"),
+                              help="directory of the batch input files and manifests")
+    parser_batch.add_argument('--file', help="batch input file to submit, or batch result file to fetch into / ingest")
+    parser_batch.add_argument('--batch-id', help="batch id to fetch")
+    parser_batch.add_argument('--round', type=int, help="rationality round to ingest, defaults to the latest one")
+    
+    parser_shard = subparsers.add_parser('shard', help="generate several sublists in parallel processes and merge the outputs")
+    parser_shard.add_argument('--sublists', type=int, nargs='+', default=list(range(1, 11)), help="sublists to generate")
+    parser_shard.add_argument('--families-per-shard', type=int, default=0, 
+                              help="split the sublists into shards of this many word families, 0 for one shard per sublist")
+    parser_shard.add_argument('--workers', type=int, default=0, help="the number of processes, defaults to the number of CPUs")
+    
+    parser_replay = subparsers.add_parser('replay', help="re-run a recorded run on its logged responses with the current parsers, without network")
+    parser_replay.add_argument('run_id', help="the run to replay")
+    parser_replay.add_argument('--log', help="log of the run, defaults to the one in its checkpoint, required for a run without checkpoint")
+    parser_replay.add_argument('--data', help="cloze items of the run to compare with, defaults to the one in its checkpoint")
+    parser_replay.add_argument('--sublist', type=int, help="sublist of the run, defaults to the one in its checkpoint or setting.SUBLIST")
+    parser_replay.add_argument('--start', type=int, help="first word family of the run, defaults to the one in its checkpoint or setting.KEYWORD_START_POS")
+    parser_replay.add_argument('--count', type=int, help="the number of word families of the run, defaults to the one in its checkpoint or setting.KEYWORD_COUNT")
+    parser_replay.add_argument('--dir', default='./data/replay', help="directory of the replayed items, log and diff")
+    
+    parser_import = subparsers.add_parser('import-logs', help="load the responses in the logs of past runs into the response cache")
+    parser_import.add_argument('files', nargs='+', help="log files of the runs (.xlsx/.jsonl/.csv)")
+    parser_import.add_argument('--model', default=setting.DEFAULT_MODEL, help="the model the runs used")
+    
+    parser_inspect = subparsers.add_parser('inspect', help="print the summary of a cached WordCluster")
+    parser_inspect.add_argument('--sublist', type=int, default=setting.SUBLIST)
+    parser_inspect.add_argument('-v', '--verbose', action='store_true', help="list the words of each word family")
+    
+    parser_export = subparsers.add_parser('export', help="export the cloze items or log of a run into an Excel file")
+    parser_export.add_argument('file', help="stream file (.jsonl/.csv) or run log (.jsonl.gz) of a run")
+    parser_export.add_argument('--output', help="Excel file, defaults to the stream file with .xlsx extension")
+    return parser.parse_args()
+
+    
+def run_command(args):
+    if args.command == 'batch':
+        main_batch(args)
+    elif args.command == 'shard':
+        main_shard(args)
+    elif args.command == 'replay':
+        main_replay(args)
+    elif args.command == 'import-logs':
+        main_import_logs(args)
+    elif args.command == 'inspect':
+        main_inspect(args)
+    elif args.command == 'export':
+        main_export(args)
+    else:
+        main(run_id=args.resume)
+
+
+def run_profiled(args):
+    """Run the command with cProfile and span tracing, and write to setting.PROFILE_DIR:
+        <date>-<command>.prof (for snakeviz/pstats), <date>-<command>.txt (the top functions) 
+        and <date>-<command>-trace.json (spans for chrome://tracing or Perfetto)
+    """
+    import cProfile
+    import io
+    import pstats
+    prefix = os.path.join(setting.PROFILE_DIR, f"{get_date_str()}-{args.command or 'run'}")
+    os.makedirs(setting.PROFILE_DIR, exist_ok=True)
+    profiler = cProfile.Profile()
+    tracer.start()
+    try:
+        profiler.runcall(run_command, args)
+    finally:
+        tracer.stop()
+        profiler.dump_stats(f'{prefix}.prof')
+        tracer.write(f'{prefix}-trace.json')
+        text = io.StringIO()
+        stats = pstats.Stats(profiler, stream=text)
+        for key in ('cumulative', 'tottime'):
+            stats.sort_stats(key).print_stats(setting.PROFILE_TOP_N)
+        with open(f'{prefix}.txt', 'w', encoding='utf-8') as f:
+            f.write(text.getvalue())
+        logger.info(f"Profile saved to {prefix}.prof/.txt, trace to {prefix}-trace.json")
+
     
 if __name__ == '__main__':
+    args = parse_args()
     setup_randomness()
     setup_log()
-    main()
+    if args.profile:
+        run_profiled(args)
+    else:
+        run_command(args)
@@ -4,9 +4,21 @@ DEBUG = False
 DEFAULT_LOG_LEVEL = "INFO"
 # DEFAULT_LOG_LEVEL = "DEBUG"
 
+# Use the fake backend, same as LLM_BACKEND = 'fake'
 # OFFLINE_CHATGPT = True
 OFFLINE_CHATGPT = False
 
+# Where the chat completion requests go: 'openai' | 'fake' (local responses made from the prompts, see lib/backend.py)
+LLM_BACKEND = 'openai'
+# LLM_BACKEND = 'fake'
+# Latency of the fake backend: 'constant' (secs,) | 'uniform' (low, high) | 'lognormal' (median, sigma)
+FAKE_LATENCY_DIST = 'lognormal'
+FAKE_LATENCY_PARAMS = (0.8, 0.5)
+# Ratios of the fake requests failing with a server error / a rate limit error (429), and of the malformed responses
+FAKE_ERROR_RATE = 0.0
+FAKE_RATE_LIMIT_RATE = 0.0
+FAKE_MALFORMED_RATE = 0.0
+
 # DEFAULT_MODEL = 'gpt-3.5-turbo-0301'
 # DEFAULT_MODEL = 'gpt-3.5-turbo'
 # DEFAULT_MODEL = 'gpt-4'
@@ -35,7 +47,148 @@ TEST_DISTRACTOR_COUNT = 10 # The number of distractors to ask ChatGPT to test ra
 DISTRACTOR_COUNT = 3 # The number of distractors to output to result
 
 # Fix the randomness, -1 means random
-#   seems not working
 RANDOM_SEED = 42
 # RANDOM_SEED = -1
 
+
+# Process word families concurrently with the async OpenAI client
+# ASYNC_MODE = True
+ASYNC_MODE = False
+# The max number of word families processed at the same time in async mode
+CONCURRENCY = 5
+
+# Cache the LLM responses on disk, so that reruns do not pay for the same prompts again
+RESPONSE_CACHE_ENABLED = True
+RESPONSE_CACHE_PATH = './cache/responses.sqlite'
+RESPONSE_CACHE_MAX_SIZE_MB = 500
+# The rationality test (temperature 0) is always cached,
+#   sentence generation (temperature 0.9) is cached only if enabled here
+# CACHE_SENT_GEN = True
+CACHE_SENT_GEN = False
+
+# The number of words in each word family sent to the Batch API for sentence generation, -1 means all
+BATCH_WORDS_PER_FAMILY = 4
+BATCH_DIR = './data/batch'
+
+# Account rate limits shared by all requests in the process
+RATE_LIMIT_RPM = 500
+RATE_LIMIT_TPM = 300000
+# The max number of requests in flight, shrinks on 429 and grows back on success
+RATE_LIMIT_MAX_CONCURRENCY = 16
+# Estimated completion tokens counted against the TPM limit
+RATE_LIMIT_COMPLETION_TOKENS = 200
+# A request slower than this factor times the fastest one is a sign of overload
+RATE_LIMIT_SLOW_FACTOR = 3
+
+# The progress of each run is kept here, to resume an interrupted run with `python main.py --resume <run-id>`
+CHECKPOINT_DIR = './data/checkpoint'
+
+# The number of sentences tagged together by spaCy in a POS check
+POS_CHECK_BATCH_SIZE = 64
+# The number of worker processes for POS checks, 1 means tagging in the current process
+POS_CHECK_N_PROCESS = 1
+
+# Bump to invalidate the cached WordCluster when the way word families are built changes
+#   outside of lib/inflections.py and lib/word_cluster.py (which are fingerprinted automatically)
+WORD_CLUSTER_CACHE_VERSION = 1
+
+# Pre-rank distractor candidates with local word vectors before asking ChatGPT, None to disable
+#   word2vec/GloVe text file (.txt/.vec) or .npz with "words" and "vectors"
+# EMBEDDING_PATH = './data/vectors/glove.6B.300d.txt'
+EMBEDDING_PATH = None
+# The number of candidates drawn for ranking, as a multiple of TEST_DISTRACTOR_COUNT
+EMBEDDING_OVERSAMPLE = 3
+# score = keyword_weight * sim(candidate, keyword) - context_weight * sim(candidate, sentence)
+EMBEDDING_KEYWORD_WEIGHT = 1.0
+EMBEDDING_CONTEXT_WEIGHT = 1.0
+# Candidates more similar than this to the keyword are treated as synonyms and ranked last
+EMBEDDING_SYNONYM_THRESHOLD = 0.7
+
+# Drop distractor candidates that break the parse of the sentence before asking ChatGPT,
+#   loads a second spaCy pipeline with the parser (get_nlp_parser()) besides the tagger-only one
+SYNTAX_FILTER = False
+# SYNTAX_FILTER = True
+# The max number of draws to collect TEST_DISTRACTOR_COUNT candidates passing the syntax filter in one trial
+SYNTAX_FILTER_MAX_DRAWS = 3
+
+# The number of sentences generated in one request for a word, the best valid one is chosen
+#   1 means one sentence per request
+SENT_GEN_N_CHOICES = 1
+# SENT_GEN_N_CHOICES = 3
+# How to choose among the valid sentences: 'length' | 'position' | 'first'
+SENT_GEN_SCORER = 'length'
+# The length range requested in the prompt, used by the 'length' scorer
+SENT_GEN_TARGET_WORDS = (15, 20)
+# Sentences out of this length range are rejected when choosing among several
+SENT_GEN_MIN_WORDS = 12
+SENT_GEN_MAX_WORDS = 25
+
+# The max number of words whose sentences are generated in one request (JSON keyed by word),
+#   the words of several word families are batched together and the failed ones are re-queued.
+#   1 means one word per request. SENT_GEN_N_CHOICES is not used in the batched mode.
+SENT_GEN_BATCH_SIZE = 1
+# SENT_GEN_BATCH_SIZE = 8
+
+# The max number of cloze items whose distractor candidates are tested in one rationality request,
+#   used with SENT_GEN_BATCH_SIZE > 1 where the items of a group of word families are checked together.
+#   1 means one item per request.
+RATIONAL_BATCH_SIZE = 1
+# RATIONAL_BATCH_SIZE = 4
+
+# Write the log of a run as gzip'ed JSONL (<run-id>-log.000.jsonl.gz, ...) with each prompt kept as 
+#   its template id and inputs, False for the plain JSONL log with the full prompts
+COMPACT_RUN_LOG = True
+# The max number of log rows kept in memory before they are compressed to the file
+RUN_LOG_BUFFER_ROWS = 200
+# The number of rows in one file of the run log before a new file is started
+RUN_LOG_ROTATE_ROWS = 20000
+
+# The metrics of each run (latency, tokens, cost, retries, accept/reject rates per stage and tag) are written here
+#   as <run-id>-metrics.json and <run-id>-metrics.prom (Prometheus text format)
+METRICS_DIR = './log/metrics'
+# The upper bounds (seconds) of the latency histogram buckets
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# USD per 1M tokens: (input, cached input, output), used to estimate the cost of a run
+MODEL_PRICES = {
+    'gpt-4-1106-preview': (10.0, 10.0, 30.0),
+    'gpt-4': (30.0, 30.0, 60.0),
+    'gpt-3.5-turbo': (0.5, 0.5, 1.5),
+    'gpt-4o': (2.5, 1.25, 10.0),
+    'gpt-4o-mini': (0.15, 0.075, 0.6),
+}
+
+# `python main.py --profile ...` writes the cProfile stats and the span trace of the command here
+PROFILE_DIR = './log/profile'
+# The number of functions listed in the text summary of the profile, by cumulative and by own time
+PROFILE_TOP_N = 40
+
+# Send a duplicate of an LLM request that is slower than HEDGE_PERCENTILE of the recent requests of its task,
+#   and take whichever finishes first
+HEDGE_ENABLED = False
+# HEDGE_ENABLED = True
+HEDGE_PERCENTILE = 0.95
+# The hedge delay is kept in this range, the max is used until HEDGE_MIN_SAMPLES latencies are seen
+HEDGE_MIN_DELAY_SECS = 2
+HEDGE_MAX_DELAY_SECS = 20
+HEDGE_MIN_SAMPLES = 20
+# The number of recent latencies of each task used for the percentile
+HEDGE_WINDOW = 200
+# The extra requests are at most HEDGE_BUDGET_RATIO of the requests, with up to HEDGE_BUDGET_BURST at once
+HEDGE_BUDGET_RATIO = 0.1
+HEDGE_BUDGET_BURST = 5
+# Task name -> seconds after which all the attempts of a request are given up (and retried), 
+#   independent of hedging. The tasks not listed have no deadline other than REQUEST_TIMEOUT_SECS.
+STAGE_DEADLINE_SECS = {}
+# STAGE_DEADLINE_SECS = {'Sentence Generation': 30, 'Rationality Test': 30, 'Batch Sentence Generation': 45, 'Batch Rationality Test': 45}
+
+# Error class -> (max attempts, base delay, max delay in seconds) of the LLM requests (see lib/retry.py),
+#   the delay before the n-th retry is drawn from [0, min(max delay, base delay * 2 ** (n - 1))].
+#   The responses that fail to parse are retried at once with a new variant, RETRY_COUNT_FOR_SINGLE_WORD times.
+RETRY_POLICY = {
+    'transient': (4, 1, 30),    # timeouts and connection errors
+    'rate_limit': (6, 2, 60),   # 429, the rate limiter also holds back the other requests
+    'server': (4, 2, 60),       # 5xx
+    'permanent': (1, 0, 0),     # auth, bad request and the other 4xx: never retried
+}
+# Stop the run (resumable) after this many LLM runs in a row failed, after their retries. 0 to disable.
+CIRCUIT_BREAKER_THRESHOLD = 10